@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark math extraction on paragraphs with many inline formulas.
+
+The time per formula should stay flat as the number of formulas grows:
+
+    python benchmark/bench_math.py
+    python benchmark/bench_math.py 1000 10000 100000
+"""
+
+import sys
+import time
+
+from md2zhihu.parser.transform.math import extract_math
+from md2zhihu.parser.transform.math import join_math_text
+
+
+def paragraph(n):
+    return " ".join(["x$a_{%d}$" % i for i in range(n)])
+
+
+def paragraphs(n):
+    """
+    A ``$$`` block spanning ``n`` paragraphs.
+    """
+    nodes = []
+    for i in range(n):
+        nodes.append({"type": "paragraph", "children": [{"type": "text", "text": "y_{%d}" % i}]})
+
+    nodes[0]["children"][0]["text"] = "$$"
+    nodes[-1]["children"][0]["text"] = "$$"
+    return nodes
+
+
+def bench(f, arg):
+    t0 = time.perf_counter()
+    f(arg)
+    return time.perf_counter() - t0
+
+
+def main(sizes):
+    print("{:>10} {:>14} {:>14} {:>14} {:>14}".format("n", "extract(s)", "us/formula", "join(s)", "us/paragraph"))
+
+    for n in sizes:
+        t_extract = bench(extract_math, {"type": "text", "text": paragraph(n)})
+        t_join = bench(join_math_text, paragraphs(n))
+
+        print(
+            "{:>10} {:>14.4f} {:>14.3f} {:>14.4f} {:>14.3f}".format(
+                n, t_extract, t_extract / n * 1e6, t_join, t_join / n * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 2000, 4000, 8000, 16000]
+    main(sizes)
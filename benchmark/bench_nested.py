@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark rendering deeply nested lists and quotes.
+
+The time per output byte should stay flat as the nesting depth grows:
+
+    python benchmark/bench_nested.py
+    python benchmark/bench_nested.py 10 100 200
+"""
+
+import sys
+import time
+
+import md2zhihu
+
+
+def nested(depth, lines=20):
+    """
+    Build an ast of a list item and a quote at every level, each with ``lines`` lines of text.
+
+    The ast is built directly because the markdown parser limits the nesting depth.
+    """
+    text = "\n".join(["line %d" % j for j in range(lines)])
+
+    node = {"type": "paragraph", "children": [{"type": "text", "text": text}]}
+    for i in range(depth):
+        quote = {"type": "block_quote", "children": [node]}
+        item = {
+            "type": "list_item",
+            "children": [
+                {"type": "paragraph", "children": [{"type": "text", "text": text}]},
+                quote,
+            ],
+        }
+        node = {"type": "list", "ordered": False, "children": [item]}
+
+    return node
+
+
+def main(depths):
+    conf = md2zhihu.Config("x.md", "transparent", "bench-out", "bench-out", md_output_path="bench-out/")
+    mdr = md2zhihu.MDRender(conf, features=conf.features)
+
+    print("{:>10} {:>14} {:>14} {:>14}".format("depth", "render(s)", "output(KB)", "us/KB"))
+
+    for depth in depths:
+        root = md2zhihu.RenderNode({"type": "ROOT", "children": [nested(depth)]})
+
+        t0 = time.perf_counter()
+        lines = mdr.render(root)
+        t = time.perf_counter() - t0
+
+        size = sum(len(x) + 1 for x in lines) / 1024
+        print("{:>10} {:>14.4f} {:>14.1f} {:>14.3f}".format(depth, t, size, t / size * 1e6))
+
+
+if __name__ == "__main__":
+    depths = [int(x) for x in sys.argv[1:]] or [10, 20, 40, 80, 160]
+    main(depths)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark parsing, transforms, rendering and converting on a synthetic corpus.
+
+External converters of ``k3down2`` are stubbed, thus it needs neither network
+nor tools such as pandoc, mermaid or a browser. Results are saved in json, so
+that results of two commits can be compared:
+
+    python benchmark/bench_suite.py
+    python benchmark/bench_suite.py --articles 50 --scale 2 --repeat 5
+    python benchmark/bench_suite.py --compare benchmark/results/<a>.json benchmark/results/<b>.json
+
+Measured items, the best of ``--repeat`` runs over the whole corpus:
+
+- ``parse``: ``new_parser()`` on every article;
+- ``transform:<pass>``: every transform pass run by ``Article``;
+- ``render:<platform>``: rendering every article with ``MDRender``;
+- ``convert_md``: end to end ``convert_all`` to zhihu, writing outputs and assets.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import k3down2
+
+import md2zhihu
+from md2zhihu.cli import convert_all
+from md2zhihu.parser import new_parser
+from md2zhihu.platform import platform_feature_dict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import Corpus  # noqa: E402
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def stub_convert(typ, content, out, opt=None):
+    """
+    Stand-in for ``k3down2.convert`` that returns a constant result of the output type.
+    """
+    if out in ("jpg", "png"):
+        return b"\xff\xd8\xff\xe0stub"
+    if out == "imgtag":
+        return '<img src="https://example.com/stub.svg" />'
+    if out == "svg":
+        return "<svg></svg>"
+    if out == "html":
+        return "<table></table>"
+    return content
+
+
+def best_of(repeat, f):
+    rst = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        t = time.perf_counter() - t0
+        if rst is None or t < rst:
+            rst = t
+    return rst
+
+
+def new_conf(path, platform, out, corpus_dir):
+    return md2zhihu.Config(
+        path,
+        platform,
+        out,
+        os.path.join(out, platform),
+        md_output_path=os.path.join(out, platform) + "/",
+        ref_files=[os.path.join(corpus_dir, "refs.yml")],
+    )
+
+
+def run(corpus, repeat):
+    rst = {}
+
+    tmp = tempfile.mkdtemp(prefix="md2zhihu-bench-")
+    try:
+        corpus_dir = os.path.join(tmp, "corpus")
+        out = os.path.join(tmp, "out")
+        paths = corpus.generate(corpus_dir)
+        texts = [open(p).read() for p in paths]
+
+        # Articles are read relative to cwd
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        paths = [os.path.relpath(p, tmp) for p in paths]
+        corpus_dir = "corpus"
+        out = "out"
+
+        try:
+            parse = new_parser()
+            rst["parse"] = best_of(repeat, lambda: [parse(t) for t in texts])
+
+            # Transforms: the sum of every pass over the corpus, in the fastest run
+
+            transforms = None
+            for _ in range(repeat):
+                parser_config = md2zhihu.ParserConfig(True, [r"[.]md$"], timing=True)
+                sums = {}
+                for p, t in zip(paths, texts):
+                    article = md2zhihu.Article(parser_config, new_conf(p, "zhihu", out, corpus_dir), t)
+                    for k, v in article.timings.items():
+                        if k != "parse":
+                            sums["transform:" + k] = sums.get("transform:" + k, 0.0) + v
+                if transforms is None or sum(sums.values()) < sum(transforms.values()):
+                    transforms = sums
+            rst.update(transforms)
+
+            # Render to every platform.
+            # Rendering modifies the ast, e.g., urls of images, thus every run renders new articles.
+
+            parser_config = md2zhihu.ParserConfig(True, [r"[.]md$"])
+            for platform in platform_feature_dict:
+                best = None
+                for _ in range(repeat):
+                    articles = []
+                    for p, t in zip(paths, texts):
+                        conf = new_conf(p, platform, out, corpus_dir)
+                        os.makedirs(conf.asset_output_dir, exist_ok=True)
+                        articles.append(md2zhihu.Article(parser_config, conf, t))
+
+                    t0 = time.perf_counter()
+                    for a in articles:
+                        a.render()
+                    t = time.perf_counter() - t0
+                    if best is None or t < best:
+                        best = t
+
+                rst["render:" + platform] = best
+
+            # End to end
+
+            def convert():
+                shutil.rmtree(out, ignore_errors=True)
+                confs = [new_conf(p, "zhihu", out, corpus_dir) for p in paths]
+                convert_all(md2zhihu.ParserConfig(True, [r"[.]md$"]), confs)
+
+            rst["convert_md"] = best_of(repeat, convert)
+
+        finally:
+            os.chdir(cwd)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return rst
+
+
+def git_rev():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+        return out.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(base_path, new_path, threshold):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    if base["corpus"] != new["corpus"]:
+        print("Warning: results are measured on different corpora")
+
+    print("{:<36} {:>10} {:>10} {:>8}".format("item", base["rev"], new["rev"], "ratio"))
+
+    regressions = 0
+    for k in sorted(set(base["results"]) | set(new["results"])):
+        a = base["results"].get(k)
+        b = new["results"].get(k)
+        if a is None or b is None:
+            print("{:<36} {:>10} {:>10}".format(k, fmt(a), fmt(b)))
+            continue
+
+        ratio = b / a if a > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = " slower"
+            regressions += 1
+        print("{:<36} {:>10} {:>10} {:>8.2f}{}".format(k, fmt(a), fmt(b), ratio, flag))
+
+    return regressions
+
+
+def fmt(t):
+    if t is None:
+        return "-"
+    return "{:.4f}".format(t)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark md2zhihu on a synthetic corpus")
+    parser.add_argument("--articles", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=str, help="path of result json, default: benchmark/results/<rev>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="ratio of slowdown reported as regression")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        sys.exit(1 if regressions > 0 else 0)
+
+    k3down2.convert = stub_convert
+
+    corpus = Corpus(args.articles, args.scale, args.seed)
+    rst = run(corpus, args.repeat)
+
+    rev = git_rev()
+    data = dict(rev=rev, time=int(time.time()), python=sys.version.split()[0], corpus=corpus.to_dict(), results=rst)
+
+    path = args.output
+    if path is None:
+        os.makedirs(results_dir, exist_ok=True)
+        path = os.path.join(results_dir, rev + ".json")
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+    print("{:<36} {:>10}".format("item", "seconds"))
+    for k in sorted(rst):
+        print("{:<36} {:>10}".format(k, fmt(rst[k])))
+    print("results are written to", path)
+
+
+if __name__ == "__main__":
+    main()
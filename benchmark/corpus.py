@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Generate a synthetic markdown corpus for benchmarks.
+
+Every article has deep lists, a long table, thousands of inline math spans,
+refs defined in a shared refs file and in the article, nested embeds and many local images:
+
+    python benchmark/corpus.py bench-corpus
+    python benchmark/corpus.py bench-corpus --articles 100 --scale 4
+
+The layout of a generated corpus:
+
+    <dir>/refs.yml
+    <dir>/article-<i>.md
+    <dir>/snippets/*.md     embedded by every article
+    <dir>/assets/*.jpg      local images
+"""
+
+import argparse
+import os
+import random
+
+# Size of every kind of content at scale 1.
+default_sizes = dict(
+    list_depth=6,
+    list_width=3,
+    table_rows=200,
+    math_spans=1000,
+    refs=500,
+    images=50,
+    code_blocks=10,
+    paragraphs=50,
+)
+
+
+class Corpus(object):
+    """
+    Parameters of a generated corpus, ``sizes`` are scaled by ``scale``.
+    """
+
+    def __init__(self, articles: int = 20, scale: float = 1.0, seed: int = 0) -> None:
+        self.articles = articles
+        self.scale = scale
+        self.seed = seed
+
+        self.sizes = {k: max(1, int(v * scale)) for k, v in default_sizes.items()}
+
+        # Nesting of lists is limited by the markdown parser
+        self.sizes["list_depth"] = min(default_sizes["list_depth"], self.sizes["list_depth"])
+
+    def to_dict(self) -> dict:
+        return dict(articles=self.articles, scale=self.scale, seed=self.seed, sizes=self.sizes)
+
+    def generate(self, d: str) -> list:
+        """
+        Write the corpus into dir ``d``.
+
+        :return: paths of the articles.
+        """
+        r = random.Random(self.seed)
+
+        os.makedirs(os.path.join(d, "snippets"), exist_ok=True)
+        os.makedirs(os.path.join(d, "assets"), exist_ok=True)
+
+        write(d, "refs.yml", refs_file(self.sizes["refs"]))
+
+        for i in range(self.sizes["images"]):
+            write(d, "assets/img-%d.jpg" % i, bytes(r.getrandbits(8) for _ in range(2048)), mode="wb")
+
+        # Nested embeds: footer -> license -> glossary
+        write(d, "snippets/glossary.md", "\n".join(["- [ref-%d][]: term %d" % (j, j) for j in range(20)]) + "\n")
+        write(d, "snippets/license.md", "License text $x^2$.\n\n![](glossary.md)\n")
+        write(d, "snippets/footer.md", "---\n\nFooter with ![](../assets/img-0.jpg)\n\n![](license.md)\n")
+
+        paths = []
+        for i in range(self.articles):
+            fn = "article-%d.md" % i
+            write(d, fn, self.article(r, i))
+            paths.append(os.path.join(d, fn))
+
+        return paths
+
+    def article(self, r: random.Random, i: int) -> str:
+        s = self.sizes
+        parts = ["# Article %d" % i, ""]
+
+        for p in range(s["paragraphs"]):
+            words = " ".join(["word%d" % r.randrange(1000) for _ in range(30)])
+            parts.extend(["%s [ref-%d][] `code %d`" % (words, r.randrange(s["refs"]), p), ""])
+
+        parts.extend(deep_list(s["list_depth"], s["list_width"]))
+        parts.extend(table(s["table_rows"]))
+
+        spans = ["x$a_{%d} + b$" % j for j in range(s["math_spans"])]
+        for j in range(0, len(spans), 50):
+            parts.extend([" ".join(spans[j : j + 50]), ""])
+
+        parts.extend(["$$", "\\sum_{i=0}^{n} x_i = %d" % i, "$$", ""])
+
+        for j in range(s["code_blocks"]):
+            parts.extend(["```python", "def f%d(x):" % j, "    return x + %d" % j, "```", ""])
+        parts.extend(["```mermaid", "graph LR", "    A%d --> B" % i, "```", ""])
+        parts.extend(["```graphviz", "digraph G { a%d -> b }" % i, "```", ""])
+
+        for j in range(s["images"]):
+            parts.extend(["![img %d](assets/img-%d.jpg)" % (j, j), ""])
+
+        parts.extend(["> quoted [local-%d][]" % i, "> - in list $y$", ""])
+        parts.extend(["![](snippets/footer.md)", ""])
+        parts.append("[local-%d]: https://example.com/local/%d" % (i, i))
+
+        return "\n".join(parts) + "\n"
+
+
+def deep_list(depth: int, width: int, level: int = 0) -> list:
+    lines = []
+    for i in range(width):
+        lines.append("    " * level + "- item %d.%d $z_{%d}$" % (level, i, i))
+        lines.append("")
+        if level + 1 < depth:
+            lines.extend(deep_list(depth, width, level + 1))
+    return lines
+
+
+def table(rows: int) -> list:
+    lines = ["| name | value | math |", "| :-- | :-: | --: |"]
+    for i in range(rows):
+        lines.append("| row %d | `v%d` | $t_{%d}$ |" % (i, i, i))
+    return lines + [""]
+
+
+def refs_file(n: int) -> str:
+    lines = ["universal:"]
+    for i in range(n):
+        lines.append('  - "ref-%d": https://example.com/ref/%d' % (i, i))
+    lines.append("zhihu:")
+    lines.append('  - "ref-0": https://zhihu.com/ref/0')
+    return "\n".join(lines) + "\n"
+
+
+def write(d: str, fn: str, cont, mode: str = "w") -> None:
+    with open(os.path.join(d, fn), mode) as f:
+        f.write(cont)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic markdown corpus")
+    parser.add_argument("dir", type=str)
+    parser.add_argument("--articles", type=int, default=20)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.articles, args.scale, args.seed)
+    paths = corpus.generate(args.dir)
+    print("generated {} articles in {}".format(len(paths), args.dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
 import logging
 
 from . import platform
+from .api import Converted
+from .api import convert_text
+from .asset import AssetSink
+from .asset import DirSink
+from .asset import MemorySink
 from .asset import save_image_to_asset_dir
 from .cli import main
 from .config import AssetRepo
 from .config import Config
 from .config import LocalRepo
+from .converters import ConvertQueue
+from .converters import MathTable
+from .converters import RenderCache
 from .converters import block_code_graphviz_to_jpg
 from .converters import block_code_mermaid_to_jpg
 from .converters import block_code_to_fixwidth_jpg
@@ -17,15 +25,24 @@ from .converters import math_inline_single_dolar
 from .converters import math_inline_to_imgtag
 from .converters import math_inline_to_jpg
 from .converters import math_inline_to_plaintext
+from .converters import prerender_math
 from .converters import table_to_barehtml
 from .converters import table_to_jpg
 from .converters import to_plaintext
+from .manifest import Manifest
 from .parser import Article
 from .parser import FrontMatter
+from .parser import Node
+from .parser import ParsedMarkdown
 from .parser import ParserConfig
 from .parser import load_external_refs
 from .renderer import RenderNode
 from .renderer.md_render import MDRender
+from .serve import Converter
+from .timing import TimingReport
+from .timing import Timings
+from .timing import add_stage_hook
+from .timing import remove_stage_hook
 from .utils import add_paragraph_end
 from .utils import asset_fn
 from .utils import escape
@@ -34,6 +51,9 @@ from .utils import indent
 from .utils import msg
 from .utils import sj
 from .utils import strip_paragraph_end
+from .watch import InotifyWatcher
+from .watch import PollWatcher
+from .watch import new_watcher
 
 logger = logging.getLogger(__name__)
 
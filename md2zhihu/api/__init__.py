@@ -0,0 +1,98 @@
+"""Convert markdown text in memory, for using md2zhihu as a library"""
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from ..asset import AssetSink
+from ..asset import MemorySink
+from ..config import Config
+from ..converters import MathTable
+from ..parser import Article
+from ..parser import ParserConfig
+
+
+class Converted(object):
+    """
+    Result of ``convert_text()``: the output ``markdown``,
+    paths of the ``assets`` it references and the ``asset_sink`` they are stored in.
+    """
+
+    def __init__(self, markdown: str, assets: List[str], asset_sink: AssetSink) -> None:
+        self.markdown = markdown
+        self.assets = assets
+        self.asset_sink = asset_sink
+
+    def blobs(self) -> Dict[str, bytes]:
+        """
+        Return the content of every asset, keyed by path.
+        """
+        return {p: self.asset_sink.read(p) for p in self.assets}
+
+
+def convert_text(
+    md_text: str,
+    platform: str = "zhihu",
+    src_path: str = "article.md",
+    asset_sink: Optional[AssetSink] = None,
+    output_dir: str = ".",
+    asset_output_dir: Optional[str] = None,
+    md_output_path: Optional[str] = None,
+    parser_config: Optional[ParserConfig] = None,
+    math_table: Optional[MathTable] = None,
+    generated: Optional[Dict[str, str]] = None,
+    **options,
+) -> Converted:
+    """
+    Convert markdown text ``md_text`` to ``platform`` and return the result.
+
+    Assets are stored in ``asset_sink``, by default a ``MemorySink``, and the
+    output markdown is returned, thus nothing is written to file system.
+    Nothing is logged about the config and no git command is run.
+
+    Paths are derived the same way as the command line does:
+    ``src_path`` is where embedded markdowns and local images are read relative to,
+    assets are stored at ``<asset_output_dir>/<name of src_path>/<fn>``,
+    and image urls are relative to ``md_output_path`` unless ``asset_url_pattern`` or ``asset_repo_url`` is specified.
+    ``asset_output_dir`` defaults to ``output_dir``, ``md_output_path`` defaults to ``<output_dir>/``.
+
+    ``options`` are passed to ``Config``, e.g., ``asset_url_pattern``, ``ref_files``, ``code_width`` or ``download``.
+    Note that ``asset_repo_url`` runs git if it is a shortcut such as ".", and ``cache_dir`` writes to the cache dir.
+
+    ``parser_config``, ``math_table`` and ``generated`` can be shared by calls
+    to reuse parsed embedded markdowns, rendered math and generated images.
+    Calls sharing them must not run concurrently.
+    """
+
+    if asset_sink is None:
+        asset_sink = MemorySink()
+
+    if asset_output_dir is None:
+        asset_output_dir = output_dir
+
+    if md_output_path is None:
+        md_output_path = output_dir + "/"
+
+    if parser_config is None:
+        parser_config = ParserConfig(True, [r"[.]md$"])
+
+    conf = Config(
+        src_path,
+        platform,
+        output_dir,
+        asset_output_dir,
+        md_output_path=md_output_path,
+        asset_sink=asset_sink,
+        verbose=False,
+        **options,
+    )
+
+    if math_table is not None:
+        conf.math_table = math_table
+    if generated is not None:
+        conf.generated = generated
+
+    article = Article(parser_config, conf, md_text)
+    lines = article.render()
+
+    return Converted("\n".join(lines), sorted(conf.assets), asset_sink)
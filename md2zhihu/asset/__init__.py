@@ -1,12 +1,285 @@
 import hashlib
 import os
-import re
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AbstractSet
+from typing import Dict
+from typing import Tuple
 
 import urllib3
-from k3handy import pjoin
 from k3handy import to_bytes
 
+from ..timing import stage_hooks
+from ..utils import fwrite_atomic
+from ..utils import http_url_regex
+
+_http = None
+_http_size = 0
+_http_lock = threading.Lock()
+
+# abspath -> (mtime_ns, size, md5 of file content).
+# One entry per file, replaced when the file changes, thus a long running process does not accumulate stale digests.
+_digests: Dict[str, Tuple[int, int, str]] = {}
+
+# ioctl request to clone a file on linux: FICLONE = _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def http_pool(maxsize: int = 8) -> urllib3.PoolManager:
+    """
+    Return the process wide http connection pool for downloading images.
+
+    It keeps at least ``maxsize`` connections per host, and is rebuilt if a
+    larger ``maxsize`` is requested, so that connections of concurrent
+    downloads are not discarded when they are returned to a full pool.
+    """
+    global _http, _http_size
+
+    with _http_lock:
+        if _http is None or maxsize > _http_size:
+            _http_size = max(maxsize, _http_size)
+            _http = urllib3.PoolManager(
+                maxsize=_http_size,
+                retries=urllib3.Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    raise_on_status=False,
+                ),
+                timeout=urllib3.Timeout(connect=10, read=60),
+            )
+        return _http
+
+
+def file_md5(path: str) -> str:
+    """
+    Return md5 hex digest of the content of a file.
+
+    The file is read in chunks. The digest is cached by path, mtime and size,
+    so that a file shared by many markdowns is read only once in a process.
+    """
+    st = os.stat(path)
+    key = os.path.abspath(path)
+
+    cached = _digests.get(key)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _digests[key] = (st.st_mtime_ns, st.st_size, digest)
+
+    return digest
+
+
+def place_file(src: str, target: str, mode: str = "copy") -> None:
+    """
+    Place a copy of file ``src`` at ``target``.
+
+    ``mode`` is one of:
+    - ``"copy"``: copy bytes.
+    - ``"hardlink"``: hard link ``target`` to ``src``.
+    - ``"reflink"``: clone ``src`` with copy-on-write, on file systems that support it, e.g., btrfs or xfs.
+
+    If ``target`` can not be linked or cloned, e.g., on another device or on windows, it falls back to copy.
+    """
+
+    if mode == "hardlink":
+        try:
+            os.link(src, target)
+            return
+        except OSError:
+            pass
+
+    if mode == "reflink":
+        try:
+            # Not available on windows
+            import fcntl
+
+            with open(src, "rb") as fsrc, open(target, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+
+    shutil.copyfile(src, target)
+
+
+class AssetSink(object):
+    """
+    Where the assets of converted markdowns are stored, e.g., images generated by
+    external converters, local images and downloaded remote images.
+
+    An asset is addressed by its path ``<asset_output_dir>/<article>/<fn>``,
+    the same path its url in output markdown is built from.
+    Subclass it to store assets elsewhere, e.g., in an object store.
+    Methods may be called from more than one thread.
+    """
+
+    def exists(self, path: str) -> bool:
+        raise NotImplementedError
+
+    def read(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    def write(self, path: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def place(self, src: str, path: str) -> None:
+        """
+        Store local file ``src`` as asset ``path``.
+        """
+        with open(src, "rb") as f:
+            self.write(path, f.read())
+
+    def copy(self, src_path: str, path: str) -> None:
+        """
+        Store a copy of asset ``src_path`` as asset ``path``.
+        """
+        self.write(path, self.read(src_path))
+
+
+class DirSink(AssetSink):
+    """
+    Store assets as files. A local file is placed by ``place_file()`` with ``link`` mode.
+
+    Missing dirs are created. A file is written to a temp file then renamed, it is never seen partially written.
+    """
+
+    def __init__(self, link: str = "copy") -> None:
+        self.link = link
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write(self, path: str, data: bytes) -> None:
+        d = os.path.dirname(path) or "."
+        os.makedirs(d, exist_ok=True)
+
+        fwrite_atomic(path, data)
+
+    def place(self, src: str, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        place_file(src, path, self.link)
+
+    def copy(self, src_path: str, path: str) -> None:
+        self.place(src_path, path)
+
+
+class MemorySink(AssetSink):
+    """
+    Keep assets in memory, in ``assets``: a dict of path to content. Nothing is written to file system.
+    """
+
+    def __init__(self) -> None:
+        self.assets: Dict[str, bytes] = {}
+        self.lock = threading.Lock()
+
+    def exists(self, path: str) -> bool:
+        with self.lock:
+            return path in self.assets
+
+    def read(self, path: str) -> bytes:
+        with self.lock:
+            return self.assets[path]
+
+    def write(self, path: str, data: bytes) -> None:
+        with self.lock:
+            self.assets[path] = data
+
+
+def remote_image_fn(src: str) -> str:
+    """
+    Build asset file name for a remote image url: ``<md5(url)[:16]>-<basename>``.
+    """
+    fn = src.split("/")[-1].split("#")[0].split("?")[0]
+
+    content_md5 = hashlib.md5(to_bytes(src)).hexdigest()
+    content_md5 = content_md5[:16]
+    return content_md5 + "-" + fn
+
+
+def fetch_image(src: str) -> bytes:
+    r = http_pool().request("GET", src)
+    if r.status != 200:
+        raise Exception("Failure to download:", src)
+    return r.data
+
+
+def collect_remote_images(nodes, rst: dict, skip_types: AbstractSet[str] = frozenset()) -> dict:
+    """
+    Collect the src of every image node with a http(s) url, in the order they appear.
+    Images in a node of type in ``skip_types`` are not collected.
+    """
+    for n in nodes:
+        if n["type"] in skip_types:
+            continue
+
+        if n["type"] == "image" and http_url_regex.match(n["src"]):
+            rst[n["src"]] = True
+
+        if "children" in n:
+            collect_remote_images(n["children"], rst, skip_types)
+
+    return rst
+
+
+def prefetch_remote_images(mdrender, nodes, skip_types: AbstractSet[str] = frozenset()) -> None:
+    """
+    Download remote images in ``nodes`` concurrently into asset sink, at most ``conf.download_jobs`` at a time,
+    so that ``save_image_to_asset_dir`` only needs to rewrite the url.
+
+    Images in a node of type in ``skip_types`` are not downloaded, e.g., a table
+    converted to one jpg, whose images are not handled by the platform.
+
+    It does nothing unless ``--download`` is specified and the platform handles images.
+    """
+
+    conf = mdrender.conf
+    if not conf.download:
+        return
+
+    sink = conf.asset_sink
+
+    if "image" not in mdrender.features and "*" not in mdrender.features:
+        return
+
+    todo = []
+    for src in collect_remote_images(nodes, {}, skip_types):
+        target = conf.asset_path(remote_image_fn(src))
+        if sink.exists(target):
+            continue
+
+        # Already downloaded for another platform
+        downloaded = conf.generated.get(src)
+        if downloaded is not None and sink.exists(downloaded):
+            with conf.timings.stage("asset:copy"):
+                sink.copy(downloaded, target)
+            continue
+
+        todo.append((src, target))
+
+    jobs = max(1, conf.download_jobs)
+    http_pool(jobs)
+
+    t0 = time.perf_counter()
+    with stage_hooks("asset:download"), ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(lambda x: sink.write(x[1], fetch_image(x[0])), todo))
+    if len(todo) > 0:
+        conf.timings.add("asset:download", time.perf_counter() - t0, len(todo))
+
+    for src, target in todo:
+        conf.generated[src] = target
+
 
 def save_image_to_asset_dir(mdrender, rnode):
     #  {'alt': 'openacid',
@@ -15,28 +288,21 @@ def save_image_to_asset_dir(mdrender, rnode):
     #   'type': 'image'},
 
     n = rnode.node
+    sink = mdrender.conf.asset_sink
 
     src = n["src"]
-    if re.match(r"https?://", src):
+    if http_url_regex.match(src):
         if not mdrender.conf.download:
             return None
 
-        fn = src.split("/")[-1].split("#")[0].split("?")[0]
+        fn = remote_image_fn(src)
 
-        content_md5 = hashlib.md5(to_bytes(src)).hexdigest()
-        content_md5 = content_md5[:16]
-        fn = content_md5 + "-" + fn
+        target = mdrender.conf.asset_path(fn)
 
-        target = pjoin(mdrender.conf.asset_output_dir, fn)
-
-        if not os.path.exists(target):
-            http = urllib3.PoolManager()
-            r = http.request("GET", src)
-            if r.status != 200:
-                raise Exception("Failure to download:", src)
-
-            with open(target, "wb") as f:
-                f.write(r.data)
+        # Usually it is already downloaded by prefetch_remote_images()
+        if not sink.exists(target):
+            with mdrender.conf.timings.stage("asset:download"):
+                sink.write(target, fetch_image(src))
 
         n["src"] = mdrender.conf.img_url(fn)
 
@@ -46,15 +312,15 @@ def save_image_to_asset_dir(mdrender, rnode):
 
     fn = os.path.split(src)[1]
 
-    with open(src, "rb") as f:
-        content = f.read()
-
-    content_md5 = hashlib.md5(content).hexdigest()
+    content_md5 = file_md5(src)
     content_md5 = content_md5[:16]
     fn = content_md5 + "-" + fn
 
-    target = pjoin(mdrender.conf.asset_output_dir, fn)
-    shutil.copyfile(src, target)
+    # The file name contains the content hash, an existing target has the same content.
+    target = mdrender.conf.asset_path(fn)
+    if not sink.exists(target):
+        with mdrender.conf.timings.stage("asset:copy"):
+            sink.place(src, target)
 
     n["src"] = mdrender.conf.img_url(fn)
 
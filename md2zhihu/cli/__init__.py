@@ -2,36 +2,429 @@ import argparse
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from k3color import darkred
 from k3color import darkyellow
 from k3color import green
 from k3fs import fread
+from k3handy import pjoin
 
 from ..config import Config
+from ..manifest import Manifest
 from ..parser import Article
+from ..parser import ParsedMarkdown
 from ..parser import ParserConfig
+from ..platform import platform_feature_dict
+from ..serve import Converter
+from ..serve import new_server
+from ..timing import ProfileHook
+from ..timing import TimingReport
+from ..timing import add_stage_hook
 from ..utils import msg
 from ..utils import sj
+from ..watch import file_stat
+from ..watch import new_watcher
 
 
-def convert_md(parser_config, conf):
+def convert_md(parser_config, conf, parsed=None):
+    """
+    Convert a markdown with ``conf``.
+
+    ``parsed`` is a ``ParsedMarkdown`` of the source markdown, shared with other platforms.
+    """
     os.makedirs(conf.output_dir, exist_ok=True)
     os.makedirs(conf.asset_output_dir, exist_ok=True)
     os.makedirs(conf.md_output_base, exist_ok=True)
 
-    md_text = fread(conf.src_path)
+    with conf.timings.stage("article"):
+        md_text = fread(conf.src_path)
+
+        article = Article(parser_config, conf, md_text, parsed=parsed)
 
-    article = Article(parser_config, conf, md_text)
+        with conf.timings.stage("render"):
+            article.write(conf.md_output_path)
 
-    output_lines = article.render()
+    for name, seconds in article.timings.items():
+        conf.timings.add(name if name == "parse" else "transform:" + name, seconds)
 
-    with open(conf.md_output_path, "w") as f:
-        f.write(str("\n".join(output_lines)))
+    conf.deps = article.deps
 
     return conf.md_output_path
 
 
+def convert_md_platforms(parser_config, confs):
+    """
+    Convert one markdown to several platforms, one ``conf`` per platform.
+
+    The markdown is parsed only once.
+    Math and images generated by external converters are shared, thus an
+    image used by more than one platform is generated only once.
+
+    :return: ``confs``, with outputs and dependencies recorded.
+    """
+    if len(confs) == 1:
+        convert_md(parser_config, confs[0])
+        return confs
+
+    parsed = ParsedMarkdown(parser_config, fread(confs[0].src_path))
+    if parser_config.timing:
+        confs[0].timings.add("parse", parsed.parse_time)
+
+    for conf in confs[1:]:
+        conf.math_table = confs[0].math_table
+        conf.generated = confs[0].generated
+
+    for conf in confs:
+        convert_md(parser_config, conf, parsed=parsed)
+
+    return confs
+
+
+def convert_md_captured(parser_config, confs):
+    """
+    Run ``convert_md_platforms`` in a pool worker.
+
+    Log messages emitted by the worker are collected and returned to the
+    parent, which outputs them in one piece, so that the log of concurrently
+    built markdowns does not interleave.
+
+    :return: a tuple of ``(confs, log_lines)``,
+        ``confs`` are the configs after building, with outputs and dependencies recorded.
+    """
+
+    log_lines = []
+
+    class CaptureHandler(logging.Handler):
+        def emit(self, record):
+            log_lines.append(record.getMessage())
+
+    saved_handlers, saved_level = logging.root.handlers, logging.root.level
+    logging.root.handlers = [CaptureHandler()]
+    logging.root.setLevel(logging.INFO)
+    try:
+        convert_md_platforms(parser_config, confs)
+        return confs, log_lines
+    finally:
+        logging.root.handlers = saved_handlers
+        logging.root.setLevel(saved_level)
+
+
+def convert_all(parser_config, confs, jobs=1, manifest=None, report=None):
+    """
+    Convert every markdown specified by ``confs``.
+
+    Configs of the same source markdown, i.e., for different platforms, are
+    converted together by ``convert_md_platforms``, parsing the markdown once.
+
+    With ``jobs`` greater than 1, markdowns are converted concurrently in a
+    process pool. Results are reported in the order of ``confs``.
+    A failure of one markdown does not stop building others.
+
+    With a ``manifest``, outputs that are up to date are skipped, and the
+    manifest is updated with every output built.
+
+    With a ``report``, the timings of every output built are added to it.
+
+    :return: a tuple of ``(stat, failures)``:
+        ``stat`` is a list of ``[src_path, md_output_path]`` that are built or up to date,
+        ``failures`` is a list of ``(src_path, exception)``.
+    """
+
+    stat = []
+    failures = []
+
+    def done(conf):
+        msg(sj("Done building ", darkyellow(conf.md_output_path)))
+        stat.append([conf.src_path, conf.md_output_path])
+        if manifest is not None:
+            manifest.update(parser_config, conf)
+        if report is not None:
+            report.add_article(conf)
+
+    # src_path -> confs to build
+    todo = {}
+    for conf in confs:
+        if manifest is not None and manifest.is_up_to_date(parser_config, conf):
+            msg(sj("Up to date: ", darkyellow(conf.md_output_path)))
+            stat.append([conf.src_path, conf.md_output_path])
+            continue
+        todo.setdefault(conf.src_path, []).append(conf)
+
+    if jobs <= 1:
+        for src_path, group in todo.items():
+            try:
+                built_confs = convert_md_platforms(parser_config, group)
+            except Exception as e:
+                msg(darkred(sj("Failed building ", repr(src_path), ": ", repr(e))))
+                failures.append((src_path, e))
+                continue
+
+            for conf in built_confs:
+                done(conf)
+
+        return stat, failures
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(convert_md_captured, parser_config, group) for group in todo.values()]
+
+        for src_path, fut in zip(todo.keys(), futures):
+            try:
+                built_confs, log_lines = fut.result()
+            except Exception as e:
+                msg(darkred(sj("Failed building ", repr(src_path), ": ", repr(e))))
+                failures.append((src_path, e))
+                continue
+
+            for line in log_lines:
+                msg(line)
+
+            for conf in built_confs:
+                done(conf)
+
+    return stat, failures
+
+
+def watch_all(parser_config, confs, manifest, watcher=None, save=False, rounds=None):
+    """
+    Convert every markdown specified by ``confs``, then convert again the
+    markdowns affected whenever a file they depend on changes: the markdown
+    itself, embedded markdowns, refs files or local images.
+
+    Markdowns are converted in this process and ``confs`` are reused, thus
+    parsed refs files and embedded markdowns, rendered math and images
+    generated by external converters are kept, and only changed blocks are
+    converted again. An output markdown is replaced atomically.
+
+    A failure is reported and does not stop watching.
+    A file changed while building is detected when the build is done, and the affected markdowns are built again.
+
+    ``manifest`` records what every output depends on, it is saved after every build if ``save`` is True.
+    ``watcher`` is a ``PollWatcher`` or ``InotifyWatcher``, by default one is created by ``new_watcher()``.
+    ``rounds`` limits how many times to convert again, by default it watches until interrupted.
+    """
+
+    if watcher is None:
+        watcher = new_watcher()
+
+    # src_path -> confs of the markdown
+    groups = {}
+    for conf in confs:
+        groups.setdefault(conf.src_path, []).append(conf)
+
+    # abspath of a file -> src_paths of the markdowns that depend on it
+    dependents = {}
+
+    def watched_paths():
+        return [p for p, s in dependents.items() if len(s) > 0]
+
+    def build(src_paths):
+        """
+        Build ``src_paths`` and return the watched files changed while building.
+        """
+        t0 = time.monotonic()
+
+        # Stats of the files known before building.
+        # A file found by this build is changed while building if its mtime is later than the start.
+        started_ns = time.time_ns()
+        before = {p: file_stat(p) for p in dependents}
+
+        for src_path in src_paths:
+            group = groups[src_path]
+            for conf in group:
+                conf.new_build()
+
+            # A failure is reported by convert_all
+            convert_all(parser_config, group, manifest=manifest)
+
+            for s in dependents.values():
+                s.discard(src_path)
+
+            for conf in group:
+                for p in [conf.src_path] + list(conf.ref_files) + deps_of(conf):
+                    dependents.setdefault(os.path.abspath(p), set()).add(src_path)
+
+        msg(sj("Built ", len(src_paths), " markdowns in ", "{:.3f}".format(time.monotonic() - t0), " seconds"))
+
+        paths = watched_paths()
+
+        # Watch from now on, with the current stats as the baseline,
+        # the changes before now are found by comparing with the stats before building.
+        watcher.watch([])
+        watcher.watch(paths)
+
+        changed = set()
+        for p in paths:
+            st = file_stat(p)
+            if p in before:
+                if st != before[p]:
+                    changed.add(p)
+            elif st is not None and st[0] > started_ns:
+                changed.add(p)
+
+        # The manifest recorded the digests of the changed files after building, not those that are built from.
+        for p in changed:
+            for src_path in dependents[p]:
+                for conf in groups[src_path]:
+                    manifest.discard(conf)
+
+        if save:
+            manifest.gc()
+            manifest.save()
+
+        return changed
+
+    def deps_of(conf):
+        if len(conf.deps) > 0:
+            return conf.deps
+
+        # Skipped because it is up to date, dependencies are those recorded by the last build.
+        entry = manifest.articles.get(os.path.abspath(conf.md_output_path))
+        if entry is None:
+            return []
+        return list(entry["deps"])
+
+    try:
+        changed = build(list(groups))
+
+        n = 0
+        while rounds is None or n < rounds:
+            if len(changed) == 0:
+                msg("Watching ", len(watched_paths()), " files, press Ctrl-C to stop")
+                changed = watcher.wait()
+            n += 1
+
+            srcs = set()
+            for p in changed:
+                srcs.update(dependents.get(p, ()))
+
+            for p in sorted(changed):
+                msg("Changed: ", darkyellow(p))
+
+            changed = build([s for s in groups if s in srcs])
+    finally:
+        watcher.close()
+
+
+def platform_list(s):
+    """
+    Parse a comma separated list of platforms, e.g., "zhihu,wechat,github".
+    """
+    platforms = []
+    for p in s.split(","):
+        p = p.strip()
+        if p not in platform_feature_dict:
+            raise argparse.ArgumentTypeError(
+                "invalid platform: {!r} (choose from {})".format(p, ", ".join(platform_feature_dict))
+            )
+        if p not in platforms:
+            platforms.append(p)
+    return platforms
+
+
+def platform_output_path(path, platform):
+    """
+    Return the output path of ``platform`` when converting to more than one platform:
+    the outputs of each platform are stored in a sub dir named after the platform.
+    """
+    if path.endswith("/"):
+        return pjoin(path, platform) + "/"
+
+    d, fn = os.path.split(path)
+    return pjoin(d, platform, fn)
+
+
+def main_serve(argv):
+    """
+    ``md2zhihu serve``: run a server that converts markdowns sent by requests, until interrupted.
+    """
+    parser = argparse.ArgumentParser(
+        prog="md2zhihu serve",
+        description="Run a server converting markdowns sent over HTTP or a Unix socket."
+        " Requests are received concurrently but converted one at a time.",
+        formatter_class=SmartFormatter,
+    )
+
+    parser.add_argument(
+        "--host",
+        action="store",
+        default="127.0.0.1",
+        help='R|Address to listen on, it must be a loopback address.\nDefault: "127.0.0.1"',
+    )
+    parser.add_argument("--port", action="store", type=int, default=8300, help="R|Port to listen on.\nDefault: 8300")
+    parser.add_argument(
+        "--socket",
+        action="store",
+        required=False,
+        help="R|Listen on a Unix socket at this path instead of <host>:<port>.",
+    )
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        action="store",
+        default="_md2",
+        help='R|Dir to store assets, in "<output-dir>/<name>/".\nDeafult: "_md2"',
+    )
+    parser.add_argument(
+        "-r",
+        "--repo",
+        action="store",
+        required=False,
+        help="R|The git url the assets will be stored in, image urls are built with it.\nNothing is pushed by the server.",
+    )
+    parser.add_argument(
+        "--embed",
+        action="store",
+        nargs="+",
+        required=False,
+        default=[r"[.]md$"],
+        help='R|Specifies regex of url in `![](url)` to embed.\nDefault: ["[.]md$"]',
+    )
+    parser.add_argument(
+        "--root",
+        action="store",
+        default=".",
+        help="R|Dir a request can read files in: the markdown path, refs files, local images and embedded markdowns."
+        " A request referring to a file out of it is rejected."
+        '\nDefault: "."',
+    )
+    parser.add_argument("--cache-dir", action="store", required=False, help="R|The same as in converting markdowns.")
+    parser.add_argument("--convert-jobs", action="store", type=int, default=1, help="R|The same as in converting markdowns.")
+    parser.add_argument("--warm-mermaid", action="store_true", default=False, help="R|The same as in converting markdowns.")
+
+    args = parser.parse_args(argv)
+
+    converter = Converter(
+        args.output_dir,
+        embed_patterns=args.embed,
+        asset_repo_url=args.repo,
+        cache_dir=args.cache_dir,
+        convert_jobs=args.convert_jobs,
+        warm_mermaid=args.warm_mermaid,
+        root=args.root,
+    )
+    try:
+        server = new_server(converter, host=args.host, port=args.port, socket_path=args.socket)
+    except ValueError as e:
+        converter.close()
+        msg(darkred(sj("Can not serve: ", str(e))))
+        sys.exit(1)
+
+    if args.socket is not None:
+        msg("Serving on: ", darkyellow(args.socket))
+    else:
+        msg("Serving on: ", darkyellow("http://{}:{}".format(*server.server_address[:2])))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        msg("Stop serving")
+    finally:
+        server.server_close()
+        converter.close()
+
+
 class SmartFormatter(argparse.HelpFormatter):
     def _split_lines(self, text, width):
         if text.startswith("R|"):
@@ -47,6 +440,10 @@ def main():
     logging.root.addHandler(handler)
     logging.root.setLevel(logging.INFO)
 
+    if sys.argv[1:2] == ["serve"]:
+        main_serve(sys.argv[2:])
+        return
+
     # TODO refine arg names
     # md2zhihu a.md --output-dir res/ --platform xxx --md-output foo/
     # res/fn.md
@@ -61,7 +458,12 @@ def main():
         formatter_class=SmartFormatter,
     )
 
-    parser.add_argument("src_path", type=str, nargs="+", help="path to the markdowns to convert")
+    parser.add_argument(
+        "src_path",
+        type=str,
+        nargs="+",
+        help='path to the markdowns to convert. Run "md2zhihu serve -h" for the conversion server',
+    )
 
     parser.add_argument(
         "-d",
@@ -128,20 +530,17 @@ def main():
         "--platform",
         action="store",
         required=False,
-        default="zhihu",
-        choices=[
-            "zhihu",
-            "github",
-            "wechat",
-            "weibo",
-            "simple",
-            "minimal_mistake",
-            "transparent",
-        ],
-        help="R|Convert to a platform compatible format."
-        "\n"
+        default=["zhihu"],
+        type=platform_list,
+        help="R|Convert to a platform compatible format:"
+        "\n" + ", ".join(platform_feature_dict) + "\n"
         '"simple" is a special type that it produce simplest output, only plain text and images, there wont be table, code block, math etc.'
         "\n"
+        'More than one platforms can be specified, separated by comma, e.g., "zhihu,wechat,github":'
+        " a markdown is parsed once and converted to every platform,"
+        " the output markdowns and assets of each platform are stored in a sub dir named after the platform,"
+        ' e.g., "<md-output>/zhihu/" and "<asset-output-dir>/zhihu/".'
+        "\n"
         'Default: "zhihu"',
     )
 
@@ -211,6 +610,15 @@ def main():
         help="R|Download remote image url if a image url starts with http[s]://.",
     )
 
+    parser.add_argument(
+        "--download-jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=8,
+        help="R|Max number of remote images in a markdown to download concurrently, with --download.\nDefault: 8",
+    )
+
     parser.add_argument(
         "--embed",
         action="store",
@@ -232,6 +640,132 @@ def main():
         help="R|specifies code image width.\nDefault: 1000",
     )
 
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        required=False,
+        help="R|Specify dir to cache images generated by external converters, e.g., mermaid, graphviz, code, table."
+        "\n"
+        "A conversion with the same input and options reuses the cached image instead of running the converter again."
+        "\n"
+        "Default: no cache",
+    )
+
+    parser.add_argument(
+        "--asset-link",
+        action="store",
+        required=False,
+        default="copy",
+        choices=["copy", "hardlink", "reflink"],
+        help="R|How to place a local image into asset dir."
+        "\n"
+        '"hardlink" and "reflink" avoid copying bytes, and fall back to copy if not supported.'
+        "\n"
+        'Default: "copy"',
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        required=False,
+        default=False,
+        help="R|Skip markdowns that are not changed since last build."
+        "\n"
+        "A build manifest is stored in <output-dir> but not pushed to the asset repo, it records the files a markdown depends on:"
+        " the markdown itself, embedded markdowns, local images and refs files."
+        "\n"
+        "Outputs of deleted markdowns and stale assets of rebuilt markdowns are removed.",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        required=False,
+        default=False,
+        help="R|After converting, watch the markdowns, embedded markdowns, refs files and local images,"
+        " and convert again the markdowns affected when any of them changes, until interrupted."
+        "\n"
+        "It uses inotify if supported, otherwise it polls."
+        " Markdowns are converted in one process, <jobs> is ignored, and nothing is pushed.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="R|Number of markdowns to convert concurrently."
+        "\n"
+        "With more than 1 job, a failure of one markdown does not stop converting others,"
+        " and nothing is pushed if any of them fails."
+        "\n"
+        "Default: 1",
+    )
+
+    parser.add_argument(
+        "--convert-jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="R|Max number of external conversions in a markdown to run concurrently,"
+        " e.g., converting mermaid, graphviz, code or table to jpg."
+        "\n"
+        "With more than 1, conversions are queued while rendering and run when the whole markdown is rendered."
+        " The output is the same as converting one by one."
+        "\n"
+        "Default: 1",
+    )
+
+    parser.add_argument(
+        "--warm-mermaid",
+        action="store_true",
+        required=False,
+        default=False,
+        help="R|Render mermaid diagrams in one browser page kept for the whole build,"
+        " instead of starting mmdc, which starts a browser, for every diagram."
+        "\n"
+        "It needs mermaid.js installed with mermaid-cli in global node_modules, and falls back to mmdc if it is not found."
+        " The images may differ slightly from those rendered by mmdc.",
+    )
+
+    parser.add_argument(
+        "--compact-ast",
+        action="store_true",
+        required=False,
+        default=False,
+        help="R|Build the syntax tree of compact nodes instead of dicts,"
+        " to reduce memory when converting very large markdowns."
+        "\n"
+        "The output is the same.",
+    )
+
+    parser.add_argument(
+        "--timings",
+        action="store",
+        nargs="?",
+        const="",
+        required=False,
+        metavar="JSON_PATH",
+        help="R|Record wall time and call count of every stage:"
+        " parse, transform:<pass>, render, convert:<mermaid|graphviz|tex|table|code>, asset:copy, asset:download and push,"
+        " in total and per markdown."
+        "\n"
+        "A summary is printed when done. If <JSON_PATH> is specified, the report is also written to it in json.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store",
+        required=False,
+        metavar="STAGE",
+        help='R|Profile a stage with cProfile, e.g., "render" or "convert", which includes every "convert:*" stage.'
+        "\n"
+        'Stats are written to "md2zhihu-<STAGE>.prof". It implies "--jobs 1" and "--convert-jobs 1".',
+    )
+
     args = parser.parse_args()
 
     if args.md_output is None:
@@ -253,26 +787,47 @@ def main():
     msg("Git dir: ", darkyellow(args.output_dir))
     msg("Gid dir will be pushed to: ", darkyellow(args.repo))
 
-    stat = []
-    for path in args.src_path:
+    timing = args.timings is not None
+
+    profile_hook = None
+    if args.profile is not None:
+        profile_hook = ProfileHook(args.profile)
+        add_stage_hook(profile_hook)
+        args.jobs = 1
+        args.convert_jobs = 1
+
+    parser_config = ParserConfig(True, args.embed, timing=timing, compact_ast=args.compact_ast)
+
+    confs = []
+    for path, platform in [(path, platform) for path in args.src_path for platform in args.platform]:
+        md_output = args.md_output
+        asset_output_dir = args.asset_output_dir
+        if len(args.platform) > 1:
+            md_output = platform_output_path(md_output, platform)
+            asset_output_dir = pjoin(asset_output_dir, platform)
+
         #  TODO Config should accept only two arguments: the path and a args
         conf = Config(
             path,
-            args.platform,
+            platform,
             args.output_dir,
-            args.asset_output_dir,
+            asset_output_dir,
             asset_repo_url=args.repo,
-            md_output_path=args.md_output,
+            md_output_path=md_output,
             code_width=args.code_width,
             keep_meta=args.keep_meta,
             ref_files=args.refs,
             jekyll=args.jekyll,
             rewrite=args.rewrite,
             download=args.download,
+            download_jobs=args.download_jobs,
+            cache_dir=args.cache_dir,
+            asset_link=args.asset_link,
+            timing=timing,
+            convert_jobs=args.convert_jobs,
+            warm_mermaid=args.warm_mermaid,
         )
 
-        parser_config = ParserConfig(True, args.embed)
-
         # Check if file exists
         try:
             fread(conf.src_path)
@@ -280,11 +835,47 @@ def main():
             msg(darkred(sj("Warn: file not found: ", repr(conf.src_path))))
             continue
 
-        convert_md(parser_config, conf)
-
-        msg(sj("Done building ", darkyellow(conf.md_output_path)))
+        confs.append(conf)
 
-        stat.append([path, conf.md_output_path])
+    if args.watch:
+        try:
+            watch_all(parser_config, confs, Manifest(args.output_dir, load=args.incremental), save=args.incremental)
+        except KeyboardInterrupt:
+            msg("Stop watching")
+        return
+
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(args.output_dir)
+
+    report = TimingReport(enabled=timing)
+
+    with report.build.stage("build"):
+        stat, failures = convert_all(parser_config, confs, jobs=args.jobs, manifest=manifest, report=report)
+
+    if manifest is not None:
+        manifest.gc()
+        os.makedirs(args.output_dir, exist_ok=True)
+        manifest.save()
+
+    if timing:
+        for line in report.summary():
+            msg(line)
+        if args.timings != "":
+            report.save(args.timings)
+            msg("Timings are written to: ", darkyellow(args.timings))
+
+    if profile_hook is not None:
+        prof_path = "md2zhihu-{}.prof".format(args.profile.replace(":", "-"))
+        profile_hook.profiler.dump_stats(prof_path)
+        msg("Profile of ", darkyellow(args.profile), " is written to: ", darkyellow(prof_path))
+
+    if len(failures) > 0:
+        for path, _ in failures:
+            msg(darkred(sj("Failed: ", repr(path))))
+        n = len(set([c.src_path for c in confs]))
+        msg(darkred(sj(len(failures), " of ", n, " markdowns failed, nothing is pushed")))
+        sys.exit(1)
 
     if conf.asset_repo.is_local:
         msg("No git repo specified")
@@ -297,6 +888,10 @@ def main():
             " branch: ",
             darkyellow(conf.asset_repo.branch),
         )
-        conf.push(args, stat)
+        with report.build.stage("push"):
+            conf.push(args, stat)
+
+        if timing:
+            msg("Push: ", "{:.3f}".format(report.build.stages["push"][0]), " seconds")
 
     msg(green(sj("Great job!!!")))
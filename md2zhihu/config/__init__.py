@@ -4,18 +4,50 @@ import argparse
 import os
 import re
 import shutil
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Set
 
 from k3color import darkred
 from k3color import darkyellow
 from k3handy import cmdpass
 from k3handy import pjoin
 
+from ..asset import DirSink
+from ..converters.cache import RenderCache
+from ..converters.math import MathTable
+from ..converters.queue import ConvertQueue
+from ..manifest import MANIFEST_FN
 from ..platform import platform_feature_dict
+from ..timing import Timings
+from ..utils import is_in_dir
 from ..utils import msg
 from .asset_reop import AssetRepo
 from .local_repo import LocalRepo
 
+jekyll_fn_regex = re.compile(r"\d\d\d\d-\d\d-\d\d-(.*)")
+
+# Options recorded in the commit message of pushed assets.
+# Runtime state such as caches and timings is left out, its repr changes every run.
+push_conf_keys = (
+    "output_dir",
+    "md_output_path",
+    "platform",
+    "src_path",
+    "root_src_path",
+    "code_width",
+    "keep_meta",
+    "ref_files",
+    "jekyll",
+    "rewrite",
+    "download",
+    "article_name",
+    "asset_output_dir",
+    "rel_dir",
+    "md_output_base",
+)
+
 
 class Config(object):
     #  TODO refactor var names
@@ -33,6 +65,16 @@ class Config(object):
         jekyll=False,
         rewrite=None,
         download=False,
+        download_jobs=8,
+        cache_dir=None,
+        asset_link="copy",
+        timing=False,
+        convert_jobs=1,
+        warm_mermaid=False,
+        asset_sink=None,
+        asset_url_pattern=None,
+        verbose=True,
+        root=None,
     ):
         """
         Config of markdown rendering
@@ -53,6 +95,28 @@ class Config(object):
 
             keep_meta(bool): whether to keep the jekyll meta file header.
 
+            download_jobs(int): max number of remote images to download concurrently, if ``download`` is True.
+
+            cache_dir(str): when present, specifies the dir to cache images generated by external converters.
+
+            asset_link(str): how to place a local image into asset dir: "copy", "hardlink" or "reflink".
+
+            timing(bool): whether to record the time spent in each stage of converting this markdown.
+
+            convert_jobs(int): max number of external conversions, e.g., mermaid or code to jpg, to run concurrently.
+
+            warm_mermaid(bool): render mermaid in a browser page kept for the whole build, instead of starting mmdc for every diagram.
+
+            asset_sink(AssetSink): where to store assets, by default they are written to files in asset_output_dir.
+
+            asset_url_pattern(str): when present, image urls are built with it instead of from asset repo,
+                    e.g., "https://cdn.example.com/{path}", in which path is relative to output_dir.
+
+            verbose(bool): whether to log the paths derived from the arguments.
+
+            root(str): when present, the markdown, refs files and local files it refers to,
+                    i.e., images and embedded markdowns, must be in this dir, otherwise ValueError is raised.
+
         """
 
         self.output_dir = output_dir
@@ -71,17 +135,56 @@ class Config(object):
             ref_files = []
         self.ref_files = ref_files
 
+        self.root = root
+        for p in [src_path, md_output_path] + list(ref_files):
+            if p is not None:
+                self.check_in_root(p)
+
         self.jekyll = jekyll
 
         if rewrite is None:
             rewrite = []
         self.rewrite = rewrite
+        self.rewrite_regexes = [(re.compile(pattern), repl) for pattern, repl in rewrite]
 
         self.download = download
+        self.download_jobs = download_jobs
+
+        self.asset_link = asset_link
+
+        if asset_sink is None:
+            asset_sink = DirSink(asset_link)
+        self.asset_sink = asset_sink
+
+        self.render_cache = None
+        if cache_dir is not None:
+            self.render_cache = RenderCache(cache_dir)
+
+        # Rendered math shared by this markdown and its embedded markdowns
+        self.math_table = MathTable()
+
+        # Images generated in this build, keyed by render key or by url of a downloaded image,
+        # shared by the configs converting the same markdown to different platforms.
+        self.generated: Dict[str, str] = {}
+
+        self.convert_jobs = convert_jobs
+        self.warm_mermaid = warm_mermaid
+
+        # Conversions queued while rendering, set by `Article` if `convert_jobs` is greater than 1
+        self.convert_queue: Optional[ConvertQueue] = None
+
+        # Time spent in each stage of converting this markdown
+        self.timings = Timings(enabled=timing)
+
+        # Paths of assets written when converting this markdown
+        self.assets: Set[str] = set()
+
+        # Paths of files the converted markdown depends on, set by convert_md
+        self.deps: List[str] = []
 
         fn = os.path.split(self.src_path)[-1]
 
-        trim_fn = re.match(r"\d\d\d\d-\d\d-\d\d-(.*)", fn)
+        trim_fn = jekyll_fn_regex.match(fn)
         if trim_fn:
             trim_fn = trim_fn.groups()[0]
         else:
@@ -108,24 +211,48 @@ class Config(object):
         else:
             self.asset_repo = AssetRepo(asset_repo_url)
 
-        for k in (
-            "src_path",
-            "platform",
-            "output_dir",
-            "asset_output_dir",
-            "md_output_base",
-            "md_output_path",
-        ):
-            msg(darkyellow(k), ": ", getattr(self, k))
+        if asset_url_pattern is not None:
+            self.asset_repo.path_pattern = asset_url_pattern
+
+        if verbose:
+            for k in (
+                "src_path",
+                "platform",
+                "output_dir",
+                "asset_output_dir",
+                "md_output_base",
+                "md_output_path",
+            ):
+                msg(darkyellow(k), ": ", getattr(self, k))
+
+    def new_build(self) -> None:
+        """
+        Reset what is recorded by the last build, before converting the markdown again with this config.
+
+        Rendered math and images generated by external converters are kept,
+        thus blocks that are not changed are not converted again.
+        """
+        self.assets = set()
+        self.deps = []
+        self.timings = Timings(enabled=self.timings.enabled)
 
     def img_url(self, fn):
         url = self.asset_repo.path_pattern.format(path=pjoin(self.rel_dir, fn))
 
-        for pattern, repl in self.rewrite:
-            url = re.sub(pattern, repl, url)
+        for regex, repl in self.rewrite_regexes:
+            url = regex.sub(repl, url)
 
         return url
 
+    def asset_path(self, fn: str) -> str:
+        """
+        Return the path to write asset ``fn`` to,
+        and record it as an output of converting this markdown.
+        """
+        p = pjoin(self.asset_output_dir, fn)
+        self.assets.add(p)
+        return p
+
     def relpath_from_cwd(self, p):
         """
         If ``p`` starts with "/", it is path starts from CWD.
@@ -143,8 +270,16 @@ class Config(object):
             abs_path = os.path.abspath(p)
             p = os.path.relpath(abs_path, start=os.getcwd())
 
+        self.check_in_root(p)
         return p
 
+    def check_in_root(self, p: str) -> None:
+        """
+        Raise ValueError if ``root`` is specified and path ``p`` is not in it.
+        """
+        if self.root is not None and not is_in_dir(p, self.root):
+            raise ValueError("path is not in {!r}: {!r}".format(self.root, p))
+
     def push(self, args: argparse.Namespace, src_dst_fns: List[List[str]]) -> None:
         x = dict(cwd=self.output_dir)
 
@@ -152,11 +287,13 @@ class Config(object):
         has_git = os.path.exists(git_path)
 
         args_str = "\n".join([k + ": " + str(v) for (k, v) in args.__dict__.items()])
-        conf_str = "\n".join([k + ": " + str(v) for (k, v) in self.__dict__.items()])
+        conf_str = "\n".join([k + ": " + str(getattr(self, k)) for k in push_conf_keys])
         fns_str = "\n".join([src for (src, dst) in src_dst_fns])
 
         cmdpass("git", "init", **x)
         cmdpass("git", "add", ".", **x)
+        # The build manifest has local absolute paths and is useless in the asset repo
+        cmdpass("git", "rm", "-q", "--cached", "--ignore-unmatch", "--", MANIFEST_FN, **x)
         cmdpass(
             "git",
             "-c",
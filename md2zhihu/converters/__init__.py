@@ -1,6 +1,8 @@
 import os
+from typing import Callable
 from typing import List
 from typing import Optional
+from typing import Set
 
 import k3down2
 
@@ -9,7 +11,14 @@ from ..renderer import MDRender
 from ..renderer import RenderNode
 from ..utils import asset_fn
 from ..utils import escape
-from ..utils import fwrite
+from .browser import mermaid_renderer
+from .cache import RenderCache
+from .cache import render_key
+from .math import MathTable
+from .math import collect_math
+from .math import math_tex_types
+from .queue import ConvertQueue
+from .queue import converter_stages
 
 
 def code_join(n: dict) -> str:
@@ -24,10 +33,60 @@ def to_plaintext(mdrender, rnode):
     return [escape(n["text"])]
 
 
-def typ_text_to_jpg(mdrender: "MDRender", typ: str, txt: str, opt: Optional[dict] = None) -> List[str]:
-    d = k3down2.convert(typ, txt, "jpg", opt=opt)
+def typ_text_to_jpg(
+    mdrender: "MDRender",
+    typ: str,
+    txt: str,
+    opt: Optional[dict] = None,
+    cache: bool = True,
+    render: Optional[Callable[[], bytes]] = None,
+) -> List[str]:
+    """
+    Convert ``txt`` of type ``typ`` to a jpg in asset sink and return the image tag.
+
+    If a render cache is configured and ``cache`` is True, the external
+    converter is skipped when the same conversion has been done before.
+    If ``cache`` is True, an image generated for another platform of the same
+    markdown in this build is copied instead of being generated again.
+
+    If ``conf.convert_queue`` is set, the conversion is queued and the image is
+    written when the queue runs, after the whole markdown is rendered.
+
+    ``render`` produces the jpg data, by default it calls ``k3down2.convert``.
+    """
+    conf = mdrender.conf
     fn = asset_fn(txt, "jpg")
-    fwrite(mdrender.conf.asset_output_dir, fn, d)
+    target = conf.asset_path(fn)
+
+    key = render_key(typ, txt, "jpg", opt) if cache else None
+    generated = conf.generated.get(key) if key is not None else None
+
+    rc = conf.render_cache
+    rkey = rc.key(typ, txt, "jpg", opt) if cache and rc is not None else None
+
+    sink = conf.asset_sink
+
+    def save(d):
+        if rkey is not None:
+            rc.put(rkey, "jpg", d)
+        sink.write(target, d)
+
+    if generated is not None and sink.exists(generated):
+        if generated != target:
+            with conf.timings.stage("asset:copy"):
+                sink.copy(generated, target)
+    elif rkey is not None and rc.has(rkey, "jpg"):
+        sink.place(rc.path(rkey, "jpg"), target)
+    elif conf.convert_queue is not None:
+        conf.convert_queue.add(typ, txt, opt, render, save, key=key)
+    elif render is not None:
+        save(render())
+    else:
+        with conf.timings.stage("convert:" + converter_stages.get(typ, typ)):
+            save(k3down2.convert(typ, txt, "jpg", opt=opt))
+
+    if key is not None:
+        conf.generated[key] = target
 
     return [r"![]({})".format(mdrender.conf.img_url(fn)), ""]
 
@@ -50,6 +109,19 @@ def block_code_to_fixwidth_jpg(mdrender: "MDRender", rnode: "RenderNode") -> Lis
 
 def block_code_mermaid_to_jpg(mdrender: "MDRender", rnode: "RenderNode") -> List[str]:
     n = rnode.node
+
+    if mdrender.conf.warm_mermaid:
+        renderer = mermaid_renderer()
+        if renderer is not None:
+            return typ_text_to_jpg(
+                mdrender,
+                "mermaid",
+                n["text"],
+                # Not passed to k3down2, but keeps images rendered differently apart in render cache
+                opt={"renderer": "warm"},
+                render=lambda: renderer.to_jpg(n["text"]),
+            )
+
     return typ_text_to_jpg(mdrender, "mermaid", n["text"])
 
 
@@ -60,12 +132,12 @@ def block_code_graphviz_to_jpg(mdrender: "MDRender", rnode: "RenderNode") -> Lis
 
 def math_block_to_imgtag(mdrender: "MDRender", rnode: "RenderNode") -> List[str]:
     n = rnode.node
-    return [k3down2.convert("tex_block", n["text"], "imgtag")]
+    return [mdrender.conf.math_table.get("tex_block", n["text"], "imgtag")]
 
 
 def math_inline_to_imgtag(mdrender: "MDRender", rnode: "RenderNode") -> List[str]:
     n = rnode.node
-    return [k3down2.convert("tex_inline", n["text"], "imgtag")]
+    return [mdrender.conf.math_table.get("tex_inline", n["text"], "imgtag")]
 
 
 def math_block_join_dolar_when_nested(mdrender, rnode):
@@ -89,27 +161,80 @@ def math_inline_single_dolar(mdrender, rnode):
 
 def math_block_to_jpg(mdrender, rnode):
     n = rnode.node
-    return typ_text_to_jpg(mdrender, "tex_block", n["text"])
+    return typ_text_to_jpg(
+        mdrender,
+        "tex_block",
+        n["text"],
+        render=lambda: mdrender.conf.math_table.get("tex_block", n["text"], "jpg"),
+    )
 
 
 def math_inline_to_jpg(mdrender, rnode):
     n = rnode.node
-    return typ_text_to_jpg(mdrender, "tex_inline", n["text"])
+    return typ_text_to_jpg(
+        mdrender,
+        "tex_inline",
+        n["text"],
+        render=lambda: mdrender.conf.math_table.get("tex_inline", n["text"], "jpg"),
+    )
 
 
 def math_inline_to_plaintext(mdrender, rnode):
     n = rnode.node
-    return [escape(k3down2.convert("tex_inline", n["text"], "plain"))]
+    return [escape(mdrender.conf.math_table.get("tex_inline", n["text"], "plain"))]
+
+
+# The output type of k3down2 a math handler renders a formula to.
+math_outputs = {
+    math_block_to_imgtag: "imgtag",
+    math_inline_to_imgtag: "imgtag",
+    math_block_to_jpg: "jpg",
+    math_inline_to_jpg: "jpg",
+    math_inline_to_plaintext: "plain",
+}
+
+
+def prerender_math(mdrender: "MDRender", nodes) -> None:
+    """
+    Render all distinct math in ``nodes`` in one batch into ``conf.math_table``,
+    so that math handlers only need to look up the table when rendering.
+
+    Only math handled by a platform feature in ``math_outputs`` is rendered.
+    A jpg that is already in render cache is skipped.
+    """
+
+    conf = mdrender.conf
+    rc = conf.render_cache
+
+    keys = []
+    for typ, tex in collect_math(nodes, set()):
+        handler = mdrender.features.get(typ)
+        if not callable(handler):
+            continue
+
+        out = math_outputs.get(handler)
+        if out is None:
+            continue
+
+        tex_typ = math_tex_types[typ]
+        if out == "jpg" and rc is not None and rc.has(rc.key(tex_typ, tex, "jpg"), "jpg"):
+            continue
+
+        keys.append((tex_typ, tex, out))
+
+    if len(keys) > 0:
+        with conf.timings.stage("convert:tex"):
+            conf.math_table.render_all(keys)
 
 
 def table_to_barehtml(mdrender, rnode) -> List[str]:
     # create a markdown render to recursively deal with images etc.
     mdr = MDRender(mdrender.conf, features=importer_features)
 
-    md = mdr.render_node(rnode)
-    md = "\n".join(md)
+    md = "\n".join(mdr.render_node(rnode))
 
-    table_html = k3down2.convert("table", md, "html")
+    with mdrender.conf.timings.stage("convert:table"):
+        table_html = k3down2.convert("table", md, "html")
     table_html = table_html.split("\n") + [""]
     return table_html
 
@@ -131,9 +256,25 @@ def table_to_jpg(mdrender, rnode):
                 "asset_base": os.path.abspath(md_base_path),
             }
         },
+        # The content of images in a table is not part of the cache key.
+        cache="![" not in md,
     )
 
 
+# Feature handlers that convert a node to one jpg, the images in the node are
+# rendered into the jpg instead of being handled by the platform.
+image_embedding_handlers = {
+    table_to_jpg,
+}
+
+
+def image_embedding_types(features: dict) -> Set[str]:
+    """
+    Return the node types whose images are rendered into a jpg by ``features``.
+    """
+    return set([typ for typ, handler in features.items() if callable(handler) and handler in image_embedding_handlers])
+
+
 # Importer is only used to copy local image to output dir and update image urls.
 # This is used to deal with partial renderers, e.g., table_to_barehtml,
 # which is not handled by universal image importer, but need to import the image when rendering a table with images.
@@ -0,0 +1,239 @@
+"""
+A warm browser renderer kept for a whole build.
+
+A mermaid diagram is converted by ``mmdc``, which starts a browser for every
+diagram. ``MermaidRenderer`` instead keeps a page with mermaid.js loaded in a
+browser it starts once, and renders every diagram in this page.
+
+The browser is owned by the renderer, not shared with k3down2: playwright
+allows only one sync instance per thread and k3down2 may have started one in
+the calling thread, thus the renderer starts and drives its browser in a
+dedicated thread.
+"""
+
+import atexit
+import os
+import queue
+import subprocess
+import threading
+from concurrent.futures import Future
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Optional
+
+import k3down2
+
+from ..utils import msg
+
+# The same config as k3down2 renders mermaid with mmdc.
+mermaid_config = {
+    "startOnLoad": False,
+    "theme": "default",
+    "look": "classic",
+    "fontSize": 14,
+}
+
+# Paths of mermaid.js relative to a node_modules dir
+mermaid_js_paths = [
+    "mermaid/dist/mermaid.min.js",
+    "@mermaid-js/mermaid-cli/node_modules/mermaid/dist/mermaid.min.js",
+]
+
+_lock = threading.Lock()
+_renderers: List[Optional["MermaidRenderer"]] = []
+
+
+def find_mermaid_js(node_modules_dirs: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Find mermaid.js installed with mermaid-cli, in global node_modules by default.
+
+    :return: path to mermaid.js or None if it is not found.
+    """
+    if node_modules_dirs is None:
+        node_modules_dirs = []
+        try:
+            out = subprocess.run(["npm", "root", "-g"], capture_output=True, text=True, check=True).stdout
+            node_modules_dirs.append(out.strip())
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    for d in node_modules_dirs:
+        for p in mermaid_js_paths:
+            path = os.path.join(d, p)
+            if os.path.isfile(path):
+                return path
+
+    return None
+
+
+class MermaidRenderer(object):
+    """
+    Render mermaid diagrams in a page that is kept open, with mermaid.js loaded once.
+
+    The page is checked before every diagram and reloaded if it is closed,
+    the browser is restarted if it crashed or is disconnected.
+    It may be used from any thread, diagrams are rendered one at a time.
+    """
+
+    def __init__(self, mermaid_js: str) -> None:
+        self.mermaid_js = mermaid_js
+
+        # playwright objects, only accessed in ``thread``
+        self.playwright: Any = None
+        self.browser: Any = None
+        self.page: Any = None
+
+        self.count = 0
+
+        # A daemon thread, not a ThreadPoolExecutor, so that it still runs when ``close()`` is called at exit.
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.calls: queue.Queue = queue.Queue()
+
+    def to_svg(self, mmd: str) -> str:
+        """
+        Render a mermaid diagram to svg.
+        If it fails, e.g., the browser crashed, the page is restarted and the diagram is rendered once more.
+        """
+        return self._call(self._to_svg, mmd)
+
+    def to_jpg(self, mmd: str) -> bytes:
+        svg = self.to_svg(mmd)
+        return k3down2.convert("svg", svg, "jpg")
+
+    def close(self) -> None:
+        """
+        Close the page and the browser and stop the thread.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+
+            fut: Future = Future()
+            self.calls.put((fut, self._stop, ()))
+            self.calls.put(None)
+            thread.join()
+            fut.result()
+
+    def _call(self, f: Callable, *args) -> Any:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="md2zhihu-mermaid", daemon=True)
+                self.thread.start()
+
+            fut: Future = Future()
+            self.calls.put((fut, f, args))
+
+        return fut.result()
+
+    def _loop(self) -> None:
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+
+            fut, f, args = call
+            try:
+                fut.set_result(f(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+
+    def _to_svg(self, mmd: str) -> str:
+        if not self._healthy():
+            self._start()
+
+        try:
+            return self._render(mmd)
+        except Exception:
+            self._start()
+            return self._render(mmd)
+
+    def _healthy(self) -> bool:
+        if self.page is None or self.page.is_closed():
+            return False
+        try:
+            return self.page.evaluate("typeof mermaid") == "object"
+        except Exception:
+            return False
+
+    def _start(self) -> None:
+        self._close_page()
+
+        if self.browser is not None and not self.browser.is_connected():
+            msg("Browser for mermaid disconnected, restart it")
+            self._close_browser()
+
+        if self.playwright is None:
+            from playwright.sync_api import sync_playwright
+
+            self.playwright = sync_playwright().start()
+
+        if self.browser is None:
+            self.browser = self.playwright.chromium.launch()
+
+        self.page = self.browser.new_page()
+        self.page.add_script_tag(path=self.mermaid_js)
+        self.page.evaluate("cfg => mermaid.initialize(cfg)", mermaid_config)
+
+    def _render(self, mmd: str) -> str:
+        self.count += 1
+        return self.page.evaluate(
+            "async ([id, src]) => (await mermaid.render(id, src)).svg",
+            ["mermaid-{}".format(self.count), mmd],
+        )
+
+    def _close_page(self) -> None:
+        page, self.page = self.page, None
+        if page is None:
+            return
+        try:
+            page.close()
+        except Exception:
+            pass
+
+    def _close_browser(self) -> None:
+        browser, self.browser = self.browser, None
+        if browser is None:
+            return
+        try:
+            browser.close()
+        except Exception:
+            pass
+
+    def _stop(self) -> None:
+        self._close_page()
+        self._close_browser()
+
+        pw, self.playwright = self.playwright, None
+        if pw is not None:
+            pw.stop()
+
+
+def mermaid_renderer() -> Optional[MermaidRenderer]:
+    """
+    Return the warm mermaid renderer shared by the process,
+    or None if mermaid.js or playwright is not available.
+    """
+    with _lock:
+        if len(_renderers) > 0:
+            return _renderers[0]
+
+        _renderers.append(None)
+
+        try:
+            import playwright.sync_api  # noqa: F401
+        except ImportError:
+            msg("playwright is not installed, use mmdc")
+            return None
+
+        path = find_mermaid_js()
+        if path is None:
+            msg("mermaid.js is not found, use mmdc")
+            return None
+
+        renderer = MermaidRenderer(path)
+        atexit.register(renderer.close)
+        _renderers[0] = renderer
+        return renderer
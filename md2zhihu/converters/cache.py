@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import k3down2
+
+from ..utils import fwrite_atomic
+
+
+def render_key(typ: str, txt: str, suffix: str, opt: Optional[dict] = None, version: str = "") -> str:
+    """
+    Digest of a conversion by ``k3down2``: the same key always produces the same image.
+    """
+    k = json.dumps([typ, txt, suffix, opt, version], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(k.encode("utf-8")).hexdigest()
+
+
+class RenderCache(object):
+    """
+    A persistent content-addressed cache of images generated by ``k3down2``.
+
+    An entry is keyed by the converter type, the input text, the converter
+    options and the version of ``k3down2``, so that a changed option or an
+    upgraded converter never hits a stale image.
+
+    Entries are stored in ``<cache_dir>/<key[:2]>/<key>.<suffix>``.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self.version = getattr(k3down2, "__version__", "")
+
+    def key(self, typ: str, txt: str, suffix: str, opt: Optional[dict] = None) -> str:
+        return render_key(typ, txt, suffix, opt, self.version)
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + "." + suffix)
+
+    def has(self, key: str, suffix: str) -> bool:
+        return os.path.exists(self.path(key, suffix))
+
+    def put(self, key: str, suffix: str, data: bytes) -> None:
+        """
+        Store an image into cache.
+
+        The image is written to a temp file then renamed, so that concurrent
+        builders sharing a cache dir never see a partially written entry.
+        An entry is created with umask permissions, thus the cache dir can be shared with other users.
+        """
+        p = self.path(key, suffix)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        fwrite_atomic(p, data)
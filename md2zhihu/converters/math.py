@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import Iterable
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+import k3down2
+
+from ..types import ASTNodes
+
+# ast node type to k3down2 input type
+math_tex_types = {
+    "math_block": "tex_block",
+    "math_inline": "tex_inline",
+}
+
+MathKey = Tuple[str, str, str]
+
+
+class MathTable(object):
+    """
+    In-memory table of rendered math, keyed by ``(tex_type, tex, output_type)``.
+
+    A formula is rendered only once no matter how many times it appears.
+    ``render_all()`` renders a batch of formulas in one go so that the
+    renderer only has to look up this table.
+    """
+
+    def __init__(self, jobs: int = 8) -> None:
+        self.jobs = jobs
+        self.rendered: Dict[MathKey, Union[str, bytes]] = {}
+
+    def get(self, typ: str, tex: str, out: str) -> Union[str, bytes]:
+        key = (typ, tex, out)
+        if key not in self.rendered:
+            self.rendered[key] = k3down2.convert(typ, tex, out)
+        return self.rendered[key]
+
+    def render_all(self, keys: Iterable[MathKey]) -> None:
+        """
+        Render every formula in ``keys`` that is not yet rendered.
+
+        Rendering a jpg downloads a svg then converts it to jpg in a browser.
+        The downloads run concurrently in a thread pool.
+        The browser conversions run in the calling thread, because the
+        browser can only be driven from the thread that started it.
+        """
+
+        todo = sorted(set(keys) - set(self.rendered.keys()))
+        jpgs = [k for k in todo if k[2] == "jpg"]
+
+        for key in todo:
+            if key[2] != "jpg":
+                self.get(*key)
+
+        if len(jpgs) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            svgs = executor.map(lambda k: k3down2.convert(k[0], k[1], "svg"), jpgs)
+
+            for key, svg in zip(jpgs, svgs):
+                self.rendered[key] = k3down2.convert("svg", svg, "jpg")
+
+
+def collect_math(nodes: ASTNodes, rst: Set[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """
+    Collect ``(node_type, tex)`` of every math node in ast.
+    """
+    for n in nodes:
+        if n["type"] in math_tex_types:
+            rst.add((n["type"], n["text"]))
+
+        if "children" in n:
+            collect_math(n["children"], rst)
+
+    return rst
@@ -0,0 +1,178 @@
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import k3down2
+
+from ..timing import stage_hooks
+
+# k3down2 input type to the name of converter stage in timings
+converter_stages = {
+    "md": "table",
+    "tex_block": "tex",
+    "tex_inline": "tex",
+}
+
+# Max number of concurrent conversions of a k3down2 input type.
+# mermaid-cli starts a browser for every diagram, thus it has a lower limit.
+convert_limits = {
+    "mermaid": 2,
+}
+
+# The type k3down2 converts an input type to, before rendering it to jpg in a browser,
+# e.g., mermaid is converted to svg by mmdc, then the svg is rendered to jpg.
+# "jpg" means it is converted to jpg without a browser, e.g., graphviz by dot.
+# A type not listed is converted to jpg in one step in the calling thread.
+intermediate_types = {
+    "mermaid": "svg",
+    "tex_block": "svg",
+    "tex_inline": "svg",
+    "code": "html",
+    "md": "html",
+    "table": "html",
+    "graphviz": "jpg",
+}
+
+
+class ConvertJob(object):
+    __slots__ = ("typ", "txt", "opt", "render", "save", "data", "seconds")
+
+    def __init__(
+        self,
+        typ: str,
+        txt: str,
+        opt: Optional[dict],
+        render: Optional[Callable[[], bytes]],
+        save: Callable[[bytes], None],
+    ) -> None:
+        self.typ = typ
+        self.txt = txt
+        self.opt = opt
+        self.render = render
+        self.save = save
+
+        # Result of the first step of conversion: svg or html in str, or jpg in bytes
+        self.data: Any = None
+
+        # Time spent in converting
+        self.seconds = 0.0
+
+
+class ConvertQueue(object):
+    """
+    Conversions to jpg queued while rendering a markdown, run in one batch when rendering is done.
+
+    The image tag of a conversion does not depend on the image data, thus the
+    renderer outputs the tag at once and only producing the image is deferred.
+
+    A conversion goes through an intermediate type, e.g., mermaid -> svg -> jpg
+    or code -> html -> jpg. The first step runs an external tool such as mmdc,
+    dot or pandoc, these run concurrently in a thread pool, at most
+    ``convert_limits[typ]`` of a type at a time. The last step renders in a
+    browser, which can only be driven from the thread that started it, thus it
+    runs in the calling thread, the same as ``MathTable.render_all()``.
+
+    Images are saved in the order they are queued, the result is the same as converting one by one.
+    """
+
+    def __init__(self, jobs: int = 4, limits: Optional[Dict[str, int]] = None) -> None:
+        self.jobs = jobs
+        self.limits = convert_limits if limits is None else limits
+
+        self.queued: List[ConvertJob] = []
+
+        # Render keys of queued conversions, a conversion is queued only once
+        self.keys: Set[str] = set()
+
+    def add(
+        self,
+        typ: str,
+        txt: str,
+        opt: Optional[dict],
+        render: Optional[Callable[[], bytes]],
+        save: Callable[[bytes], None],
+        key: Optional[str] = None,
+    ) -> None:
+        """
+        Queue a conversion of ``txt`` of type ``typ`` to jpg.
+        The jpg data is passed to ``save`` when it is done.
+
+        ``render`` produces the jpg data, by default it is converted by ``k3down2.convert``.
+        ``key`` is the render key of the conversion, a conversion with the same key is queued only once.
+        """
+        if key is not None:
+            if key in self.keys:
+                return
+            self.keys.add(key)
+
+        self.queued.append(ConvertJob(typ, txt, opt, render, save))
+
+    def run(self, timings=None) -> None:
+        """
+        Run queued conversions and save the results.
+        Time spent is recorded in ``timings`` as ``"convert:<type>"``.
+        """
+
+        jobs, self.queued, self.keys = self.queued, [], set()
+        if len(jobs) == 0:
+            return
+
+        semaphores = {}
+        for job in jobs:
+            if job.typ not in semaphores:
+                semaphores[job.typ] = threading.Semaphore(min(self.limits.get(job.typ, self.jobs), self.jobs))
+
+        def first_step(job):
+            with semaphores[job.typ]:
+                t0 = time.perf_counter()
+                job.data = k3down2.convert(job.typ, job.txt, intermediate_type(job.typ), opt=job.opt)
+                job.seconds += time.perf_counter() - t0
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures: List[Optional[Future]] = []
+            for job in jobs:
+                if job.render is None and intermediate_type(job.typ) is not None:
+                    futures.append(executor.submit(first_step, job))
+                else:
+                    futures.append(None)
+
+            for job, fut in zip(jobs, futures):
+                stage = "convert:" + converter_stages.get(job.typ, job.typ)
+
+                # Hooks run in this thread only: the first step in pool threads is not profiled, but waited for.
+                with stage_hooks(stage):
+                    if fut is not None:
+                        fut.result()
+
+                    t0 = time.perf_counter()
+                    if job.render is not None:
+                        d = job.render()
+                    elif fut is None:
+                        d = k3down2.convert(job.typ, job.txt, "jpg", opt=job.opt)
+                    elif intermediate_type(job.typ) == "jpg":
+                        d = job.data
+                    else:
+                        d = k3down2.convert(intermediate_type(job.typ), job.data, "jpg", opt=job.opt)
+                    job.seconds += time.perf_counter() - t0
+
+                job.save(d)
+
+                if timings is not None and job.render is None:
+                    timings.add(stage, job.seconds)
+
+
+def intermediate_type(typ: str) -> Optional[str]:
+    """
+    Return the type that ``typ`` is converted to before being rendered to jpg in a browser,
+    or "jpg" if it is converted to jpg without a browser, e.g., graphviz by dot.
+
+    It returns None if ``typ`` is converted to jpg in one step in the calling thread.
+    """
+    return intermediate_types.get(typ)
@@ -0,0 +1,167 @@
+"""Build manifest for incremental conversion"""
+
+import hashlib
+import json
+import os
+from typing import Dict
+from typing import Optional
+
+import k3down2
+from k3handy import pjoin
+
+from ..asset import file_md5
+from ..utils import msg
+
+MANIFEST_FN = ".md2zhihu-manifest.json"
+
+
+def file_digest(path: str) -> Optional[str]:
+    """
+    Return md5 of the content of file ``path``, or None if it is not a regular file.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    return file_md5(path)
+
+
+def config_digest(parser_config, conf) -> str:
+    """
+    Digest of the options that affect the output of converting a markdown.
+    """
+    opts = dict(
+        platform=conf.platform,
+        output_dir=conf.output_dir,
+        asset_output_dir=conf.asset_output_dir,
+        md_output_path=conf.md_output_path,
+        path_pattern=conf.asset_repo.path_pattern,
+        code_width=conf.code_width,
+        keep_meta=conf.keep_meta,
+        jekyll=conf.jekyll,
+        rewrite=conf.rewrite,
+        download=conf.download,
+        warm_mermaid=conf.warm_mermaid,
+        ref_files=conf.ref_files,
+        populate_reference=parser_config.populate_reference,
+        embed_patterns=parser_config.embed_patterns,
+        # Images may be rendered differently by another k3down2
+        k3down2=getattr(k3down2, "__version__", None),
+    )
+    s = json.dumps(opts, sort_keys=True, default=str)
+    return hashlib.md5(s.encode("utf-8")).hexdigest()
+
+
+class Manifest(object):
+    """
+    Manifest records what an output markdown is built from and what is built,
+    in a json file in the output dir, which is not pushed to the asset repo. Paths are absolute:
+
+        {
+            "articles": {
+                "<md_output_path>": {
+                    "src_path": "<path>",
+                    "config": "<config_digest>",
+                    "deps": {"<path>": "<md5>", ...},
+                    "md_output_path": "<path>",
+                    "assets": ["<path>", ...]
+                }
+            }
+        }
+
+    An entry is keyed by the output path, because a markdown converted to
+    several platforms has one output per platform.
+
+    A markdown does not need to be converted again if its config and all of
+    its dependencies stay the same and its outputs are still there.
+    """
+
+    version = 2
+
+    def __init__(self, output_dir: str, load: bool = True) -> None:
+        """
+        If ``load`` is False, the manifest stored in ``output_dir`` is not loaded and it starts empty.
+        """
+        self.path = pjoin(output_dir, MANIFEST_FN)
+        self.articles: Dict[str, dict] = {}
+
+        if load and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+
+            if data.get("version") == self.version:
+                self.articles = data["articles"]
+
+    def is_up_to_date(self, parser_config, conf) -> bool:
+        entry = self.articles.get(os.path.abspath(conf.md_output_path))
+        if entry is None:
+            return False
+
+        if entry["config"] != config_digest(parser_config, conf):
+            return False
+
+        for path, digest in entry["deps"].items():
+            if file_digest(path) != digest:
+                return False
+
+        for path in [entry["md_output_path"]] + entry["assets"]:
+            if not os.path.exists(path):
+                return False
+
+        return True
+
+    def update(self, parser_config, conf) -> None:
+        """
+        Record a markdown that is just built with ``conf``,
+        and remove assets that are output by the previous build but not by this one.
+        """
+        md_output_path = os.path.abspath(conf.md_output_path)
+        prev = self.articles.get(md_output_path)
+
+        self.articles[md_output_path] = dict(
+            src_path=os.path.abspath(conf.src_path),
+            config=config_digest(parser_config, conf),
+            deps={os.path.abspath(p): file_digest(p) for p in conf.deps},
+            md_output_path=md_output_path,
+            assets=sorted([os.path.abspath(p) for p in conf.assets]),
+        )
+
+        if prev is not None:
+            self._remove_unused(prev["assets"])
+
+    def discard(self, conf) -> None:
+        """
+        Forget the output of ``conf``, so that it is not up to date, e.g., a dependency changed while building it.
+        Its outputs are kept.
+        """
+        self.articles.pop(os.path.abspath(conf.md_output_path), None)
+
+    def gc(self) -> None:
+        """
+        Remove outputs of markdowns whose source file no longer exists.
+        """
+        for key, entry in list(self.articles.items()):
+            if os.path.exists(entry["src_path"]):
+                continue
+
+            del self.articles[key]
+            msg("Remove outputs of deleted markdown: ", entry["src_path"])
+            self._remove_unused([entry["md_output_path"]] + entry["assets"])
+
+    def save(self) -> None:
+        data = dict(version=self.version, articles=self.articles)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _remove_unused(self, paths) -> None:
+        used = set()
+        for entry in self.articles.values():
+            used.add(entry["md_output_path"])
+            used.update(entry["assets"])
+
+        for p in paths:
+            if p in used:
+                continue
+            if os.path.exists(p):
+                os.remove(p)
@@ -1,16 +1,27 @@
 """Parser classes for md2zhihu"""
 
 from .article import Article
+from .article import EmbedPass
+from .article import ParseCache
+from .article import ParsedMarkdown
 from .article import ParserConfig
 from .extract.front_matter import FrontMatter
 from .extract.front_matter import extract_front_matter
 from .extract.refs import extract_ref_definitions
 from .extract.refs import load_external_refs
 from .mistune_parser import new_parser
+from .node import Node
+from .node import copy_ast
 from .output import render_ref_list
+from .transform.math import JoinMathPass
+from .transform.math import ParseMathPass
 from .transform.math import join_math_block
 from .transform.math import parse_math
+from .transform.pipeline import Pass
+from .transform.pipeline import Pipeline
 from .transform.rebase import rebase_url
 from .transform.rebase import rebase_url_in_ast
+from .transform.refs import ReplaceRefPass
 from .transform.refs import replace_ref_with_def
+from .transform.table import InListTablePass
 from .transform.table import parse_in_list_tables
@@ -1,26 +1,39 @@
 import os
 import re
+import time
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 from k3fs import fread
 
+from ..asset import prefetch_remote_images
 from ..config import Config
+from ..converters import image_embedding_types
+from ..converters import prerender_math
+from ..converters.queue import ConvertQueue
 from ..renderer import MDRender
 from ..renderer import RenderNode
+from ..timing import stage_hooks
 from ..utils import add_paragraph_end
+from ..utils import http_url_regex
 from .extract.front_matter import FrontMatter
 from .extract.front_matter import extract_front_matter
 from .extract.refs import extract_ref_definitions
 from .extract.refs import load_external_refs
 from .mistune_parser import new_parser
+from .node import copy_ast
 from .output import render_ref_list
-from .transform.math import join_math_block
-from .transform.math import parse_math
+from .transform.math import JoinMathPass
+from .transform.math import ParseMathPass
+from .transform.pipeline import Pass
+from .transform.pipeline import Pipeline
 from .transform.rebase import rebase_url
 from .transform.rebase import rebase_url_in_ast
-from .transform.refs import replace_ref_with_def
-from .transform.table import parse_in_list_tables
+from .transform.refs import ReplaceRefPass
+from .transform.table import InListTablePass
 
 
 class ParserConfig(object):
@@ -30,26 +43,141 @@ class ParserConfig(object):
     `populate_reference`: whether to replace reference with definition.
 
     `embed_patterns`: the url regex patterns to replace the content of url in ![](url).
+
+    `timing`: whether to record the time spent in parsing and in each transform pass.
+
+    `compact_ast`: whether to build the ast of compact `Node` instead of `dict`, to save memory on large markdown.
     """
 
-    def __init__(self, populate_reference: bool, embed_patterns: List[str]):
+    def __init__(
+        self,
+        populate_reference: bool,
+        embed_patterns: List[str],
+        timing: bool = False,
+        compact_ast: bool = False,
+    ):
         self.populate_reference = populate_reference
         self.embed_patterns = embed_patterns
+        self.timing = timing
+        self.compact_ast = compact_ast
+
+        # Parsed embedded markdowns shared by every article in a build
+        self.parse_cache = ParseCache()
+
+        # Compile all embed patterns into one alternation.
+        self.embed_regexes: List[re.Pattern] = []
+        if len(embed_patterns) > 0:
+            try:
+                self.embed_regexes = [re.compile("|".join(["(?:" + p + ")" for p in embed_patterns]))]
+            except re.error:
+                # A pattern with global flags such as "(?i)" can not be put in a group
+                self.embed_regexes = [re.compile(p) for p in embed_patterns]
+
+    def is_embed(self, url: str) -> bool:
+        """
+        Whether the content of ``url`` in ``![](url)`` should be embedded.
+        """
+        for regex in self.embed_regexes:
+            if regex.search(url):
+                return True
+        return False
+
+
+class EmbedPass(Pass):
+    """
+    Replace a paragraph of a single ``![](url)`` with the markdown at url, if url matches `--embed`.
+    Local images are recorded as dependencies of the article.
+    """
+
+    name = "embed"
+    leave_types = ("image", "paragraph")
+
+    def __init__(self, article: "Article") -> None:
+        super().__init__()
+        self.article = article
+        self.used_refs: Dict[str, str] = {}
+
+    def leave(self, n):
+        return self.article.embed_node(n, self.used_refs)
+
+
+class ParsedMarkdown(object):
+    """
+    The platform independent result of parsing a markdown:
+    the front matter, the reference definitions and the ast before transforms.
+
+    A markdown is parsed once and rendered to every platform from it.
+    """
+
+    def __init__(self, parser_config: ParserConfig, md_text: str):
+        # Markdown text without front matter and reference definitions
+        self.md_text, self.front_matter = extract_front_matter(md_text)
+        self.md_text, self.refs = extract_ref_definitions(self.md_text)
+
+        with stage_hooks("parse"):
+            t0 = time.perf_counter()
+            parse_to_ast = new_parser(parser_config.compact_ast)
+            self.ast = parse_to_ast(self.md_text)
+            self.parse_time = time.perf_counter() - t0
+
+
+class ParseCache(object):
+    """
+    Cache of parsed markdowns, one entry per path, replaced when the mtime or size of the file changes.
+
+    A markdown embedded many times, e.g., a footer included by every article,
+    is read and parsed only once in a build.
+    An article built from a cached ``ParsedMarkdown`` transforms its own copy of the ast.
+    """
+
+    def __init__(self) -> None:
+        # abspath -> (mtime_ns, size, parsed)
+        self.parsed: Dict[str, Tuple[int, int, ParsedMarkdown]] = {}
+
+    def get(self, parser_config: ParserConfig, path: str) -> ParsedMarkdown:
+        st = os.stat(path)
+        key = os.path.abspath(path)
+
+        cached = self.parsed.get(key)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        parsed = ParsedMarkdown(parser_config, fread(path))
+        self.parsed[key] = (st.st_mtime_ns, st.st_size, parsed)
+
+        return parsed
 
 
 class Article(object):
-    def __init__(self, parser_config: ParserConfig, conf: Config, md_text: str):
+    def __init__(
+        self,
+        parser_config: ParserConfig,
+        conf: Config,
+        md_text: str,
+        parsed: Optional[ParsedMarkdown] = None,
+        embedded_by: Tuple[str, ...] = (),
+    ):
+        """
+        ``parsed`` is the parse result of ``md_text`` shared with other articles,
+        i.e., of other platforms or embedding the same markdown.
+        Its ast is copied before being transformed for ``conf.platform``.
+
+        ``embedded_by`` is the absolute paths of the articles that embed this one, outermost first.
+        """
         self.parser_config = parser_config
 
         self.conf = conf
 
+        # Absolute paths of the articles embedding this one and of this one, to detect embed cycles
+        self.embed_path: Tuple[str, ...] = embedded_by + (os.path.abspath(conf.src_path),)
+
         # init
 
         # Input markdown in str
         self.md_text: str = md_text
 
         # References defined in this markdown
-        self.refs = {}
+        self.refs: Dict[str, str] = {}
 
         # References used in this markdown
         self.used_refs = None
@@ -59,105 +187,132 @@ class Article(object):
         # Parsed AST of the markdown
         self.ast = None
 
-        # extract article meta
+        # Seconds spent in parsing and in each transform pass, if `parser_config.timing` is enabled.
+        # Parsing is not included if the article is built from a shared `parsed`.
+        self.timings: Dict[str, float] = {}
+
+        # Paths of files this markdown depends on:
+        # the markdown itself, refs files, embedded markdowns and local images.
+        self.deps: List[str] = [self.conf.src_path] + list(self.conf.ref_files)
 
-        self.md_text, self.front_matter = extract_front_matter(self.md_text)
-        self.md_text, article_refs = extract_ref_definitions(self.md_text)
+        # extract article meta and parse to ast
+
+        if parsed is None:
+            parsed = ParsedMarkdown(self.parser_config, self.md_text)
+            self.ast = parsed.ast
+            if self.parser_config.timing:
+                self.timings["parse"] = parsed.parse_time
+        else:
+            self.ast = copy_ast(parsed.ast)
+
+        self.md_text = parsed.md_text
+        self.front_matter = parsed.front_matter
 
         # build refs
 
         self.refs.update(load_external_refs(self.conf))
         if self.front_matter is not None:
             self.refs.update(self.front_matter.get_refs(conf.platform))
-        self.refs.update(article_refs)
-
-        # parse to ast and clean up
+        self.refs.update(parsed.refs)
 
-        parse_to_ast = new_parser()
-        self.ast = parse_to_ast(self.md_text)
+        # clean up
 
-        self.ast = parse_in_list_tables(self.ast)
+        refs_pass = ReplaceRefPass(self.refs, self.parser_config.populate_reference)
+        embed_pass = EmbedPass(self)
 
-        self.used_refs = replace_ref_with_def(self.ast, self.refs, self.parser_config.populate_reference)
+        pipeline = Pipeline(
+            [
+                InListTablePass(compact=self.parser_config.compact_ast),
+                refs_pass,
+                # extract already inlined math
+                ParseMathPass(),
+                # join cross paragraph math
+                JoinMathPass(),
+                ParseMathPass(name="parse_joined_math"),
+                embed_pass,
+            ],
+            timing=self.parser_config.timing,
+        )
+        self.ast = pipeline.run(self.ast)
 
-        # extract already inlined math
-        self.ast = parse_math(self.ast)
+        if self.parser_config.timing:
+            self.timings.update(pipeline.timings)
 
-        # join cross paragraph math
-        join_math_block(self.ast)
-        self.ast = parse_math(self.ast)
+        self.used_refs = refs_pass.used_defs
+        self.used_refs.update(embed_pass.used_refs)
 
-        self.parse_embed()
+        self.deps = list(dict.fromkeys(self.deps))
 
-    def parse_embed(self):
-        # Import here to avoid circular dependency
-
-        used_refs = {}
-        self.ast = self.embed(self.ast, used_refs)
-        self.used_refs.update(used_refs)
-
-    def embed(self, nodes, used_refs):
+    def embed_node(self, n, used_refs):
         """
-        Embed the content of url in ![](url) if url matches specified regex
+        Embed the content of url in ![](url) if url matches specified regex.
+        A local image is recorded as a dependency.
+
+        :return: None if the node is kept, or the nodes of the embedded markdown to replace it.
         """
 
-        children = []
+        if n["type"] == "image" and not http_url_regex.match(n["src"]):
+            self.deps.append(self.conf.relpath_from_cwd(n["src"]))
 
-        for n in nodes:
-            if "children" in n:
-                n["children"] = self.embed(n["children"], used_refs)
+        if n["type"] != "paragraph" or len(n.get("children", [])) != 1:
+            return None
 
-            if n["type"] != "paragraph" or len(n.get("children", [])) != 1:
-                children.append(n)
-                continue
+        child = n["children"][0]
 
-            child = n["children"][0]
+        if child["type"] != "image":
+            return None
 
-            if child["type"] != "image":
-                children.append(n)
-                continue
+        #  {'alt': 'openacid',
+        #   'src': 'https://...',
+        #   'title': None,
+        #   'type': 'image'},
 
-            #  {'alt': 'openacid',
-            #   'src': 'https://...',
-            #   'title': None,
-            #   'type': 'image'},
+        if not self.parser_config.is_embed(child["src"]):
+            return None
 
-            if not regex_search_any(self.parser_config.embed_patterns, child["src"]):
-                children.append(n)
-                continue
+        article_path = self.conf.relpath_from_cwd(child["src"])
 
-            article_path = self.conf.relpath_from_cwd(child["src"])
-            md_text = fread(article_path)
+        if os.path.abspath(article_path) in self.embed_path:
+            cycle = self.embed_path + (os.path.abspath(article_path),)
+            raise ValueError("embed cycle: " + " -> ".join(cycle))
 
-            # save and restore parent src_path
+        parsed = self.parser_config.parse_cache.get(self.parser_config, article_path)
 
-            old = self.conf.src_path
-            self.conf.src_path = article_path
+        # save and restore parent src_path
 
-            article = Article(self.parser_config, self.conf, md_text)
+        old = self.conf.src_path
+        self.conf.src_path = article_path
 
+        try:
+            article = Article(self.parser_config, self.conf, parsed.md_text, parsed=parsed, embedded_by=self.embed_path)
+        finally:
             self.conf.src_path = old
 
-            # rebase urls in embedded article
+        self.deps.extend(article.deps)
 
-            child_base = os.path.split(article_path)[0]
-            parent_base = os.path.split(self.conf.src_path)[0]
+        # rebase urls in embedded article
 
-            new_children = article.ast
-            rebase_url_in_ast(child_base, parent_base, new_children)
+        child_base = os.path.split(article_path)[0]
+        parent_base = os.path.split(self.conf.src_path)[0]
 
-            children.extend(new_children)
+        new_children = article.ast
+        rebase_url_in_ast(child_base, parent_base, new_children)
 
-            # update used_refs
+        # update used_refs
 
-            used = {}
-            for k, v in article.used_refs.items():
-                v = v.strip()
-                used[k] = rebase_url(child_base, parent_base, v)
+        for k, v in article.used_refs.items():
+            v = v.strip()
+            used_refs[k] = rebase_url(child_base, parent_base, v)
 
-            used_refs.update(used)
+        return new_children
 
-        return children
+    def prerender(self, mdr: MDRender) -> None:
+        """
+        Prepare the slow parts of rendering in batch:
+        download remote images and render math concurrently.
+        """
+        prefetch_remote_images(mdr, self.ast, image_embedding_types(mdr.features))
+        prerender_math(mdr, self.ast)
 
     def chunks(self):
         """
@@ -168,60 +323,100 @@ class Article(object):
             yield "front_matter", "", "---\n" + self.front_matter.text + "\n---"
 
         mdr = MDRender(self.conf, features=self.conf.features)
+        self.prerender(mdr)
+
+        root_node = RenderNode(
+            {
+                "type": "ROOT",
+                "children": self.ast,
+            }
+        )
 
         for node in self.ast:
             # render list items separately
             if node["type"] == "list":
-                root_node = RenderNode(node)
+                list_node = RenderNode(node)
                 for n in node["children"]:
-                    child = root_node.new_child(n)
+                    child = list_node.new_child(n)
                     output_lines = mdr.render_node(child)
                     output_lines = add_paragraph_end(output_lines)
                     yield "content", n["type"], "\n".join(output_lines)
                 yield "content", "new_line", ""
             else:
-                root_node = RenderNode(
-                    {
-                        "type": "ROOT",
-                        "children": [node],
-                    }
-                )
-                output_lines = mdr.render(root_node)
+                output_lines = mdr.render_node(root_node.new_child(node))
                 yield "content", node["type"], "\n".join(output_lines)
 
         ref_lines = ["[{id}]: {d}".format(id=ref_id, d=self.used_refs[ref_id]) for ref_id in sorted(self.used_refs)]
 
         yield "ref_def", "", "\n".join(ref_lines)
 
-    def render(self):
-        mdr = MDRender(self.conf, features=self.conf.features)
+    def blocks(self) -> Iterator[List[str]]:
+        """
+        yield output lines block by block: the front matter, every top level node and the reference definitions.
+        The output markdown is all of the lines joined with newline.
+        """
 
-        root_node = {
-            "type": "ROOT",
-            "children": self.ast,
-        }
-        output_lines = mdr.render(RenderNode(root_node))
+        # Both are set by __init__
+        assert self.ast is not None
+        assert self.used_refs is not None
 
-        if self.conf.keep_meta and self.front_matter is not None:
-            output_lines = ["---", self.front_matter.text, "---"] + output_lines
+        mdr = MDRender(self.conf, features=self.conf.features)
+        self.prerender(mdr)
 
-        output_lines.append("")
+        if self.conf.keep_meta and self.front_matter is not None:
+            yield ["---", self.front_matter.text, "---"]
+
+        # External conversions are queued while rendering and run concurrently when all nodes are rendered.
+        if self.conf.convert_jobs > 1:
+            self.conf.convert_queue = ConvertQueue(self.conf.convert_jobs)
+
+        try:
+            root_node = RenderNode(
+                {
+                    "type": "ROOT",
+                    "children": self.ast,
+                }
+            )
+            for n in self.ast:
+                yield mdr.render_node(root_node.new_child(n))
+
+            if self.conf.convert_queue is not None:
+                self.conf.convert_queue.run(self.conf.timings)
+        finally:
+            self.conf.convert_queue = None
 
         ref_list = render_ref_list(self.used_refs, self.conf.platform)
-        output_lines.extend(ref_list)
+        ref_lines = ["[{id}]: {d}".format(id=ref_id, d=self.used_refs[ref_id]) for ref_id in sorted(self.used_refs)]
 
-        output_lines.append("")
+        yield [""] + ref_list + [""] + ref_lines
 
-        ref_lines = ["[{id}]: {d}".format(id=ref_id, d=self.used_refs[ref_id]) for ref_id in sorted(self.used_refs)]
-        output_lines.extend(ref_lines)
+    def render(self) -> List[str]:
+        output_lines = []
+        for lines in self.blocks():
+            output_lines.extend(lines)
 
         return output_lines
 
+    def write(self, path: str) -> None:
+        """
+        Render and write the output markdown to ``path``.
 
-def regex_search_any(regex_list: List[str], s):
-    for regex in regex_list:
-        m = re.search(regex, s)
-        if m:
-            return True
+        Blocks are written as soon as they are rendered, thus the whole output is never held in memory.
+        The output is written to a temp file then renamed to ``path``,
+        so that ``path`` is never left partially written.
+        """
 
-    return False
+        tmp = "{}.tmp-{}".format(path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                sep = ""
+                for lines in self.blocks():
+                    if len(lines) == 0:
+                        continue
+                    f.write(sep + "\n".join(lines))
+                    sep = "\n"
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
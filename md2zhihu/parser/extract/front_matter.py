@@ -2,6 +2,8 @@ import re
 
 import yaml
 
+front_matter_regex = re.compile(r"^ *--- *\n(.*?)\n---\n", flags=re.DOTALL | re.UNICODE)
+
 
 class FrontMatter(object):
     """
@@ -41,7 +43,7 @@ class FrontMatter(object):
 
 def extract_front_matter(cont):
     meta = None
-    m = re.match(r"^ *--- *\n(.*?)\n---\n", cont, flags=re.DOTALL | re.UNICODE)
+    m = front_matter_regex.match(cont)
     if m:
         cont = cont[m.end() :]
         meta_text = m.groups()[0].strip()
@@ -1,30 +1,85 @@
+import os
 import re
+from types import MappingProxyType
+from typing import Dict
+from typing import Mapping
+from typing import Tuple
 
 import yaml
 from k3fs import fread
 
 from ...config import Config
 
+try:
+    # The C loader of libyaml is several times faster
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
 
-def load_external_refs(conf: Config) -> dict:
-    refs = {}
-    for ref_path in conf.ref_files:
-        fcont = fread(ref_path)
-        y = yaml.safe_load(fcont)
+ref_definition_regex = re.compile(r"\[(.*?)\]:(.*?)$", flags=re.UNICODE)
+
+# (mtime_ns, size) of a file
+FileStamp = Tuple[int, int]
+
+# Caches keep one entry per path, replaced when a file changes,
+# thus a long running process does not accumulate stale entries.
+
+# abspath -> (stamp, parsed refs file)
+_ref_files: Dict[str, Tuple[FileStamp, dict]] = {}
+
+# (abspaths of refs files, platform) -> (stamps of the files, merged refs)
+_merged_refs: Dict[Tuple[Tuple[str, ...], str], Tuple[Tuple[FileStamp, ...], Mapping[str, str]]] = {}
+
+
+def load_external_refs(conf: Config) -> Mapping[str, str]:
+    """
+    Load refs defined in ``conf.ref_files`` that are visible to ``conf.platform``.
+
+    A refs file is parsed only once in a process, unless its mtime or size changes.
+    The merged refs are shared by every article of the same platform, as a read-only mapping.
+    """
+    paths = tuple([os.path.abspath(p) for p in conf.ref_files])
+    stamps = tuple([_file_stamp(p) for p in paths])
+    key = (paths, conf.platform)
+
+    cached = _merged_refs.get(key)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+
+    merged: Dict[str, str] = {}
+    for path, stamp in zip(paths, stamps):
+        y = _load_ref_file(path, stamp)
         for r in y.get("universal", []):
-            refs.update(r)
+            merged.update(r)
         for r in y.get(conf.platform, []):
-            refs.update(r)
+            merged.update(r)
 
+    refs = MappingProxyType(merged)
+    _merged_refs[key] = (stamps, refs)
     return refs
 
 
+def _file_stamp(path: str) -> FileStamp:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load_ref_file(path: str, stamp: FileStamp) -> dict:
+    cached = _ref_files.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    y = yaml.load(fread(path), Loader=SafeLoader)
+    _ref_files[path] = (stamp, y)
+    return y
+
+
 def extract_ref_definitions(cont):
     lines = cont.split("\n")
     rst = []
     refs = {}
     for line in lines:
-        r = re.match(r"\[(.*?)\]:(.*?)$", line, flags=re.UNICODE)
+        r = ref_definition_regex.match(line)
         if r:
             gs = r.groups()
             refs[gs[0]] = gs[1]
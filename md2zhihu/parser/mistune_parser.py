@@ -1,14 +1,52 @@
+import threading
 from typing import Callable
 
 from .._vendor import mistune
+from .._vendor.mistune.renderers import AstRenderer
 from ..types import ASTNodes
+from .node import Node
 
+_local = threading.local()
 
-def new_parser() -> Callable[[str], ASTNodes]:
-    rdr = mistune.create_markdown(
-        escape=False,
-        renderer="ast",
-        plugins=["strikethrough", "footnotes", "table"],
-    )
+
+class CompactAstRenderer(AstRenderer):
+    """
+    An ast renderer that builds ``Node`` instead of ``dict``.
+
+    Every node built by the ast renderer or by a plugin is converted as soon as
+    it is built, thus the whole ast never exists in ``dict`` form.
+    """
+
+    def _get_method(self, name):
+        method = super(CompactAstRenderer, self)._get_method(name)
+
+        def build(*args, **kwargs):
+            return Node.from_dict(method(*args, **kwargs))
+
+        return build
+
+
+def new_parser(compact: bool = False) -> Callable[[str], ASTNodes]:
+    """
+    Return a parser that parses markdown text into ast.
+
+    A parser is built once per thread and reused, thus the rule regexes and
+    the compiled scanners cached in it are built only once.
+    Every parse creates its own state, e.g., link definitions, thus parses do
+    not affect each other.
+
+    If ``compact`` is True, the ast is built of ``Node`` instead of ``dict``.
+    """
+
+    attr = "compact_parser" if compact else "parser"
+
+    rdr = getattr(_local, attr, None)
+    if rdr is None:
+        rdr = mistune.create_markdown(
+            escape=False,
+            renderer=CompactAstRenderer() if compact else "ast",
+            plugins=["strikethrough", "footnotes", "table"],
+        )
+        setattr(_local, attr, rdr)
 
     return rdr
@@ -0,0 +1,135 @@
+import sys
+from collections.abc import MutableMapping
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+from ..types import ASTNodes
+
+_missing = object()
+
+# Keys stored in slots: keys of text nodes, container nodes, list items and table cells.
+# Other keys are stored in ``attrs``.
+_slot_keys = ("type", "children", "text", "level", "align", "is_head")
+
+
+class Node(MutableMapping):
+    """
+    A compact ast node that behaves like the ``dict`` node produced by mistune.
+
+    Common keys such as ``type``, ``children`` and ``text`` are stored in slots, and the type tag is interned.
+    Less common keys such as ``link`` or ``info`` are stored in a dict created only when needed.
+    A text node or a table cell costs less than half of the memory of a dict node.
+
+    Transforms, renderers and platform features access it with the same dict
+    operations: ``n["type"]``, ``"children" in n``, ``n.get("info")``, ``"{src}".format(**n)``, etc.
+    """
+
+    __slots__ = _slot_keys + ("attrs",)
+
+    def __init__(self, typ: str) -> None:
+        self.type = sys.intern(typ)
+        self.children: Any = _missing
+        self.text: Any = _missing
+        self.level: Any = _missing
+        self.align: Any = _missing
+        self.is_head: Any = _missing
+        self.attrs: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Node":
+        n = cls(d["type"])
+        for k, v in d.items():
+            if k != "type":
+                n[k] = v
+        return n
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _slot_keys:
+            v = getattr(self, key)
+            if v is _missing:
+                raise KeyError(key)
+            return v
+
+        if self.attrs is None:
+            raise KeyError(key)
+        return self.attrs[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _slot_keys:
+            if key == "type":
+                value = sys.intern(value)
+            setattr(self, key, value)
+            return
+
+        if self.attrs is None:
+            self.attrs = {}
+        self.attrs[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key == "type":
+            raise KeyError("can not delete type of a node")
+
+        if key in _slot_keys:
+            if getattr(self, key) is _missing:
+                raise KeyError(key)
+            setattr(self, key, _missing)
+            return
+
+        if self.attrs is None:
+            raise KeyError(key)
+        del self.attrs[key]
+
+    def __contains__(self, key: object) -> bool:
+        if key in _slot_keys:
+            return getattr(self, key) is not _missing  # type: ignore
+        return self.attrs is not None and key in self.attrs
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _slot_keys:
+            v = getattr(self, key)
+            return default if v is _missing else v
+
+        if self.attrs is None:
+            return default
+        return self.attrs.get(key, default)
+
+    def __iter__(self) -> Iterator[str]:
+        for k in _slot_keys:
+            if getattr(self, k) is not _missing:
+                yield k
+        if self.attrs is not None:
+            yield from self.attrs
+
+    def __len__(self) -> int:
+        n = len([k for k in _slot_keys if getattr(self, k) is not _missing])
+        if self.attrs is not None:
+            n += len(self.attrs)
+        return n
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def copy(self) -> "Node":
+        n = Node(self.type)
+        for k in _slot_keys[1:]:
+            setattr(n, k, getattr(self, k))
+        if self.attrs is not None:
+            n.attrs = dict(self.attrs)
+        return n
+
+
+def copy_ast(nodes: ASTNodes) -> ASTNodes:
+    """
+    Copy an ast of ``dict`` or ``Node``, so that transforming the copy does not affect the original.
+
+    Nodes and lists of children are copied, other values, i.e., str, int or None, are shared.
+    """
+    rst = []
+    for n in nodes:
+        c = n.copy()
+        if "children" in c:
+            c["children"] = copy_ast(c["children"])
+        rst.append(c)
+    return rst
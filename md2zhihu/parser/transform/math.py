@@ -1,4 +1,11 @@
 import re
+from typing import Optional
+
+from ...types import ASTNode
+from ...types import ASTNodes
+from .pipeline import Pass
+
+math_regex = re.compile(r"([$]|[$][$])([^$].*?)\1", flags=re.DOTALL)
 
 
 def join_math_block(nodes):
@@ -42,30 +49,96 @@ def parse_math(nodes):
     return children
 
 
+class ParseMathPass(Pass):
+    """
+    Pass version of ``parse_math``.
+    """
+
+    name = "parse_math"
+    leave_types = ("text",)
+
+    def leave(self, n: ASTNode) -> Optional[ASTNodes]:
+        if "$" not in n["text"]:
+            return None
+        return extract_math(n)
+
+
+class JoinMathPass(Pass):
+    """
+    Pass version of ``join_math_block``.
+    """
+
+    name = "join_math_block"
+    has_list = True
+
+    def leave_list(self, nodes: ASTNodes) -> ASTNodes:
+        join_math_text(nodes)
+        return nodes
+
+
 def join_math_text(nodes):
-    i = 0
-    while i < len(nodes) - 1:
-        n1 = nodes[i]
-        n2 = nodes[i + 1]
-        if (
-            "children" in n1
-            and "children" in n2
-            and len(n1["children"]) > 0
-            and len(n2["children"]) > 0
-            and n1["children"][-1]["type"] == "text"
-            and n2["children"][0]["type"] == "text"
-            and "$$" in n1["children"][-1]["text"]
-        ):
-            has_dd = "$$" in n2["children"][0]["text"]
-            n1["children"][-1]["text"] += "\n\n" + n2["children"][0]["text"]
+    """
+    Merge a paragraph whose last text has an open ``$$`` with the following
+    paragraphs, until a paragraph with the closing ``$$``.
+
+    Merged texts are joined once and the list is rebuilt once, thus it is
+    linear in the number of nodes and the length of text.
+    """
+
+    rst = []
+
+    # The text node being merged into and the text pieces to join into it
+    joining = None
+
+    # The last node has got the closing ``$$`` and does not merge more.
+    closed = False
+
+    for n2 in nodes:
+        n1 = rst[-1] if len(rst) > 0 else None
+
+        if not closed and n1 is not None and _joinable(n1, n2, joining is not None):
+            t1 = n1["children"][-1]
+            if joining is None:
+                joining = (t1, [t1["text"]])
+
+            t2 = n2["children"][0]["text"]
+            joining[1].append(t2)
             n1["children"].extend(n2["children"][1:])
 
-            nodes.pop(i + 1)
+            closed = "$$" in t2
+            if closed or n1["children"][-1] is not t1:
+                _join_text(joining)
+                joining = None
+            continue
 
-            if has_dd:
-                i += 1
-        else:
-            i += 1
+        if joining is not None:
+            _join_text(joining)
+            joining = None
+
+        closed = False
+        rst.append(n2)
+
+    if joining is not None:
+        _join_text(joining)
+
+    nodes[:] = rst
+
+
+def _joinable(n1, n2, joining):
+    return (
+        "children" in n1
+        and "children" in n2
+        and len(n1["children"]) > 0
+        and len(n2["children"]) > 0
+        and n1["children"][-1]["type"] == "text"
+        and n2["children"][0]["type"] == "text"
+        and (joining or "$$" in n1["children"][-1]["text"])
+    )
+
+
+def _join_text(joining):
+    n, pieces = joining
+    n["text"] = "\n\n".join(pieces)
 
 
 def extract_math(n):
@@ -75,25 +148,23 @@ def extract_math(n):
 
     The math is a block if it is a paragraph.
     Otherwise, it is an inline math.
+
+    The text is scanned once and sliced only for the output segments.
     """
     children = []
 
-    math_regex = r"([$]|[$][$])([^$].*?)\1"
-
     t = n["text"]
-    while True:
-        match = re.search(math_regex, t, flags=re.DOTALL)
-        if match:
-            children.append({"type": "text", "text": t[: match.start()]})
-            children.append({"type": "math_inline", "text": match.groups()[1]})
-            t = t[match.end() :]
-
-            left = children[-2]["text"]
-            right = t
-            if (left == "" or left.endswith("\n\n")) and (right == "" or right.startswith("\n")):
-                children[-1]["type"] = "math_block"
-            continue
+    pos = 0
+    for match in math_regex.finditer(t):
+        left = t[pos : match.start()]
+        pos = match.end()
+
+        typ = "math_inline"
+        if (left == "" or left.endswith("\n\n")) and (pos == len(t) or t.startswith("\n", pos)):
+            typ = "math_block"
+
+        children.append({"type": "text", "text": left})
+        children.append({"type": typ, "text": match.group(2)})
 
-        break
-    children.append({"type": "text", "text": t})
+    children.append({"type": "text", "text": t[pos:]})
     return children
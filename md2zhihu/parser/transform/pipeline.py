@@ -0,0 +1,138 @@
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from ...timing import has_stage_hooks
+from ...timing import stage_hooks
+from ...types import ASTNode
+from ...types import ASTNodes
+
+
+class Pass(object):
+    """
+    A transform of ast, to run in a ``Pipeline``.
+
+    A pass declares the node types it handles:
+
+    - ``enter()`` is called for a node in ``enter_types`` before its children are transformed.
+    - ``leave()`` is called for a node in ``leave_types`` after its children are transformed.
+    - ``leave_list()`` is called for every list of sibling nodes after all of them are transformed,
+      if ``has_list`` is True.
+
+    ``enter()`` and ``leave()`` return None to keep the node, or a list of nodes to replace it.
+    The replacing nodes and their children are then transformed only by the following passes.
+    """
+
+    name: str = ""
+    enter_types: Tuple[str, ...] = ()
+    leave_types: Tuple[str, ...] = ()
+    has_list: bool = False
+
+    def __init__(self, name: Optional[str] = None) -> None:
+        if name is not None:
+            self.name = name
+
+    def enter(self, n: ASTNode) -> Optional[ASTNodes]:
+        return None
+
+    def leave(self, n: ASTNode) -> Optional[ASTNodes]:
+        return None
+
+    def leave_list(self, nodes: ASTNodes) -> ASTNodes:
+        return nodes
+
+
+class Pipeline(object):
+    """
+    Run passes over an ast in as few traversals as the order of passes allows.
+
+    The result is the same as running each pass over the whole ast one by one.
+
+    Consecutive passes are fused into a stage, which is transformed in one
+    traversal. A stage is some ``enter`` passes, then some ``leave`` passes,
+    then some list passes. A pass that has to run after a later kind starts
+    a new stage: e.g., an ``enter`` pass after a ``leave`` pass would see
+    children not yet transformed by the ``leave`` pass.
+
+    If ``timing`` is True, the time spent in each pass is accumulated in
+    ``timings``, keyed by pass name.
+    """
+
+    def __init__(self, passes: Sequence[Pass], timing: bool = False) -> None:
+        self.passes = list(passes)
+        self.stages: List[List[Pass]] = []
+
+        self.timing = timing
+        self.timings: Dict[str, float] = {p.name: 0.0 for p in self.passes}
+
+        # rank of a pass in a stage: enter, leave, then list
+        prev_rank = 3
+        for p in self.passes:
+            rank = 0 if p.enter_types else (1 if p.leave_types else 2)
+            if rank < prev_rank:
+                self.stages.append([])
+            self.stages[-1].append(p)
+            prev_rank = rank
+
+    def run(self, nodes: ASTNodes) -> ASTNodes:
+        for stage in self.stages:
+            nodes = self._walk(stage, 0, nodes)
+        return nodes
+
+    def _walk(self, stage: List[Pass], start: int, nodes: ASTNodes) -> ASTNodes:
+        """
+        Transform a list of sibling nodes with passes ``stage[start:]``.
+        """
+        rst = []
+        for n in nodes:
+            rst.extend(self._node(stage, start, n))
+
+        for p in stage[start:]:
+            if p.has_list:
+                rst = self._call(p, p.leave_list, rst)
+
+        return rst
+
+    def _node(self, stage: List[Pass], start: int, n: ASTNode) -> ASTNodes:
+        """
+        Transform a node and its children with passes ``stage[start:]``.
+        """
+        for i in range(start, len(stage)):
+            p = stage[i]
+            if n["type"] in p.enter_types:
+                replaced = self._call(p, p.enter, n)
+                if replaced is not None:
+                    return self._replace(stage, i + 1, replaced)
+
+        if "children" in n:
+            n["children"] = self._walk(stage, start, n["children"])
+
+        for i in range(start, len(stage)):
+            p = stage[i]
+            if n["type"] in p.leave_types:
+                replaced = self._call(p, p.leave, n)
+                if replaced is not None:
+                    return self._replace(stage, i + 1, replaced)
+
+        return [n]
+
+    def _replace(self, stage: List[Pass], start: int, nodes: ASTNodes) -> ASTNodes:
+        rst = []
+        for n in nodes:
+            rst.extend(self._node(stage, start, n))
+        return rst
+
+    def _call(self, p: Pass, f, arg):
+        if not self.timing and not has_stage_hooks():
+            return f(arg)
+
+        # The same stage name as the timings of the pass are recorded with.
+        with stage_hooks("transform:" + p.name):
+            t0 = time.perf_counter()
+            try:
+                return f(arg)
+            finally:
+                self.timings[p.name] += time.perf_counter() - t0
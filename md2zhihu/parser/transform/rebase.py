@@ -1,7 +1,7 @@
 import os
-import re
 
 from ...types import ASTNodes
+from ...utils import http_url_regex
 
 
 def rebase_url_in_ast(frm: str, to: str, nodes: ASTNodes) -> None:
@@ -22,7 +22,7 @@ def rebase_url(frm: str, to: str, src: str) -> str:
     """
     Change relative path based from ``frm`` to from ``to``.
     """
-    if re.match(r"http[s]?://", src):
+    if http_url_regex.match(src):
         return src
 
     if src.startswith("/"):
@@ -1,4 +1,12 @@
 import re
+from typing import Optional
+
+from ...types import ASTNode
+from ...types import ASTNodes
+from ...types import RefDict
+from .pipeline import Pass
+
+ref_regex = re.compile(r"^\[(.*?)\](\[([^\]]*?)\])?$")
 
 
 def replace_ref_with_def(nodes, refs, do_replace: bool):
@@ -21,27 +29,64 @@ def replace_ref_with_def(nodes, refs, do_replace: bool):
         if n["type"] != "text":
             continue
 
-        t = n["text"]
-        link = re.match(r"^\[(.*?)\](\[([^\]]*?)\])?$", t)
-        if not link:
-            continue
+        replace_ref(n, refs, do_replace, used_defs)
+
+    return used_defs
 
-        gs = link.groups()
-        txt = gs[0]
-        if len(gs) >= 3:
-            definition = gs[2]
 
-        if definition is None or definition == "":
-            definition = txt
+def replace_ref(n: ASTNode, refs: RefDict, do_replace: bool, used_defs: RefDict) -> bool:
+    """
+    Record the ref used by a text node in ``used_defs``,
+    and if ``do_replace`` is True, convert the text node to a link node.
 
-        if definition in refs:
-            r = refs[definition]
-            used_defs[definition] = r
+    :return: True if the node is converted to a link.
+    """
 
-            if do_replace:
-                n["type"] = "link"
-                #  TODO title
-                n["link"] = r.split()[0]
-                n["children"] = [{"type": "text", "text": txt}]
+    t = n["text"]
+    link = ref_regex.match(t)
+    if not link:
+        return False
 
-    return used_defs
+    gs = link.groups()
+    txt = gs[0]
+    if len(gs) >= 3:
+        definition = gs[2]
+
+    if definition is None or definition == "":
+        definition = txt
+
+    if definition not in refs:
+        return False
+
+    r = refs[definition]
+    used_defs[definition] = r
+
+    if not do_replace:
+        return False
+
+    n["type"] = "link"
+    #  TODO title
+    n["link"] = r.split()[0]
+    n["children"] = [{"type": "text", "text": txt}]
+    return True
+
+
+class ReplaceRefPass(Pass):
+    """
+    Pass version of ``replace_ref_with_def``. Used refs are collected in ``used_defs``.
+    """
+
+    name = "replace_ref_with_def"
+    leave_types = ("text",)
+
+    def __init__(self, refs: RefDict, do_replace: bool) -> None:
+        super().__init__()
+        self.refs = refs
+        self.do_replace = do_replace
+        self.used_defs: RefDict = {}
+
+    def leave(self, n: ASTNode) -> Optional[ASTNodes]:
+        if replace_ref(n, self.refs, self.do_replace, self.used_defs):
+            # The link text is a new child that following passes need to transform.
+            return [n]
+        return None
@@ -1,9 +1,15 @@
 import re
 from typing import List
+from typing import Optional
 
 from ...renderer import MDRender
 from ...renderer import RenderNode
+from ...types import ASTNode
+from ...types import ASTNodes
 from ..mistune_parser import new_parser
+from .pipeline import Pass
+
+table_regex = re.compile(r" {0,3}\|(.+)\n *\|( *[-:]+[-| :]*)\n((?: *\|.*(?:\n|$))*)\n*")
 
 
 def parse_in_list_tables(nodes) -> List[dict]:
@@ -23,9 +29,32 @@ def parse_in_list_tables(nodes) -> List[dict]:
     return rst
 
 
-def convert_paragraph_table(node: dict) -> List[dict]:
+class InListTablePass(Pass):
+    """
+    Pass version of ``parse_in_list_tables``.
+
+    A paragraph is converted before its children are transformed,
+    because the paragraph is rendered back to markdown and parsed again.
+    """
+
+    name = "parse_in_list_tables"
+    enter_types = ("paragraph",)
+
+    def __init__(self, compact: bool = False) -> None:
+        super().__init__()
+        self.compact = compact
+
+    def enter(self, n: ASTNode) -> Optional[ASTNodes]:
+        nodes = convert_paragraph_table(n, compact=self.compact)
+        if len(nodes) == 1 and nodes[0] is n:
+            return None
+        return nodes
+
+
+def convert_paragraph_table(node: dict, compact: bool = False) -> List[dict]:
     """
     Parse table text in a paragraph and returns the ast of parsed table.
+    If ``compact`` is True, the table is parsed into ``Node``.
 
     :return List[dict]: a list of ast nodes.
     """
@@ -44,15 +73,13 @@ def convert_paragraph_table(node: dict) -> List[dict]:
 
     txt = c0["text"]
 
-    table_reg = r" {0,3}\|(.+)\n *\|( *[-:]+[-| :]*)\n((?: *\|.*(?:\n|$))*)\n*"
-
-    match = re.match(table_reg, txt)
+    match = table_regex.match(txt)
     if match:
         mdr = MDRender(None, features={})
         partialmd_lines = mdr.render(RenderNode(node))
         partialmd = "".join(partialmd_lines)
 
-        parser = new_parser()
+        parser = new_parser(compact)
         new_children = parser(partialmd)
 
         return new_children
@@ -94,7 +94,14 @@ simple_features = dict(
     ),
 )
 
-weibo_features = {"*": weibo_specific}
+weibo_features = {
+    # The same as weibo_specific, declared so that what they are converted with can be looked up,
+    # e.g., to render math or download images in batch before rendering.
+    "math_block": math_block_to_imgtag,
+    "math_inline": math_inline_to_plaintext,
+    "table": table_to_jpg,
+    "*": weibo_specific,
+}
 
 
 wechat_features = dict(
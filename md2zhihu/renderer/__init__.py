@@ -1,4 +1,6 @@
 """Renderer classes for md2zhihu"""
 
+from .dispatch import compile_features
 from .md_render import MDRender
 from .render_node import RenderNode
+from .rope import LineRope
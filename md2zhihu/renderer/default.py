@@ -0,0 +1,219 @@
+"""Default renderers that render every ast node back to markdown"""
+
+import pprint
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Union
+
+from ..utils import add_paragraph_end
+from .rope import LineRope
+
+# prefix of lines in a list item except the first one, see ``utils.indent()``
+indent_prefix = ("    ", True)
+
+quote_prefix = ("> ", False)
+
+alignmap = {
+    "left": ":--",
+    "right": "--:",
+    "center": ":-:",
+    None: "---",
+}
+
+
+def render_thematic_break(mdr, rnode):
+    return ["---", ""]
+
+
+def render_paragraph(mdr, rnode):
+    lines = mdr.render(rnode)
+    return "".join(lines).split("\n") + [""]
+
+
+def render_text(mdr, rnode):
+    return [rnode.node["text"]]
+
+
+def render_strong(mdr, rnode):
+    lines = mdr.render(rnode)
+    lines[0] = "**" + lines[0]
+    lines[-1] = lines[-1] + "**"
+    return lines
+
+
+def render_math_block(mdr, rnode):
+    return ["$$", rnode.node["text"], "$$"]
+
+
+def render_math_inline(mdr, rnode):
+    return ["$$ " + rnode.node["text"].strip() + " $$"]
+
+
+def render_table(mdr, rnode):
+    return mdr.render(rnode) + [""]
+
+
+def render_table_head(mdr, rnode):
+    lines = mdr.render(rnode)
+    aligns = [alignmap[x["align"]] for x in rnode.node["children"]]
+    aligns = "| " + " | ".join(aligns) + " |"
+    return ["| " + " | ".join(lines) + " |", aligns]
+
+
+def render_table_cell(mdr, rnode):
+    lines = mdr.render(rnode)
+    return ["".join(lines)]
+
+
+def render_table_body(mdr, rnode):
+    return mdr.render(rnode)
+
+
+def render_table_row(mdr, rnode):
+    lines = mdr.render(rnode)
+    return ["| " + " | ".join(lines) + " |"]
+
+
+def render_block_code(mdr, rnode):
+    n = rnode.node
+    # remove the last \n
+    return ["```" + (n["info"] or "")] + n["text"][:-1].split("\n") + ["```", ""]
+
+
+def render_codespan(mdr, rnode):
+    return [("`" + rnode.node["text"] + "`")]
+
+
+def render_image(mdr, rnode):
+    n = rnode.node
+    if n["title"] is None:
+        return ["![{alt}]({src})".format(**n)]
+    else:
+        return ["![{alt}]({src} {title})".format(**n)]
+
+
+def render_list(mdr, rnode):
+    rope = mdr.render_rope(rnode)
+    if not rope.last_is_empty():
+        rope.append("")
+    return rope
+
+
+def render_list_item(mdr, rnode):
+    # parent is a `list` node
+    parent = rnode.parent
+    assert parent.node["type"] == "list"
+
+    head = "-   "
+    if parent.node["ordered"]:
+        head = "1.  "
+
+    rope = LineRope(first=(head, False), rest=indent_prefix)
+    rope.extend(mdr.render_rope(rnode))
+    return rope
+
+
+def render_block_text(mdr, rnode):
+    lines = mdr.render(rnode)
+    return "".join(lines).split("\n")
+
+
+def render_block_quote(mdr, rnode):
+    children = mdr.render_rope(rnode)
+    children.strip_end()
+
+    quoted = LineRope(first=quote_prefix, rest=quote_prefix)
+    quoted.extend(children)
+
+    rope = LineRope()
+    rope.extend(quoted)
+    rope.append("")
+    return rope
+
+
+def render_newline(mdr, rnode):
+    return [""]
+
+
+def render_block_html(mdr, rnode):
+    return add_paragraph_end([rnode.node["text"]])
+
+
+def render_link(mdr, rnode):
+    #  TODO title
+    lines = mdr.render(rnode)
+    lines[0] = "[" + lines[0]
+    lines[-1] = lines[-1] + "](" + rnode.node["link"] + ")"
+
+    return lines
+
+
+def render_heading(mdr, rnode):
+    lines = mdr.render(rnode)
+    lines[0] = "#" * rnode.node["level"] + " " + lines[0]
+    return lines + [""]
+
+
+def render_strikethrough(mdr, rnode):
+    lines = mdr.render(rnode)
+    lines[0] = "~~" + lines[0]
+    lines[-1] = lines[-1] + "~~"
+    return lines
+
+
+def render_emphasis(mdr, rnode):
+    lines = mdr.render(rnode)
+    lines[0] = "*" + lines[0]
+    lines[-1] = lines[-1] + "*"
+    return lines
+
+
+def render_inline_html(mdr, rnode):
+    return [rnode.node["text"]]
+
+
+def render_linebreak(mdr, rnode):
+    return ["  \n"]
+
+
+def render_unknown(mdr, rnode):
+    n = rnode.node
+    typ = n["type"]
+
+    print(typ, n.keys())
+    pprint.pprint(n)
+    return ["***:" + typ]
+
+
+Renderer = Callable[..., Union[List[str], LineRope]]
+
+# node type to default renderer
+default_renderers: Dict[str, Renderer] = {
+    "thematic_break": render_thematic_break,
+    "paragraph": render_paragraph,
+    "text": render_text,
+    "strong": render_strong,
+    "math_block": render_math_block,
+    "math_inline": render_math_inline,
+    "table": render_table,
+    "table_head": render_table_head,
+    "table_cell": render_table_cell,
+    "table_body": render_table_body,
+    "table_row": render_table_row,
+    "block_code": render_block_code,
+    "codespan": render_codespan,
+    "image": render_image,
+    "list": render_list,
+    "list_item": render_list_item,
+    "block_text": render_block_text,
+    "block_quote": render_block_quote,
+    "newline": render_newline,
+    "block_html": render_block_html,
+    "link": render_link,
+    "heading": render_heading,
+    "strikethrough": render_strikethrough,
+    "emphasis": render_emphasis,
+    "inline_html": render_inline_html,
+    "linebreak": render_linebreak,
+}
@@ -1,8 +1,21 @@
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 
+from .default import Renderer
+from .default import default_renderers
+from .default import render_unknown
 from .render_node import RenderNode
 
+# A compiled handler table: (node type to handler, handler of other node types)
+HandlerTable = Tuple[Dict[str, Renderer], Renderer]
+
+# Cache of compiled features, keyed by id(features).
+# The features dict is kept in the entry so that its id is not reused.
+_compiled: Dict[int, Tuple[dict, HandlerTable]] = {}
+_compiled_max = 128
+
 
 #  features: {typ:action(), typ2:{subtyp:action()}}
 def render_with_features(mdrender, rnode: RenderNode, features=None) -> Optional[List[str]]:
@@ -33,3 +46,73 @@ def render_with_features(mdrender, rnode: RenderNode, features=None) -> Optional
         return type_handler["*"](mdrender, rnode)
 
     return None
+
+
+def compile_features(features: dict) -> HandlerTable:
+    """
+    Compile a features dict and the default renderers into a flat table of one handler per node type.
+
+    A handler renders a node with the platform feature, or with the default renderer if the
+    feature returns None, the same as ``render_with_features()`` followed by the default renderer.
+
+    Compiled tables are cached, thus a features dict should not be modified after it is used.
+    """
+
+    cached = _compiled.get(id(features))
+    if cached is not None and cached[0] is features:
+        return cached[1]
+
+    star = features.get("*")
+
+    handlers = {}
+    for typ in set(default_renderers.keys()) | set(features.keys()):
+        if typ == "*":
+            continue
+
+        default = default_renderers.get(typ, render_unknown)
+
+        if typ not in features:
+            handlers[typ] = _chain(star, default)
+        elif callable(features[typ]):
+            handlers[typ] = _chain(features[typ], default)
+        else:
+            handlers[typ] = _by_info(features[typ], default)
+
+    table = (handlers, _chain(star, render_unknown))
+
+    if len(_compiled) >= _compiled_max:
+        _compiled.clear()
+    _compiled[id(features)] = (features, table)
+
+    return table
+
+
+def _chain(feature, default: Renderer) -> Renderer:
+    if feature is None:
+        return default
+
+    def handler(mdrender, rnode):
+        lines = feature(mdrender, rnode)
+        if lines is None:
+            return default(mdrender, rnode)
+        return lines
+
+    return handler
+
+
+def _by_info(sub_features: dict, default: Renderer) -> Renderer:
+    """
+    Build a handler that chooses a feature by subtype, e.g., the language of a code block.
+    """
+    star = sub_features.get("*")
+
+    def handler(mdrender, rnode):
+        #  subtype is info, the type after "```"
+        feature = sub_features.get(rnode.node["info"] or "", star)
+        if feature is not None:
+            lines = feature(mdrender, rnode)
+            if lines is not None:
+                return lines
+        return default(mdrender, rnode)
+
+    return handler
@@ -1,11 +1,9 @@
-import pprint
 from typing import List
+from typing import Union
 
-from ..utils import add_paragraph_end
-from ..utils import indent
 from ..utils import msg
-from ..utils import strip_paragraph_end
-from .dispatch import render_with_features
+from .dispatch import compile_features
+from .rope import LineRope
 
 
 class MDRender(object):
@@ -15,7 +13,10 @@ class MDRender(object):
         self.conf = conf
         self.features = features
 
-    def render_node(self, rnode):
+        # one handler per node type, merged from features and default renderers
+        self.handlers, self.fallback = compile_features(features)
+
+    def render_node(self, rnode) -> List[str]:
         """
         Render a AST node into lines of text
 
@@ -23,150 +24,17 @@ class MDRender(object):
             rnode is a RenderNode instance
         """
 
-        n = rnode.node
-        typ = n["type"]
-
-        #  customized renderers:
-
-        lines = render_with_features(self, rnode, self.features)
-        if lines is not None:
-            return lines
-        else:
-            # can not render, continue with default handler
-            pass
-
-        # default renderers:
-
-        if typ == "thematic_break":
-            return ["---", ""]
-
-        if typ == "paragraph":
-            lines = self.render(rnode)
-            return "".join(lines).split("\n") + [""]
-
-        if typ == "text":
-            return [n["text"]]
-
-        if typ == "strong":
-            lines = self.render(rnode)
-            lines[0] = "**" + lines[0]
-            lines[-1] = lines[-1] + "**"
-            return lines
-
-        if typ == "math_block":
-            return ["$$", n["text"], "$$"]
-
-        if typ == "math_inline":
-            return ["$$ " + n["text"].strip() + " $$"]
-
-        if typ == "table":
-            return self.render(rnode) + [""]
-
-        if typ == "table_head":
-            alignmap = {
-                "left": ":--",
-                "right": "--:",
-                "center": ":-:",
-                None: "---",
-            }
-            lines = self.render(rnode)
-            aligns = [alignmap[x["align"]] for x in n["children"]]
-            aligns = "| " + " | ".join(aligns) + " |"
-            return ["| " + " | ".join(lines) + " |", aligns]
-
-        if typ == "table_cell":
-            lines = self.render(rnode)
-            return ["".join(lines)]
-
-        if typ == "table_body":
-            return self.render(rnode)
-
-        if typ == "table_row":
-            lines = self.render(rnode)
-            return ["| " + " | ".join(lines) + " |"]
-
-        if typ == "block_code":
-            # remove the last \n
-            return ["```" + (n["info"] or "")] + n["text"][:-1].split("\n") + ["```", ""]
-
-        if typ == "codespan":
-            return [("`" + n["text"] + "`")]
-
-        if typ == "image":
-            if n["title"] is None:
-                return ["![{alt}]({src})".format(**n)]
-            else:
-                return ["![{alt}]({src} {title})".format(**n)]
-
-        if typ == "list":
-            lines = self.render(rnode)
-            return add_paragraph_end(lines)
-
-        if typ == "list_item":
-            lines = self.render(rnode)
-
-            # parent is a `list` node
-            parent = rnode.parent
-            assert parent.node["type"] == "list"
+        lines = self._render_node(rnode)
+        if isinstance(lines, LineRope):
+            return lines.to_list()
+        return lines
 
-            head = "-   "
-            if parent.node["ordered"]:
-                head = "1.  "
-
-            lines[0] = head + lines[0]
-            lines = lines[0:1] + [indent(x) for x in lines[1:]]
-            return lines
-
-        if typ == "block_text":
-            lines = self.render(rnode)
-            return "".join(lines).split("\n")
-
-        if typ == "block_quote":
-            lines = self.render(rnode)
-            lines = strip_paragraph_end(lines)
-            lines = ["> " + x for x in lines]
-            return lines + [""]
-
-        if typ == "newline":
-            return [""]
-
-        if typ == "block_html":
-            return add_paragraph_end([n["text"]])
-
-        if typ == "link":
-            #  TODO title
-            lines = self.render(rnode)
-            lines[0] = "[" + lines[0]
-            lines[-1] = lines[-1] + "](" + n["link"] + ")"
-
-            return lines
-
-        if typ == "heading":
-            lines = self.render(rnode)
-            lines[0] = "#" * n["level"] + " " + lines[0]
-            return lines + [""]
-
-        if typ == "strikethrough":
-            lines = self.render(rnode)
-            lines[0] = "~~" + lines[0]
-            lines[-1] = lines[-1] + "~~"
-            return lines
-
-        if typ == "emphasis":
-            lines = self.render(rnode)
-            lines[0] = "*" + lines[0]
-            lines[-1] = lines[-1] + "*"
-            return lines
-
-        if typ == "inline_html":
-            return [n["text"]]
-
-        if typ == "linebreak":
-            return ["  \n"]
-
-        print(typ, n.keys())
-        pprint.pprint(n)
-        return ["***:" + typ]
+    def _render_node(self, rnode) -> Union[List[str], LineRope]:
+        """
+        Render a AST node into lines of text,
+        or into a ``LineRope`` if it is a container block rendered by default renderer.
+        """
+        return self.handlers.get(rnode.node["type"], self.fallback)(self, rnode)
 
     def render(self, rnode) -> List[str]:
         rst = []
@@ -177,5 +45,16 @@ class MDRender(object):
 
         return rst
 
+    def render_rope(self, rnode) -> LineRope:
+        """
+        Render children of a container block into a rope, without building lines of nested containers.
+        """
+        rope = LineRope()
+        for n in rnode.node["children"]:
+            child = rnode.new_child(n)
+            rope.extend(self._render_node(child))
+
+        return rope
+
     def msg(self, *args):
         msg(*args)
@@ -8,24 +8,27 @@ from ..types import ASTNode
 class RenderNode(object):
     """
     RenderNode is a container of current ast-node and parent
+
+    One is created for every node rendered, thus it has no per-instance dict.
     """
 
-    def __init__(self, n: ASTNode, parent: Optional[RenderNode] = None) -> None:
+    __slots__ = ("node", "level", "parent")
+
+    def __init__(self, n: ASTNode, parent: Optional[RenderNode] = None, level: int = 0) -> None:
         """
         :param n: ast node: a normal dictionary such as {'type': 'text' ... }
         :param parent: parent RenderNode
+        :param level: depth of this node, the root is 0
         """
         self.node: ASTNode = n
 
-        self.level: int = 0
+        self.level: int = level
 
         # parent RenderNode
         self.parent: Optional[RenderNode] = parent
 
     def new_child(self, n: ASTNode) -> RenderNode:
-        c = RenderNode(n, parent=self)
-        c.level = self.level + 1
-        return c
+        return RenderNode(n, self, self.level + 1)
 
     def to_str(self) -> str:
         t = "{}".format(self.node.get("type"))
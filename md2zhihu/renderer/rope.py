@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+# A line prefix: (prefix, skip_empty).
+# If skip_empty is True, the prefix is not added to an empty line, e.g., indentation.
+Prefix = Tuple[str, bool]
+
+# Composed prefixes of all enclosing ropes: (prefix of a non-empty line, prefix of an empty line)
+_Ctx = Tuple[str, str]
+
+
+class LineRope(object):
+    """
+    Output lines of a container block such as a list or a quote, built without copying nested lines.
+
+    A rope is a sequence of lines and of nested ropes.
+    The prefix of a rope, such as a list item head or ``"> "``, is recorded once,
+    instead of being added to every nested line at every nesting level.
+    Lines are built only once in ``to_list()``, when the prefixes of all
+    enclosing ropes are known. Thus nested blocks render in time linear to the output size.
+
+    ``first`` is the prefix of the first line, ``rest`` is the prefix of other lines.
+    """
+
+    __slots__ = ("parts", "first", "rest", "size")
+
+    def __init__(self, first: Optional[Prefix] = None, rest: Optional[Prefix] = None) -> None:
+        self.parts: List[Union[str, LineRope]] = []
+        self.first = first
+        self.rest = rest
+
+        # Number of lines
+        self.size = 0
+
+    def append(self, line: str) -> None:
+        self.parts.append(line)
+        self.size += 1
+
+    def extend(self, lines: Union[List[str], LineRope]) -> None:
+        if isinstance(lines, LineRope):
+            self.parts.append(lines)
+        else:
+            self.parts.extend(lines)
+        self.size += len(lines)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def last_is_empty(self) -> bool:
+        """
+        Whether the last output line is empty.
+        """
+        if self.size == 0:
+            return False
+
+        last = self._last_part()
+        if isinstance(last, LineRope):
+            empty = last.last_is_empty()
+        else:
+            empty = last == ""
+
+        prefix = self.first if self.size == 1 else self.rest
+        if prefix is None:
+            return empty
+
+        return empty and prefix[1]
+
+    def strip_end(self) -> None:
+        """
+        Remove trailing empty lines, like ``utils.strip_paragraph_end()``.
+        """
+        while self.last_is_empty():
+            self._pop()
+
+    def to_list(self) -> List[str]:
+        out: List[str] = []
+        self._emit(out, ("", ""), ("", ""))
+        return out
+
+    def _last_part(self) -> Union[str, LineRope]:
+        while isinstance(self.parts[-1], LineRope) and self.parts[-1].size == 0:
+            self.parts.pop()
+        return self.parts[-1]
+
+    def _pop(self) -> None:
+        last = self._last_part()
+        if isinstance(last, LineRope):
+            last._pop()
+        else:
+            self.parts.pop()
+        self.size -= 1
+
+    def _emit(self, out: List[str], first: _Ctx, rest: _Ctx) -> None:
+        """
+        Build lines into ``out``.
+
+        ``first`` and ``rest`` are composed prefixes of enclosing ropes for the first line and for other lines.
+        """
+        first = _compose(first, self.first)
+        rest = _compose(rest, self.rest)
+
+        ctx = first
+        for part in self.parts:
+            if isinstance(part, LineRope):
+                if part.size == 0:
+                    continue
+                part._emit(out, ctx, rest)
+            elif part == "":
+                out.append(ctx[1])
+            else:
+                out.append(ctx[0] + part)
+            ctx = rest
+
+
+def _compose(ctx: _Ctx, prefix: Optional[Prefix]) -> _Ctx:
+    """
+    Add an inner prefix to the composed prefixes of enclosing ropes.
+    """
+    if prefix is None:
+        return ctx
+
+    p, skip_empty = prefix
+    non_empty = ctx[0] + p
+    if skip_empty:
+        return non_empty, ctx[1]
+    return non_empty, non_empty
@@ -0,0 +1,256 @@
+"""
+A long running server converting markdowns sent over HTTP or a Unix socket.
+
+Requests are received concurrently but converted one at a time, see ``Converter``.
+The server listens only on a loopback address or a Unix socket, and a request
+can only read files in the root dir of ``Converter``.
+"""
+
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+from ..api import convert_text
+from ..asset import DirSink
+from ..converters import MathTable
+from ..parser import ParserConfig
+from ..platform import platform_feature_dict
+from ..utils import msg
+
+# Max number of rendered math and generated images kept between requests,
+# they are dropped when there are more, to bound the memory of a long running server.
+max_kept = 10000
+
+
+class RequestError(ValueError):
+    """
+    An invalid conversion request.
+    """
+
+
+class Converter(object):
+    """
+    Convert markdown text sent by requests, keeping what is costly to prepare
+    for the next request: the parser config and parsed embedded markdowns,
+    parsed refs files, rendered math, images generated by external
+    converters and the browser k3down2 renders images with.
+
+    Conversions run one at a time in one dedicated thread, because the
+    browser can only be driven from the thread that started it.
+    A request may be submitted from any thread, but it waits for the conversions before it,
+    thus the throughput is that of one conversion at a time.
+
+    Paths in a request, and local files the markdown refers to, must be in
+    ``root``, by default the current working dir, otherwise the request is rejected.
+
+    A request is a dict:
+
+    - ``markdown``: the markdown text to convert, required;
+    - ``platform``: the platform to convert to, default "zhihu";
+    - ``path``: path of the markdown, relative embeds and images are read relative to it,
+      and assets are stored in ``<output_dir>/<name>/`` named after it. Default "article.md";
+    - ``md_output``: the path the output markdown will be stored at, image urls are relative to it when no repo is specified.
+      Default "<output_dir>/";
+    - ``refs``, ``rewrite``, ``code_width``, ``keep_meta``, ``jekyll``, ``download``: the same as command line options.
+
+    The result is a dict of the converted ``markdown`` and ``assets``, the paths of assets it references.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        embed_patterns: Optional[List[str]] = None,
+        asset_repo_url: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        convert_jobs: int = 1,
+        warm_mermaid: bool = False,
+        root: Optional[str] = None,
+    ) -> None:
+        self.output_dir = output_dir
+        self.root = os.path.abspath(root if root is not None else os.getcwd())
+        self.asset_repo_url = asset_repo_url
+        self.cache_dir = cache_dir
+        self.convert_jobs = convert_jobs
+        self.warm_mermaid = warm_mermaid
+
+        if embed_patterns is None:
+            embed_patterns = [r"[.]md$"]
+        self.parser_config = ParserConfig(True, embed_patterns)
+
+        self.math_table = MathTable()
+        self.generated: Dict[str, str] = {}
+        self.asset_sink = DirSink()
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="md2zhihu-convert")
+
+    def convert(self, req: dict) -> dict:
+        return self.executor.submit(self._convert, req).result()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def _convert(self, req: dict) -> dict:
+        md_text = req.get("markdown")
+        if not isinstance(md_text, str):
+            raise RequestError('"markdown" is required')
+
+        platform = req.get("platform", "zhihu")
+        if platform not in platform_feature_dict:
+            raise RequestError("invalid platform: {!r}".format(platform))
+
+        refs = req.get("refs")
+        if refs is not None and not (isinstance(refs, list) and all(isinstance(r, str) for r in refs)):
+            raise RequestError('"refs" must be a list of paths')
+
+        for k in ("path", "md_output"):
+            if k in req and not isinstance(req[k], str):
+                raise RequestError('"{}" must be a path'.format(k))
+
+        if len(self.math_table.rendered) > max_kept:
+            self.math_table = MathTable()
+        if len(self.generated) > max_kept:
+            self.generated = {}
+
+        rst = convert_text(
+            md_text,
+            platform,
+            src_path=req.get("path", "article.md"),
+            asset_sink=self.asset_sink,
+            output_dir=self.output_dir,
+            md_output_path=req.get("md_output", self.output_dir + "/"),
+            parser_config=self.parser_config,
+            math_table=self.math_table,
+            generated=self.generated,
+            asset_repo_url=self.asset_repo_url,
+            code_width=req.get("code_width", 1000),
+            keep_meta=req.get("keep_meta", False),
+            ref_files=refs,
+            jekyll=req.get("jekyll", False),
+            rewrite=req.get("rewrite"),
+            download=req.get("download", False),
+            cache_dir=self.cache_dir,
+            convert_jobs=self.convert_jobs,
+            warm_mermaid=self.warm_mermaid,
+            root=self.root,
+        )
+
+        return dict(markdown=rst.markdown, assets=rst.assets)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    ``POST /convert`` with a json request converts a markdown, see ``Converter``.
+    ``GET /health`` returns ``{"ok": true}``.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.reply(404, dict(error="not found: " + self.path))
+            return
+        self.reply(200, dict(ok=True))
+
+    def do_POST(self):
+        if self.path != "/convert":
+            self.reply(404, dict(error="not found: " + self.path))
+            return
+
+        try:
+            size = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(size))
+            if not isinstance(req, dict):
+                raise RequestError("request must be a json object")
+
+            rst = self.server.converter.convert(req)
+        except (ValueError, OSError) as e:
+            # Invalid json, request or a file that can not be read
+            self.reply(400, dict(error=repr(e)))
+            return
+        except Exception as e:
+            self.reply(500, dict(error=repr(e)))
+            return
+
+        self.reply(200, rst)
+
+    def reply(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is empty with a Unix socket
+        if isinstance(self.client_address, tuple):
+            return str(self.client_address[0])
+        return "unix"
+
+    def log_message(self, format, *args):
+        msg(self.address_string(), " ", format % args)
+
+
+class ConvertServer(ThreadingHTTPServer):
+    converter: Converter
+
+
+class ConvertUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    converter: Converter
+
+
+def is_loopback(host: str) -> bool:
+    """
+    Return True if every address ``host`` resolves to is a loopback address.
+    """
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+
+    return len(infos) > 0 and all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+def remove_stale_socket(path: str) -> None:
+    """
+    Remove the socket file at ``path`` left by a previous server.
+    Raise ValueError if there is something else at ``path``.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ValueError("not a socket, refuse to replace it: {!r}".format(path))
+
+    os.remove(path)
+
+
+def new_server(converter: Converter, host: str = "127.0.0.1", port: int = 8300, socket_path: Optional[str] = None):
+    """
+    Create a server that handles every request in a thread and converts with ``converter``.
+    It listens on ``socket_path`` if it is specified, otherwise on ``host:port``.
+
+    ``host`` must be a loopback address, a request reads local files and there is no authentication.
+    """
+    server: Union[ConvertServer, ConvertUnixServer]
+    if socket_path is not None:
+        remove_stale_socket(socket_path)
+        server = ConvertUnixServer(socket_path, Handler)
+    else:
+        if not is_loopback(host):
+            raise ValueError("only a loopback address can be listened on: {!r}".format(host))
+        server = ConvertServer((host, port), Handler)
+
+    server.converter = converter
+    return server
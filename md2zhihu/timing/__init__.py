@@ -0,0 +1,205 @@
+"""Wall time and call counts of the stages of a build"""
+
+import cProfile
+import json
+import time
+from contextlib import ExitStack
+from contextlib import contextmanager
+from typing import Callable
+from typing import ContextManager
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+# A hook is called with the name of a stage when the stage starts,
+# and returns a context manager that exits when the stage ends.
+StageHook = Callable[[str], ContextManager]
+
+_hooks: List[StageHook] = []
+
+
+def add_stage_hook(hook: StageHook) -> None:
+    """
+    Register a hook that runs around every stage, e.g., to profile one stage with cProfile or pyinstrument.
+    """
+    _hooks.append(hook)
+
+
+def remove_stage_hook(hook: StageHook) -> None:
+    _hooks.remove(hook)
+
+
+def has_stage_hooks() -> bool:
+    return len(_hooks) > 0
+
+
+@contextmanager
+def stage_hooks(name: str) -> Iterator[None]:
+    """
+    Run the stage hooks around a stage whose time is recorded by the caller with ``Timings.add()``,
+    e.g., parsing, which runs before the ``Timings`` of a markdown is available,
+    or a batch whose time is counted per item.
+    """
+    if len(_hooks) == 0:
+        yield
+        return
+
+    with ExitStack() as stack:
+        for hook in list(_hooks):
+            stack.enter_context(hook(name))
+        yield
+
+
+class Timings(object):
+    """
+    Accumulated wall time and call count per stage, keyed by stage name, e.g.:
+
+    - ``"article"``: converting a markdown, including everything below;
+    - ``"parse"``: parsing markdown with mistune;
+    - ``"transform:<pass>"``: a pass transforming the ast, e.g., ``"transform:embed"``;
+    - ``"render"``: rendering and writing the output markdown, including converters and assets;
+    - ``"convert:<type>"``: an external converter, ``<type>`` is one of mermaid, graphviz, tex, table or code;
+    - ``"asset:copy"``, ``"asset:download"``: placing a local image or downloading a remote image;
+    - ``"push"``: pushing the output dir to git repo.
+
+    Stages nest, thus the time of a stage includes the time of the stages within it.
+    If it is not ``enabled``, nothing is recorded, but stage hooks still run.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+
+        # stage name -> [seconds, count]
+        self.stages: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.enabled and len(_hooks) == 0:
+            yield
+            return
+
+        with stage_hooks(name):
+            t0 = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.enabled:
+                    self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float, count: int = 1) -> None:
+        if not self.enabled:
+            return
+
+        st = self.stages.setdefault(name, [0.0, 0])
+        st[0] += seconds
+        st[1] += count
+
+    def merge(self, other: "Timings") -> None:
+        for name, (seconds, count) in other.stages.items():
+            self.add(name, seconds, int(count))
+
+    def to_dict(self) -> dict:
+        return {
+            name: dict(seconds=round(seconds, 6), count=int(count)) for name, (seconds, count) in sorted(self.stages.items())
+        }
+
+
+class TimingReport(object):
+    """
+    Timings of a build: of every converted markdown, and of the stages outside of them, e.g., ``push``.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.build = Timings(enabled=enabled)
+
+        # md_output_path -> {"src_path", "platform", "timings"}
+        self.articles: Dict[str, dict] = {}
+
+    def add_article(self, conf) -> None:
+        self.articles[conf.md_output_path] = dict(
+            src_path=conf.src_path,
+            platform=conf.platform,
+            timings=conf.timings,
+        )
+
+    def total(self) -> Timings:
+        t = Timings()
+        t.merge(self.build)
+        for a in self.articles.values():
+            t.merge(a["timings"])
+        return t
+
+    def to_dict(self) -> dict:
+        return dict(
+            version=1,
+            total=self.total().to_dict(),
+            build=self.build.to_dict(),
+            articles={
+                path: dict(src_path=a["src_path"], platform=a["platform"], stages=a["timings"].to_dict())
+                for path, a in sorted(self.articles.items())
+            },
+        )
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def summary(self, top: int = 10) -> List[str]:
+        """
+        Human readable lines: stages by time, then the slowest markdowns.
+        """
+        lines = ["{:<32} {:>10} {:>8}".format("stage", "seconds", "count")]
+        stages = self.total().stages
+        for name in sorted(stages, key=lambda n: -stages[n][0]):
+            seconds, count = stages[name]
+            lines.append("{:<32} {:>10.3f} {:>8}".format(name, seconds, int(count)))
+
+        def article_time(path):
+            return self.articles[path]["timings"].stages.get("article", [0.0])[0]
+
+        slowest = sorted(self.articles, key=lambda p: -article_time(p))[:top]
+        if len(slowest) > 0:
+            lines.append("")
+            lines.append("slowest markdowns:")
+            for path in slowest:
+                lines.append("{:>10.3f} {}".format(article_time(path), path))
+
+        return lines
+
+
+class ProfileHook(object):
+    """
+    A stage hook that profiles the stages named ``stage`` or ``<stage>:*`` with cProfile.
+
+    Usage::
+
+        hook = ProfileHook("convert")
+        add_stage_hook(hook)
+        ...
+        hook.profiler.dump_stats("convert.prof")
+    """
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.profiler = cProfile.Profile()
+        self.depth = 0
+
+    def match(self, name: str) -> bool:
+        return name == self.stage or name.startswith(self.stage + ":")
+
+    @contextmanager
+    def __call__(self, name: str) -> Iterator[None]:
+        if not self.match(name):
+            yield
+            return
+
+        # Only the outermost matching stage enables profiler, nested ones are already profiled.
+        self.depth += 1
+        if self.depth == 1:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
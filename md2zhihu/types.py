@@ -12,7 +12,7 @@ from typing import Union
 from typing_extensions import TypeAlias
 
 # AST node types
-ASTNode: TypeAlias = Dict[str, Any]
+ASTNode: TypeAlias = Dict[str, Any]  # or a compact `parser.node.Node` that behaves like a dict
 ASTNodes: TypeAlias = List[ASTNode]
 
 # Reference dictionary: {ref_id: url}
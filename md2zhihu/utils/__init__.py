@@ -4,12 +4,17 @@ import hashlib
 import logging
 import os
 import re
+import uuid
 from typing import List
 
 from k3handy import to_bytes
 
 logger = logging.getLogger(__name__)
 
+http_url_regex = re.compile(r"https?://")
+
+non_fn_chars_regex = re.compile(r"[^a-zA-Z0-9_\-=]+")
+
 
 def sj(*args) -> str:
     return "".join([str(x) for x in args])
@@ -46,21 +51,53 @@ def add_paragraph_end(lines: List[str]) -> List[str]:
 
 def strip_paragraph_end(lines: List[str]) -> List[str]:
     #  remove last blank lines
-    if lines[-1] == "":
-        return strip_paragraph_end(lines[:-1])
+    end = len(lines)
+    while end > 0 and lines[end - 1] == "":
+        end -= 1
 
-    return lines
+    if end == len(lines):
+        return lines
+
+    return lines[:end]
 
 
 def asset_fn(text: str, suffix: str) -> str:
     textmd5 = hashlib.md5(to_bytes(text)).hexdigest()
-    escaped = re.sub(r"[^a-zA-Z0-9_\-=]+", "", text)
+    escaped = non_fn_chars_regex.sub("", text)
     fn = escaped[:32] + "-" + textmd5[:16] + "." + suffix
     return fn
 
 
+def is_in_dir(path: str, d: str) -> bool:
+    """
+    Return True if ``path`` is ``d`` or in ``d``, after resolving symbolic links.
+    """
+    path = os.path.realpath(path)
+    d = os.path.realpath(d)
+    return os.path.commonpath([path, d]) == d
+
+
 def fwrite(*p) -> None:
     cont = p[-1]
     p = p[:-1]
     with open(os.path.join(*p), "wb") as f:
         f.write(cont)
+
+
+def fwrite_atomic(path: str, data: bytes) -> None:
+    """
+    Write ``data`` to a temp file in the same dir then rename it to ``path``,
+    thus ``path`` is never seen partially written.
+
+    The file is created with ``open()``, its mode is ``0o666`` masked by umask,
+    unlike a file created by ``tempfile.mkstemp()``, which is readable only by the owner.
+    """
+    tmp = os.path.join(os.path.dirname(path) or ".", ".tmp-" + uuid.uuid4().hex)
+    try:
+        with open(tmp, "xb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,203 @@
+"""Detect changes of the files markdowns depend on"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from ..utils import msg
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# Editors often save a file by writing a temp file then renaming it,
+# thus creating, moving and deleting are watched as well as writing.
+inotify_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+inotify_event = struct.Struct("iIII")
+
+FileStat = Optional[Tuple[int, int]]
+
+
+def file_stat(path: str) -> FileStat:
+    """
+    Return ``(mtime_ns, size)`` of ``path``, or None if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class PollWatcher(object):
+    """
+    Detect changed files by comparing mtime and size of every watched file every ``interval`` seconds.
+    """
+
+    def __init__(self, interval: float = 0.2) -> None:
+        self.interval = interval
+
+        # abspath -> stat when last checked
+        self.stats: Dict[str, FileStat] = {}
+
+    def watch(self, paths: Iterable[str]) -> None:
+        """
+        Replace the watched files with ``paths``.
+        """
+        stats = {}
+        for p in paths:
+            p = os.path.abspath(p)
+            stats[p] = self.stats[p] if p in self.stats else file_stat(p)
+        self.stats = stats
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Block until some watched files change or ``timeout`` seconds passed.
+
+        :return: absolute paths of changed files, empty if timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            changed = set()
+            for p, st in self.stats.items():
+                new = file_stat(p)
+                if new != st:
+                    self.stats[p] = new
+                    changed.add(p)
+
+            if len(changed) > 0:
+                return changed
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+            time.sleep(self.interval)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detect changed files with Linux inotify, without polling.
+
+    The dirs containing the watched files are watched instead of the files,
+    so that a file replaced by renaming is still watched.
+    Events arriving within ``quiet`` seconds after one another are reported together.
+    """
+
+    def __init__(self, quiet: float = 0.05) -> None:
+        self.quiet = quiet
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.paths: Set[str] = set()
+
+        # watch descriptor -> dir, and dir -> watch descriptor
+        self.wds: Dict[int, str] = {}
+        self.dirs: Dict[str, int] = {}
+
+    def watch(self, paths: Iterable[str]) -> None:
+        """
+        Replace the watched files with ``paths``.
+        """
+        self.paths = set([os.path.abspath(p) for p in paths])
+
+        dirs = set([os.path.dirname(p) for p in self.paths])
+
+        for d in set(self.dirs) - dirs:
+            self._rm_watch(self.fd, self.dirs[d])
+            del self.wds[self.dirs.pop(d)]
+
+        for d in dirs - set(self.dirs):
+            wd = self._add_watch(self.fd, os.fsencode(d), inotify_mask)
+            if wd < 0:
+                # The dir does not exist, e.g., a refs file is not created yet.
+                continue
+            self.wds[wd] = d
+            self.dirs[d] = wd
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Block until some watched files change or ``timeout`` seconds passed.
+
+        :return: absolute paths of changed files, empty if timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        changed: Set[str] = set()
+        while True:
+            if len(changed) > 0:
+                t = self.quiet
+            elif deadline is None:
+                t = None
+            else:
+                t = max(0.0, deadline - time.monotonic())
+
+            readable, _, _ = select.select([self.fd], [], [], t)
+            if len(readable) == 0:
+                return changed
+
+            changed.update(self._read())
+
+    def _read(self) -> Set[str]:
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        i = 0
+        while i < len(buf):
+            wd, _, _, size = inotify_event.unpack_from(buf, i)
+            i += inotify_event.size
+            name = buf[i : i + size].rstrip(b"\0")
+            i += size
+
+            d = self.wds.get(wd)
+            if d is None:
+                continue
+
+            p = os.path.join(d, os.fsdecode(name))
+            if p in self.paths:
+                changed.add(p)
+
+        return changed
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def new_watcher(interval: float = 0.2):
+    """
+    Return an ``InotifyWatcher`` if inotify is supported, otherwise a ``PollWatcher`` polling every ``interval`` seconds.
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        msg("inotify is not available: ", repr(e), ", poll every ", interval, " seconds")
+        return PollWatcher(interval)
@@ -1,8 +1,17 @@
+import argparse
+import contextlib
 import glob
+import http.client
+import http.server
+import json
 import os
 import re
+import stat
+import threading
+import time
 import unittest
 
+import k3down2
 import k3fs
 import k3git
 import k3proc
@@ -15,8 +24,16 @@ from k3handy import pjoin
 from skimage.metrics import structural_similarity
 
 import md2zhihu
+import md2zhihu.asset
+import md2zhihu.cli
 import md2zhihu.config.asset_reop
 import md2zhihu.config.local_repo
+import md2zhihu.converters
+import md2zhihu.converters.browser
+import md2zhihu.parser
+import md2zhihu.renderer.dispatch
+import md2zhihu.serve
+import md2zhihu.watch
 
 dd = k3ut.dd
 
@@ -551,6 +568,984 @@ class TestMd2zhihu(unittest.TestCase):
         k3fs.remove(d, "foo", onerror="ignore")
         k3fs.remove(d, "dst2", onerror="ignore")
 
+    def test_option_jobs(self):
+        self._test_platform_no_push("transparent", "transparent.md", ["-p", "transparent", "--jobs", "2"])
+
+    def test_convert_all_collect_failures(self):
+        d = "test/data/transparent"
+        out = pjoin(d, "dst")
+        k3fs.remove(out, onerror="ignore")
+
+        parser_config = md2zhihu.ParserConfig(True, [])
+        good = md2zhihu.Config(pjoin(d, "src/transparent.md"), "transparent", out, out, md_output_path=out + "/")
+        # A dir can not be read as a markdown
+        bad = md2zhihu.Config(pjoin(d, "src/assets"), "transparent", out, out, md_output_path=out + "/")
+
+        for jobs in (1, 2):
+            stat, failures = md2zhihu.cli.convert_all(parser_config, [bad, good], jobs=jobs)
+
+            self.assertEqual([[good.src_path, pjoin(out, "transparent.md")]], stat, jobs)
+            self.assertEqual([bad.src_path], [path for path, _ in failures], jobs)
+            self.assertIsInstance(failures[0][1], IsADirectoryError, jobs)
+
+            k3fs.remove(out, onerror="ignore")
+
+    def test_timings(self):
+        d = "test/data/transparent"
+        out = pjoin(d, "dst")
+        k3fs.remove(out, onerror="ignore")
+
+        parser_config = md2zhihu.ParserConfig(True, [], timing=True)
+        conf = md2zhihu.Config(pjoin(d, "src/transparent.md"), "transparent", out, out, md_output_path=out + "/", timing=True)
+
+        stages = []
+
+        @contextlib.contextmanager
+        def hook(name):
+            stages.append(name)
+            yield
+
+        md2zhihu.add_stage_hook(hook)
+        try:
+            report = md2zhihu.TimingReport()
+            md2zhihu.cli.convert_all(parser_config, [conf], report=report)
+        finally:
+            md2zhihu.remove_stage_hook(hook)
+
+        # Parsing and transforms are timed apart from the article, but hooked in it
+        self.assertEqual(["article", "parse"], stages[:2])
+        self.assertIn("transform:embed", stages)
+        self.assertEqual(["render", "asset:copy"], [s for s in stages[2:] if not s.startswith("transform:")])
+
+        got = report.to_dict()
+        article = got["articles"][conf.md_output_path]
+        self.assertEqual("transparent", article["platform"])
+        self.assertEqual(
+            ["article", "asset:copy", "parse", "render", "transform:embed"],
+            [k for k in sorted(article["stages"]) if not k.startswith("transform:") or k == "transform:embed"],
+        )
+        self.assertEqual(1, article["stages"]["asset:copy"]["count"])
+        self.assertEqual(got["total"], article["stages"])
+        self.assertIn(conf.md_output_path, report.summary()[-1])
+
+        # Disabled timings record nothing
+
+        t = md2zhihu.Timings(enabled=False)
+        with t.stage("foo"):
+            pass
+        self.assertEqual({}, t.to_dict())
+
+        k3fs.remove(out, onerror="ignore")
+
+    def test_convert_queue(self):
+        self.assertEqual("svg", md2zhihu.converters.queue.intermediate_type("mermaid"))
+        self.assertEqual("html", md2zhihu.converters.queue.intermediate_type("code"))
+        self.assertEqual("jpg", md2zhihu.converters.queue.intermediate_type("graphviz"))
+        self.assertIsNone(md2zhihu.converters.queue.intermediate_type("html"))
+
+        d = "test/data/convert-queue"
+        k3fs.remove(d, onerror="ignore")
+
+        conf = md2zhihu.Config("foo.md", "zhihu", d, d, md_output_path=d + "/")
+        os.makedirs(conf.asset_output_dir)
+        conf.convert_queue = md2zhihu.ConvertQueue(4)
+        mdr = md2zhihu.MDRender(conf, {})
+
+        rendered = []
+
+        def render(data):
+            def f():
+                rendered.append(data)
+                return data
+
+            return f
+
+        # The image tag is returned at once, the image is written when the queue runs
+
+        got = md2zhihu.converters.typ_text_to_jpg(mdr, "mermaid", "a", render=render(b"a"))
+        md2zhihu.converters.typ_text_to_jpg(mdr, "mermaid", "b", render=render(b"b"))
+        md2zhihu.converters.typ_text_to_jpg(mdr, "mermaid", "a", render=render(b"a"))
+
+        fn = md2zhihu.asset_fn("a", "jpg")
+        self.assertEqual(["![](foo/" + fn + ")", ""], got)
+        self.assertFalse(os.path.exists(pjoin(conf.asset_output_dir, fn)))
+
+        conf.convert_queue.run()
+        self.assertEqual([b"a", b"b"], rendered)
+        self.assertEqual(b"a", k3fs.fread(conf.asset_output_dir, fn, mode="b"))
+        self.assertEqual([], conf.convert_queue.queued)
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_find_mermaid_js(self):
+        d = "test/data/mermaid-js"
+        k3fs.remove(d, onerror="ignore")
+
+        self.assertIsNone(md2zhihu.converters.browser.find_mermaid_js([d]))
+
+        os.makedirs(pjoin(d, "@mermaid-js/mermaid-cli/node_modules/mermaid/dist"))
+        k3fs.fwrite(d, "@mermaid-js/mermaid-cli/node_modules/mermaid/dist/mermaid.min.js", "")
+        self.assertEqual(
+            pjoin(d, "@mermaid-js/mermaid-cli/node_modules/mermaid/dist/mermaid.min.js"),
+            md2zhihu.converters.browser.find_mermaid_js(["test/data/nonexistent", d]),
+        )
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_render_cache(self):
+        d = "test/data/render-cache"
+        k3fs.remove(d, onerror="ignore")
+
+        rc = md2zhihu.RenderCache(pjoin(d, "cache"))
+
+        k = rc.key("code", "x = 1", "jpg", {"html": {"width": 1000}})
+        self.assertEqual(k, rc.key("code", "x = 1", "jpg", {"html": {"width": 1000}}))
+        self.assertNotEqual(k, rc.key("code", "x = 2", "jpg", {"html": {"width": 1000}}))
+        self.assertNotEqual(k, rc.key("code", "x = 1", "jpg", {"html": {"width": 600}}))
+        self.assertNotEqual(k, rc.key("graphviz", "x = 1", "jpg", {"html": {"width": 1000}}))
+
+        # A hit copies the cached image to asset dir and skips the converter
+
+        conf = md2zhihu.Config("foo.md", "zhihu", d, d, md_output_path=d + "/", cache_dir=pjoin(d, "cache"))
+        os.makedirs(conf.asset_output_dir)
+
+        txt = "graph LR\n    A --> B\n"
+        umask = os.umask(0o022)
+        try:
+            rc.put(rc.key("mermaid", txt, "jpg"), "jpg", b"cached-jpg")
+        finally:
+            os.umask(umask)
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(rc.path(rc.key("mermaid", txt, "jpg"), "jpg")).st_mode))
+
+        got = md2zhihu.converters.typ_text_to_jpg(md2zhihu.MDRender(conf, {}), "mermaid", txt)
+
+        fn = md2zhihu.asset_fn(txt, "jpg")
+        self.assertEqual(["![](foo/" + fn + ")", ""], got)
+        self.assertEqual(b"cached-jpg", k3fs.fread(conf.asset_output_dir, fn, mode="b"))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_incremental(self):
+        d = "test/data/incremental"
+        k3fs.remove(d, onerror="ignore")
+
+        src = pjoin(d, "src")
+        out = pjoin(d, "dst")
+        os.makedirs(d)
+        cmdx("cp", "-R", "test/data/transparent/src", src)
+
+        parser_config = md2zhihu.ParserConfig(True, [r"[.]md$"])
+
+        def new_conf():
+            return md2zhihu.Config(pjoin(src, "transparent.md"), "transparent", out, out, md_output_path=out + "/")
+
+        # First build records dependencies and outputs
+
+        manifest = md2zhihu.Manifest(out)
+        stat, failures = md2zhihu.cli.convert_all(parser_config, [new_conf()], manifest=manifest)
+        manifest.save()
+
+        self.assertEqual([], failures)
+        entry = manifest.articles[pabs(out, "transparent.md")]
+        self.assertEqual(
+            [pabs(src, "assets/slim.jpg"), pabs(src, "transparent.md")],
+            sorted(entry["deps"].keys()),
+        )
+        self.assertEqual(pabs(src, "transparent.md"), entry["src_path"])
+        self.assertEqual(pabs(out, "transparent.md"), entry["md_output_path"])
+        self.assertEqual(1, len(entry["assets"]))
+        asset = entry["assets"][0]
+
+        # Nothing changed
+
+        manifest = md2zhihu.Manifest(out)
+        self.assertTrue(manifest.is_up_to_date(parser_config, new_conf()))
+
+        # Changed option
+
+        conf = new_conf()
+        conf.keep_meta = True
+        self.assertFalse(manifest.is_up_to_date(parser_config, conf))
+
+        # Changed image
+
+        k3fs.fwrite(src, "assets/slim.jpg", "changed")
+        self.assertFalse(manifest.is_up_to_date(parser_config, new_conf()))
+
+        # Rebuild removes the stale asset
+
+        md2zhihu.cli.convert_all(parser_config, [new_conf()], manifest=manifest)
+        new_asset = manifest.articles[pabs(out, "transparent.md")]["assets"][0]
+        self.assertNotEqual(asset, new_asset)
+        self.assertFalse(os.path.exists(asset))
+        self.assertTrue(os.path.exists(new_asset))
+
+        # Deleted markdown
+
+        k3fs.remove(src, "transparent.md")
+        manifest.gc()
+        self.assertEqual({}, manifest.articles)
+        self.assertFalse(os.path.exists(pjoin(out, "transparent.md")))
+        self.assertFalse(os.path.exists(new_asset))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_multi_platform(self):
+        d = "test/data/multi-platform"
+        k3fs.remove(d, onerror="ignore")
+
+        src = pjoin(d, "src")
+        os.makedirs(src)
+        cmdx("cp", "-R", "test/data/transparent/src/assets", src)
+        k3fs.fwrite(
+            src,
+            "foo.md",
+            "\n".join(
+                [
+                    "---",
+                    "platform_refs:",
+                    "    github:",
+                    '        - "home": https://github.com',
+                    "    transparent:",
+                    '        - "home": https://example.com',
+                    "---",
+                    "",
+                    "Go [home][] $x = y$",
+                    "",
+                    "![](assets/slim.jpg)",
+                    "",
+                ]
+            ),
+        )
+
+        parser_config = md2zhihu.ParserConfig(True, [])
+        platforms = ["transparent", "github"]
+
+        def new_conf(platform, out):
+            return md2zhihu.Config(
+                pjoin(src, "foo.md"), platform, out, pjoin(out, platform), md_output_path=out + "/" + platform + "/"
+            )
+
+        # Parse once and render to every platform
+
+        confs = [new_conf(p, pjoin(d, "all")) for p in platforms]
+        stat, failures = md2zhihu.cli.convert_all(parser_config, confs)
+        self.assertEqual([], failures)
+        self.assertEqual([[c.src_path, c.md_output_path] for c in confs], stat)
+
+        # Same as converting to each platform separately
+
+        for p in platforms:
+            conf = new_conf(p, pjoin(d, "one"))
+            md2zhihu.cli.convert_all(parser_config, [conf])
+            self.assertEqual(
+                k3fs.fread(d, "one", p, "foo.md"),
+                k3fs.fread(d, "all", p, "foo.md"),
+            )
+            self.assertEqual(sorted(os.listdir(pjoin(d, "one", p, "foo"))), sorted(os.listdir(pjoin(d, "all", p, "foo"))))
+
+        self.assertIn("https://github.com", k3fs.fread(d, "all/github/foo.md"))
+        self.assertIn("https://example.com", k3fs.fread(d, "all/transparent/foo.md"))
+
+        self.assertEqual(["zhihu", "github"], md2zhihu.cli.platform_list("zhihu, github,zhihu"))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            md2zhihu.cli.platform_list("zhihu,foo")
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_prerender_math(self):
+        parser_config = md2zhihu.ParserConfig(False, [])
+        conf = md2zhihu.Config("foo.md", "zhihu", "output_foo", "output_asset_dir", md_output_path="output_md")
+
+        article = md2zhihu.Article(parser_config, conf, "$n$ and $n$ and $m$\n\n- $n$\n\n$$\nx = 1\n$$\n")
+
+        mdr = md2zhihu.MDRender(conf, features=conf.features)
+        md2zhihu.converters.prerender_math(mdr, article.ast)
+
+        self.assertEqual(
+            [
+                ("tex_block", "\nx = 1\n", "imgtag"),
+                # A formula that is the only content of a paragraph is a block
+                ("tex_block", "n", "imgtag"),
+                ("tex_inline", "m", "imgtag"),
+                ("tex_inline", "n", "imgtag"),
+            ],
+            sorted(conf.math_table.rendered.keys()),
+        )
+        self.assertEqual(
+            k3down2.convert("tex_inline", "n", "imgtag"),
+            conf.math_table.rendered[("tex_inline", "n", "imgtag")],
+        )
+
+        # Rendering only looks up the table
+
+        conf.math_table.rendered[("tex_inline", "n", "imgtag")] = "<N>"
+        got = "\n".join(article.render())
+        self.assertIn("<N> and <N> and", got)
+
+        # Math is rendered in batch for a platform that handles other nodes with "*" too
+
+        conf = md2zhihu.Config("foo.md", "weibo", "output_foo", "output_asset_dir", md_output_path="output_md")
+        article = md2zhihu.Article(parser_config, conf, "$n$ and $m$\n\n$$\nx = 1\n$$\n")
+
+        mdr = md2zhihu.MDRender(conf, features=conf.features)
+        md2zhihu.converters.prerender_math(mdr, article.ast)
+
+        self.assertEqual(
+            [
+                ("tex_block", "\nx = 1\n", "imgtag"),
+                ("tex_inline", "m", "plain"),
+                ("tex_inline", "n", "plain"),
+            ],
+            sorted(conf.math_table.rendered.keys()),
+        )
+
+    def test_prefetch_remote_images(self):
+        d = "test/data/prefetch"
+        k3fs.remove(d, onerror="ignore")
+
+        requested = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requested.append(self.path)
+                if self.path.startswith("/missing"):
+                    self.send_error(404)
+                    return
+
+                body = b"img:" + self.path.encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        th = threading.Thread(target=srv.serve_forever, daemon=True)
+        th.start()
+
+        try:
+            base = "http://127.0.0.1:%d" % srv.server_address[1]
+
+            parser_config = md2zhihu.ParserConfig(False, [])
+            conf = md2zhihu.Config("foo.md", "zhihu", d, d, md_output_path=d + "/", download=True)
+            os.makedirs(conf.asset_output_dir)
+
+            md = "![](%s/a.png)\n\n![](%s/b.png?x=1)\n\n- ![](%s/a.png)\n" % (base, base, base)
+            article = md2zhihu.Article(parser_config, conf, md)
+
+            mdr = md2zhihu.MDRender(conf, features=conf.features)
+            md2zhihu.asset.prefetch_remote_images(mdr, article.ast)
+
+            self.assertEqual(["/a.png", "/b.png?x=1"], sorted(requested))
+
+            fn_a = md2zhihu.asset.remote_image_fn(base + "/a.png")
+            self.assertEqual(b"img:/a.png", k3fs.fread(conf.asset_output_dir, fn_a, mode="b"))
+
+            # Rendering only rewrites url
+
+            got = "\n".join(article.render())
+            self.assertEqual(2, len(requested))
+            self.assertIn("![](foo/" + fn_a + ")", got)
+
+            # The connection pool is as large as the concurrent downloads
+
+            conf = md2zhihu.Config("foo.md", "zhihu", d, d, md_output_path=d + "/", download=True, download_jobs=16)
+            article = md2zhihu.Article(parser_config, conf, "![](%s/e.png)\n" % base)
+            md2zhihu.asset.prefetch_remote_images(md2zhihu.MDRender(conf, features=conf.features), article.ast)
+
+            pool = md2zhihu.asset.http_pool()
+            self.assertGreaterEqual(pool.connection_pool_kw["maxsize"], 16)
+            self.assertIs(pool, md2zhihu.asset.http_pool(4))
+
+            # Images in a table converted to jpg are not downloaded
+
+            conf = md2zhihu.Config("foo.md", "weibo", d, d, md_output_path=d + "/", download=True)
+            md = "![](%s/c.png)\n\n| a |\n| - |\n| ![](%s/d.png) |\n" % (base, base)
+            article = md2zhihu.Article(parser_config, conf, md)
+
+            mdr = md2zhihu.MDRender(conf, features=conf.features)
+            article.prerender(mdr)
+            self.assertEqual(["/a.png", "/b.png?x=1", "/c.png", "/e.png"], sorted(requested))
+
+            # Failure to download
+
+            article = md2zhihu.Article(parser_config, conf, "![](%s/missing.png)\n" % base)
+            with self.assertRaisesRegex(Exception, "Failure to download"):
+                md2zhihu.asset.prefetch_remote_images(mdr, article.ast)
+        finally:
+            srv.shutdown()
+            srv.server_close()
+            k3fs.remove(d, onerror="ignore")
+
+    def test_local_image_placing(self):
+        d = "test/data/placing"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(d)
+
+        src = pjoin(d, "a.jpg")
+        k3fs.fwrite(src, "abc")
+
+        self.assertEqual("900150983cd24fb0d6963f7d28e17f72", md2zhihu.asset.file_md5(src))
+
+        # A changed file replaces its cached digest
+        n = len(md2zhihu.asset._digests)
+        k3fs.fwrite(src, "abcd")
+        self.assertEqual("e2fc714c4727ee9395f324cd2e7f331f", md2zhihu.asset.file_md5(src))
+        self.assertEqual(n, len(md2zhihu.asset._digests))
+        k3fs.fwrite(src, "abc")
+
+        for mode in ("copy", "hardlink", "reflink"):
+            target = pjoin(d, mode + ".jpg")
+            md2zhihu.asset.place_file(src, target, mode)
+            self.assertEqual("abc", k3fs.fread(target))
+
+            same_inode = os.stat(src).st_ino == os.stat(target).st_ino
+            self.assertEqual(mode == "hardlink", same_inode)
+
+        # Convert with hardlink
+
+        out = pjoin(d, "dst")
+        conf = md2zhihu.Config(
+            "test/data/transparent/src/transparent.md",
+            "transparent",
+            out,
+            out,
+            md_output_path=out + "/",
+            asset_link="hardlink",
+        )
+        md2zhihu.cli.convert_md(md2zhihu.ParserConfig(True, []), conf)
+
+        self.assertEqual(1, len(conf.assets))
+        target = list(conf.assets)[0]
+        self.assertEqual(
+            os.stat("test/data/transparent/src/assets/slim.jpg").st_ino,
+            os.stat(target).st_ino,
+        )
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_article_write(self):
+        d = "test/data/article-write"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(d)
+
+        conf = md2zhihu.Config(
+            "test/data/transparent/src/transparent.md",
+            "transparent",
+            d,
+            d,
+            md_output_path=d + "/",
+            keep_meta=True,
+        )
+        os.makedirs(conf.asset_output_dir)
+        parser_config = md2zhihu.ParserConfig(True, [])
+        md_text = k3fs.fread(conf.src_path)
+
+        want = "\n".join(md2zhihu.Article(parser_config, conf, md_text).render())
+
+        path = pjoin(d, "out.md")
+        md2zhihu.Article(parser_config, conf, md_text).write(path)
+
+        self.assertEqual(want, k3fs.fread(path))
+        self.assertEqual(["out.md"], sorted([x for x in os.listdir(d) if x.endswith(".md") or ".tmp" in x]))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_new_parser_reused(self):
+        parse = md2zhihu.parser.new_parser()
+        self.assertIs(parse, md2zhihu.parser.new_parser())
+
+        # A parser is not shared between threads
+        other = []
+        th = threading.Thread(target=lambda: other.append(md2zhihu.parser.new_parser()))
+        th.start()
+        th.join()
+        self.assertIsNot(parse, other[0])
+
+        # A link definition does not leak into the next parse
+        got = parse("[a]: http://a.com\n\n[a]\n")
+        self.assertEqual("link", got[0]["children"][0]["type"])
+
+        got = parse("[a]\n")
+        self.assertEqual([{"type": "paragraph", "children": [{"type": "text", "text": "[a]"}]}], got)
+
+    def test_parser_config_is_embed(self):
+        pc = md2zhihu.ParserConfig(True, [r"[.]md$", r"^snippets/"])
+        self.assertEqual(1, len(pc.embed_regexes))
+        self.assertTrue(pc.is_embed("a/b.md"))
+        self.assertTrue(pc.is_embed("snippets/footer.txt"))
+        self.assertFalse(pc.is_embed("a/b.jpg"))
+
+        # Global flags can not be combined into one regex
+        pc = md2zhihu.ParserConfig(True, [r"(?i)[.]MD$", r"^snippets/"])
+        self.assertTrue(pc.is_embed("a/b.md"))
+        self.assertTrue(pc.is_embed("snippets/footer.txt"))
+        self.assertFalse(pc.is_embed("a/b.jpg"))
+
+        pc = md2zhihu.ParserConfig(True, [])
+        self.assertFalse(pc.is_embed("a/b.md"))
+
+    def test_load_external_refs(self):
+        d = "test/data/ext-refs"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(d)
+
+        k3fs.fwrite(d, "refs.yml", "\n".join(["universal:", '  - "a": http://a', "zhihu:", '  - "b": http://b', ""]))
+
+        def load(platform):
+            conf = md2zhihu.Config("foo.md", platform, d, d, md_output_path=d + "/", ref_files=[pjoin(d, "refs.yml")])
+            return md2zhihu.load_external_refs(conf)
+
+        zhihu = load("zhihu")
+        self.assertEqual({"a": "http://a", "b": "http://b"}, dict(zhihu))
+        self.assertEqual({"a": "http://a"}, dict(load("github")))
+
+        # Shared and read-only
+        self.assertIs(zhihu, load("zhihu"))
+        with self.assertRaises(TypeError):
+            zhihu["c"] = "http://c"  # type: ignore
+
+        # A changed refs file is loaded again and replaces the stale entries
+        n_files = len(md2zhihu.parser.extract.refs._ref_files)
+        n_merged = len(md2zhihu.parser.extract.refs._merged_refs)
+
+        k3fs.fwrite(d, "refs.yml", "\n".join(["universal:", '  - "a": http://aa', ""]))
+        self.assertEqual({"a": "http://aa"}, dict(load("zhihu")))
+        self.assertEqual({"a": "http://aa"}, dict(load("github")))
+
+        self.assertEqual(n_files, len(md2zhihu.parser.extract.refs._ref_files))
+        self.assertEqual(n_merged, len(md2zhihu.parser.extract.refs._merged_refs))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_embed_parse_cache(self):
+        d = "test/data/embed-cache"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(pjoin(d, "snippets"))
+
+        k3fs.fwrite(d, "snippets/footer.md", "See [home][] and [x](../x.html)\n\n[home]: https://example.com\n")
+        k3fs.fwrite(d, "a.md", "# A\n\n![](snippets/footer.md)\n\n![](snippets/footer.md)\n")
+
+        parser_config = md2zhihu.ParserConfig(True, [r"[.]md$"])
+        conf = md2zhihu.Config(pjoin(d, "a.md"), "transparent", d, d, md_output_path=d + "/")
+
+        # The footer is parsed once, every embed gets its own copy of ast
+        article = md2zhihu.Article(parser_config, conf, k3fs.fread(d, "a.md"))
+        self.assertEqual(1, len(parser_config.parse_cache.parsed))
+        self.assertEqual(
+            [
+                "# A",
+                "",
+                "See [home](https://example.com) and [x](x.html)",
+                "",
+                "See [home](https://example.com) and [x](x.html)",
+                "",
+            ],
+            article.render()[:6],
+        )
+        self.assertEqual({"home": "https://example.com"}, article.used_refs)
+
+        # A changed footer is parsed again and replaces the stale entry
+        k3fs.fwrite(d, "snippets/footer.md", "Bye\n")
+        article = md2zhihu.Article(parser_config, conf, k3fs.fread(d, "a.md"))
+        self.assertEqual(1, len(parser_config.parse_cache.parsed))
+        self.assertEqual(["# A", "", "Bye", "", "Bye", ""], article.render()[:6])
+
+        # Embed cycle
+        k3fs.fwrite(d, "snippets/footer.md", "![](b.md)\n")
+        k3fs.fwrite(d, "snippets/b.md", "![](footer.md)\n")
+        with self.assertRaises(ValueError) as ctx:
+            md2zhihu.Article(parser_config, conf, k3fs.fread(d, "a.md"))
+        self.assertIn("footer.md -> ", str(ctx.exception))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_watcher(self):
+        d = "test/data/watcher"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(d)
+
+        path = pjoin(d, "a.md")
+        k3fs.fwrite(path, "a")
+
+        for watcher in (md2zhihu.watch.PollWatcher(0.01), md2zhihu.watch.new_watcher()):
+            watcher.watch([path])
+            self.assertEqual(set(), watcher.wait(0.05))
+
+            k3fs.fwrite(path, k3fs.fread(path) + "a")
+            self.assertEqual({os.path.abspath(path)}, watcher.wait(5))
+            watcher.close()
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_watch_all(self):
+        d = "test/data/watch-all"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(pjoin(d, "snippets"))
+
+        k3fs.fwrite(d, "snippets/footer.md", "Hi\n")
+        k3fs.fwrite(d, "a.md", "# A\n\n![](snippets/footer.md)\n")
+        k3fs.fwrite(d, "b.md", "# B\n")
+
+        footer = os.path.abspath(pjoin(d, "snippets/footer.md"))
+        out = pjoin(d, "out")
+
+        class Watcher(object):
+            def __init__(self):
+                self.watched = []
+
+            def watch(self, paths):
+                self.watched = paths
+
+            def wait(self):
+                os.remove(pjoin(out, "b.md"))
+                k3fs.fwrite(footer, "Bye\n")
+                return {footer}
+
+            def close(self):
+                pass
+
+        parser_config = md2zhihu.ParserConfig(True, [r"[.]md$"])
+        confs = [md2zhihu.Config(pjoin(d, fn), "transparent", out, out, md_output_path=out + "/") for fn in ("a.md", "b.md")]
+
+        watcher = Watcher()
+        md2zhihu.cli.watch_all(parser_config, confs, md2zhihu.Manifest(out, load=False), watcher=watcher, rounds=1)
+
+        self.assertIn(footer, watcher.watched)
+
+        # Only the markdown embedding the changed file is built again
+        self.assertTrue(k3fs.fread(out, "a.md").startswith("# A\n\nBye\n"))
+        self.assertFalse(os.path.exists(pjoin(out, "b.md")))
+
+        # A file changed while building is built again at once, without waiting for another change
+
+        class NoWait(Watcher):
+            def wait(self):
+                raise AssertionError("a change while building is missed")
+
+        edits = []
+
+        @contextlib.contextmanager
+        def edit_in_render(name):
+            if name == "render" and len(edits) == 0:
+                edits.append(name)
+                time.sleep(0.01)
+                k3fs.fwrite(footer, "Again\n")
+            yield
+
+        confs = [md2zhihu.Config(pjoin(d, "a.md"), "transparent", out, out, md_output_path=out + "/")]
+        md2zhihu.add_stage_hook(edit_in_render)
+        try:
+            md2zhihu.cli.watch_all(parser_config, confs, md2zhihu.Manifest(out, load=False), watcher=NoWait(), rounds=1)
+        finally:
+            md2zhihu.remove_stage_hook(edit_in_render)
+
+        self.assertEqual(["render"], edits)
+        self.assertTrue(k3fs.fread(out, "a.md").startswith("# A\n\nAgain\n"))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_serve(self):
+        d = "test/data/serve"
+        k3fs.remove(d, onerror="ignore")
+
+        converter = md2zhihu.Converter(d)
+        server = md2zhihu.serve.new_server(converter, port=0)
+        th = threading.Thread(target=server.serve_forever, daemon=True)
+        th.start()
+
+        def post(path, req):
+            host, port = server.server_address[:2]
+            conn = http.client.HTTPConnection(host, port)
+            conn.request("POST", path, json.dumps(req))
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read())
+
+        try:
+            # Concurrent requests are converted one at a time, every request gets its own result
+
+            results = [None] * 8
+
+            def convert(i):
+                results[i] = post(
+                    "/convert",
+                    {"markdown": "# T%d\n\nsee [a][]\n\n[a]: https://a/%d\n" % (i, i), "platform": "transparent"},
+                )
+
+            ths = [threading.Thread(target=convert, args=(i,)) for i in range(len(results))]
+            for t in ths:
+                t.start()
+            for t in ths:
+                t.join()
+
+            for i, (status, rst) in enumerate(results):
+                self.assertEqual(200, status)
+                self.assertTrue(rst["markdown"].startswith("# T%d\n\nsee [a](https://a/%d)\n" % (i, i)))
+                self.assertEqual([], rst["assets"])
+
+            status, rst = post("/convert", {"platform": "transparent"})
+            self.assertEqual(400, status)
+            self.assertIn("markdown", rst["error"])
+
+            status, rst = post("/convert", {"markdown": "", "platform": "foo"})
+            self.assertEqual(400, status)
+
+            # Files out of root can not be read
+
+            root = os.path.abspath(".")
+            for req in (
+                {"markdown": "", "path": "../foo.md"},
+                {"markdown": "", "refs": ["/etc/passwd"]},
+                {"markdown": "", "md_output": "/tmp/"},
+                {"markdown": "![](../../etc/hostname)\n"},
+                {"markdown": "![](/../etc/foo.md)\n"},
+            ):
+                status, rst = post("/convert", dict(req, platform="transparent"))
+                self.assertEqual(400, status, req)
+                self.assertIn("path is not in " + repr(root), rst["error"], req)
+        finally:
+            server.shutdown()
+            server.server_close()
+            converter.close()
+
+        k3fs.remove(d, onerror="ignore")
+
+        # No authentication, thus only loopback addresses are allowed
+        with self.assertRaisesRegex(ValueError, "loopback"):
+            md2zhihu.serve.new_server(converter, host="0.0.0.0", port=0)
+
+        # Only a stale socket is replaced
+        os.makedirs(d)
+        sock_path = pjoin(d, "sock")
+        k3fs.fwrite(sock_path, "not a socket")
+        with self.assertRaisesRegex(ValueError, "not a socket"):
+            md2zhihu.serve.new_server(converter, socket_path=sock_path)
+        self.assertEqual("not a socket", k3fs.fread(sock_path))
+
+        os.remove(sock_path)
+        for _ in range(2):
+            server = md2zhihu.serve.new_server(converter, socket_path=sock_path)
+            server.server_close()
+        self.assertTrue(os.path.exists(sock_path))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_convert_text(self):
+        d = "test/data/convert-text"
+        k3fs.remove(d, onerror="ignore")
+        os.makedirs(d)
+        k3fs.fwrite(d, "slim.jpg", "jpg")
+
+        fn = md2zhihu.asset.file_md5(pjoin(d, "slim.jpg"))[:16] + "-slim.jpg"
+
+        # Assets are kept in memory, nothing is written
+        rst = md2zhihu.convert_text(
+            "# T\n\n![](slim.jpg)\n",
+            "github",
+            src_path=pjoin(d, "foo.md"),
+            output_dir="out",
+            asset_url_pattern="https://cdn.example.com/{path}",
+        )
+        self.assertTrue(rst.markdown.startswith("# T\n\n![](https://cdn.example.com/foo/" + fn + ")\n"))
+        self.assertEqual([pjoin("out", "foo", fn)], rst.assets)
+        self.assertEqual({pjoin("out", "foo", fn): b"jpg"}, rst.blobs())
+        self.assertFalse(os.path.exists("out"))
+
+        # Write assets to dir
+        out = pjoin(d, "out")
+        rst = md2zhihu.convert_text(
+            "![](slim.jpg)\n",
+            "github",
+            src_path=pjoin(d, "foo.md"),
+            asset_sink=md2zhihu.DirSink(),
+            output_dir=out,
+        )
+        self.assertTrue(rst.markdown.startswith("![](foo/" + fn + ")\n"))
+        self.assertEqual("jpg", k3fs.fread(out, "foo", fn))
+
+        # A written asset is readable by others, as a file created by open()
+        umask = os.umask(0o022)
+        try:
+            md2zhihu.DirSink().write(pjoin(out, "bar", "x.jpg"), b"x")
+        finally:
+            os.umask(umask)
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(pjoin(out, "bar", "x.jpg")).st_mode))
+        self.assertEqual(["x.jpg"], os.listdir(pjoin(out, "bar")))
+
+        k3fs.remove(d, onerror="ignore")
+
+    def test_pipeline(self):
+        md = "\n".join(
+            [
+                "- foo",
+                "",
+                "  | a | b |",
+                "  | - | - |",
+                "  | 1 | $x$ |",
+                "",
+                "see [ref] and $y$:",
+                "",
+                "$$",
+                "a",
+                "",
+                "b",
+                "$$",
+                "",
+                "[ref]: http://a.com",
+                "",
+            ]
+        )
+        md, refs = md2zhihu.parser.extract_ref_definitions(md)
+
+        # run transforms one by one
+        want = md2zhihu.parser.new_parser()(md)
+        want = md2zhihu.parser.parse_in_list_tables(want)
+        want_used = md2zhihu.parser.replace_ref_with_def(want, refs, True)
+        want = md2zhihu.parser.parse_math(want)
+        md2zhihu.parser.join_math_block(want)
+        want = md2zhihu.parser.parse_math(want)
+
+        refs_pass = md2zhihu.parser.ReplaceRefPass(refs, True)
+        pipeline = md2zhihu.parser.Pipeline(
+            [
+                md2zhihu.parser.InListTablePass(),
+                refs_pass,
+                md2zhihu.parser.ParseMathPass(),
+                md2zhihu.parser.JoinMathPass(),
+                md2zhihu.parser.ParseMathPass(name="parse_joined_math"),
+            ],
+            timing=True,
+        )
+        self.assertEqual(2, len(pipeline.stages))
+
+        got = pipeline.run(md2zhihu.parser.new_parser()(md))
+        self.assertEqual(want, got)
+        self.assertEqual(want_used, refs_pass.used_defs)
+
+        self.assertEqual(
+            ["join_math_block", "parse_in_list_tables", "parse_joined_math", "parse_math", "replace_ref_with_def"],
+            sorted(pipeline.timings.keys()),
+        )
+        self.assertGreater(pipeline.timings["parse_math"], 0)
+
+    def test_join_math_text(self):
+        def para(*texts):
+            return {"type": "paragraph", "children": [{"type": "text", "text": t} for t in texts]}
+
+        nodes = [para("a $$"), para("x"), para("y $$", "b"), para("c"), {"type": "thematic_break"}]
+        md2zhihu.parser.join_math_block(nodes)
+        self.assertEqual(
+            [para("a $$\n\nx\n\ny $$", "b"), para("c"), {"type": "thematic_break"}],
+            nodes,
+        )
+
+        got = md2zhihu.parser.parse_math(nodes[:1])
+        self.assertEqual(
+            [
+                {"type": "text", "text": "a "},
+                {"type": "math_inline", "text": "\n\nx\n\ny "},
+                {"type": "text", "text": ""},
+                {"type": "text", "text": "b"},
+            ],
+            got[0]["children"],
+        )
+
+    def test_line_rope(self):
+        LineRope = md2zhihu.renderer.LineRope
+
+        inner = LineRope(first=("-   ", False), rest=("    ", True))
+        inner.extend(["a", "", "b", ""])
+
+        children = LineRope()
+        children.extend(["q"])
+        children.extend(inner)
+
+        # The empty line in a list item is not indented
+        self.assertTrue(children.last_is_empty())
+        children.strip_end()
+        self.assertEqual(4, len(children))
+
+        quoted = LineRope(first=("> ", False), rest=("> ", False))
+        quoted.extend(children)
+        self.assertFalse(quoted.last_is_empty())
+
+        outer = LineRope(first=("1.  ", False), rest=("    ", True))
+        outer.extend(quoted)
+        outer.append("")
+        outer.append("c")
+
+        self.assertEqual(
+            ["1.  > q", "    > -   a", "    > ", "    >     b", "", "    c"],
+            outer.to_list(),
+        )
+
+    def test_compile_features(self):
+        compile_features = md2zhihu.renderer.dispatch.compile_features
+
+        def upper_text(mdr, rnode):
+            return [rnode.node["text"].upper()]
+
+        def skip_all(mdr, rnode):
+            return None
+
+        features = {
+            "text": upper_text,
+            "block_code": {"foo": upper_text, "*": skip_all},
+            "*": skip_all,
+        }
+        table = compile_features(features)
+        self.assertIs(table, compile_features(features))
+
+        mdr = md2zhihu.MDRender(None, features=features)
+        self.assertEqual(table, (mdr.handlers, mdr.fallback))
+
+        def render(n):
+            return mdr.render_node(md2zhihu.RenderNode(n))
+
+        self.assertEqual(["ABC"], render({"type": "text", "text": "abc"}))
+        self.assertEqual(["ABC\n"], render({"type": "block_code", "info": "foo", "text": "abc\n"}))
+
+        # A feature returning None falls back to the default renderer
+        self.assertEqual(["```bar", "abc", "```", ""], render({"type": "block_code", "info": "bar", "text": "abc\n"}))
+        self.assertEqual(["`abc`"], render({"type": "codespan", "text": "abc"}))
+
+        self.assertEqual(["***:foo"], render({"type": "foo"}))
+
+    def test_render_node(self):
+        root = md2zhihu.RenderNode({"type": "ROOT"})
+        p = root.new_child({"type": "paragraph"})
+        m = p.new_child({"type": "math_block"})
+
+        self.assertEqual((0, 1, 2), (root.level, p.level, m.level))
+        self.assertIs(p, m.parent)
+        self.assertEqual("ROOT -> paragraph -> math_block", m.to_str())
+
+        self.assertFalse(hasattr(m, "__dict__"))
+
+    def test_compact_ast(self):
+        n = md2zhihu.Node.from_dict({"type": "image", "src": "a.jpg", "alt": "a", "title": None})
+        self.assertEqual({"type": "image", "src": "a.jpg", "alt": "a", "title": None}, n)
+        self.assertNotIn("children", n)
+        self.assertIsNone(n.get("children"))
+        self.assertEqual("![a](a.jpg)", "![{alt}]({src})".format(**n))
+
+        n["type"] = "text"
+        n["text"] = "x"
+        del n["src"]
+        self.assertEqual(["type", "text", "alt", "title"], list(n.keys()))
+
+        md_text = k3fs.fread("test/data/transparent/src/transparent.md")
+        conf = md2zhihu.Config("x.md", "transparent", "output_foo", "output_foo", md_output_path="output_md")
+
+        want = md2zhihu.Article(md2zhihu.ParserConfig(True, []), conf, md_text)
+        got = md2zhihu.Article(md2zhihu.ParserConfig(True, [], compact_ast=True), conf, md_text)
+
+        self.assertIsInstance(got.ast[0], md2zhihu.Node)
+        self.assertEqual(want.ast, got.ast)
+
     def test_rules_to_features(self):
         rules = [
             "image:local_to_remote",